@@ -0,0 +1,112 @@
+"""Batched data augmentation for uint8 image batches.
+
+The default pipeline applies the augmentations one image at a time in each dataloader
+worker, and sends normalized float32 images to the main process. Instead, workers may
+return uint8 batches (4x smaller), and the augmentations (random crop, horizontal flip and
+normalization) can be applied to the whole batch at once, either in the collate function
+of the dataloader or on the device after the batch has been transferred.
+
+"""
+
+from typing import Optional, Sequence
+
+import torch
+import torch.utils.data
+
+
+# Values taken from ImageNet
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class BatchAugmentation(torch.nn.Module):
+    """Crops, flips and normalizes a batch of uint8 images.
+
+    In training mode, a random crop and a random horizontal flip is applied to each
+    image of the batch. In evaluation mode, the center crop of each image is taken.
+    The crop and flip are computed with a single gather over the batch.
+
+    Parameters
+    ----------
+    crop_size : int
+        Size of the (square) crop to take from each image.
+    eval_crop_size : int, optional
+        Size of the center crop in evaluation mode, if different from `crop_size`.
+        This allows changing the training crop size (see `bootcamp.progressive`) independently.
+    flip : bool
+        If `True`, randomly flips images horizontally in training mode.
+    mean : Sequence[float]
+        Per-channel mean used for normalization, for images scaled to [0, 1].
+    std : Sequence[float]
+        Per-channel standard deviation used for normalization, for images scaled to [0, 1].
+    """
+
+    def __init__(self, crop_size: int=224, flip: bool=True,
+                 mean: Sequence[float]=IMAGENET_MEAN, std: Sequence[float]=IMAGENET_STD,
+                 eval_crop_size: Optional[int]=None):
+        super().__init__()
+
+        self.crop_size = crop_size
+        self.eval_crop_size = eval_crop_size if eval_crop_size is not None else crop_size
+        self.flip = flip
+
+        # Fold the conversion from [0, 255] to [0, 1] into the normalization
+        self.register_buffer('mean', torch.tensor(mean).mul_(255).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).mul_(255).view(1, -1, 1, 1), persistent=False)
+
+    def _crop_indices(self, n: int, height: int, width: int, device: torch.device):
+        size = self.crop_size if self.training else self.eval_crop_size
+        offsets = torch.arange(size, device=device)
+
+        if self.training:
+            top = torch.randint(0, height - size + 1, (n, 1), device=device)
+            left = torch.randint(0, width - size + 1, (n, 1), device=device)
+        else:
+            top = torch.full((n, 1), (height - size) // 2, device=device)
+            left = torch.full((n, 1), (width - size) // 2, device=device)
+
+        rows = top + offsets
+        cols = left + offsets
+
+        if self.training and self.flip:
+            flip = torch.rand((n, 1), device=device) < 0.5
+            cols = torch.where(flip, left + (size - 1 - offsets), cols)
+
+        return rows, cols
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        """Augments the given batch of images.
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            A uint8 tensor of shape `[N, C, H, W]`.
+
+        Returns
+        -------
+        torch.Tensor
+            A float32 tensor of shape `[N, C, S, S]`, where `S` is the crop size of the current mode.
+        """
+        n, c, height, width = images.shape
+        rows, cols = self._crop_indices(n, height, width, images.device)
+
+        batch_idx = torch.arange(n, device=images.device).view(n, 1, 1, 1)
+        channel_idx = torch.arange(c, device=images.device).view(1, c, 1, 1)
+
+        images = images[batch_idx, channel_idx, rows.view(n, 1, -1, 1), cols.view(n, 1, 1, -1)]
+
+        return images.float().sub_(self.mean).div_(self.std)
+
+
+def collate_and_augment(batch, augmentation: BatchAugmentation):
+    """Collate function which applies the given augmentation to the collated batch.
+
+    This may be used with `functools.partial` as the `collate_fn` of a dataloader,
+    in order to apply the augmentation in the dataloader workers.
+    """
+    images, labels = torch.utils.data.default_collate(batch)
+
+    with torch.no_grad():
+        images = augmentation(images)
+
+    return images, labels
@@ -0,0 +1,278 @@
+"""Pre-decoded image cache for the places365 dataset.
+
+Decoding jpeg images is the main cost of loading data for training. As the small version
+of places365 is made of 256x256 images, we may instead decode all images once into a single
+`N x 256 x 256 x 3` uint8 array, stored as a numpy file which is memory-mapped during training.
+Note that the resulting cache is large (~350GB for the training split), and is best placed
+on a local SSD or in `/dev/shm` (see README).
+
+As the validation split is only ever center-cropped, we may go further for that split and
+store the final (cropped) uint8 images in CHW layout, so that complete batches can be read as
+contiguous slices of the cache, see `build_eval_cache` and `EvalCacheDataset`.
+
+"""
+
+import dataclasses
+import multiprocessing
+import os
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import hydra
+import numpy as np
+import PIL.Image
+import torch
+import torch.utils.data
+
+
+def images_path(cache_root: str, split: str) -> str:
+    return os.path.join(cache_root, f'{split}_images.npy')
+
+
+def labels_path(cache_root: str, split: str) -> str:
+    return os.path.join(cache_root, f'{split}_labels.npy')
+
+
+def eval_images_path(cache_root: str, split: str, crop_size: int) -> str:
+    return os.path.join(cache_root, f'{split}_center{crop_size}_images.npy')
+
+
+def eval_labels_path(cache_root: str, split: str, crop_size: int) -> str:
+    return os.path.join(cache_root, f'{split}_center{crop_size}_labels.npy')
+
+
+def load_image(path: str, image_size: int) -> np.ndarray:
+    with PIL.Image.open(path) as img:
+        img = img.convert('RGB')
+
+        if img.size != (image_size, image_size):
+            img = img.resize((image_size, image_size), PIL.Image.BILINEAR)
+
+        return np.asarray(img)
+
+
+def _decode_chunk(path: str, start: int, files: Sequence[str], image_size: int, crop_size: Optional[int]=None):
+    images = np.load(path, mmap_mode='r+')
+
+    for i, file in enumerate(files):
+        img = load_image(file, image_size)
+
+        if crop_size is not None:
+            offset = (image_size - crop_size) // 2
+            img = img[offset:offset + crop_size, offset:offset + crop_size].transpose(2, 0, 1)
+
+        images[start + i] = img
+
+    images.flush()
+
+
+def _decode_chunk_star(args):
+    return _decode_chunk(*args)
+
+
+def _decode_all(path: str, files: Sequence[str], shape: Tuple[int, ...], image_size: int,
+                crop_size: Optional[int], num_workers: int, chunk_size: int):
+    """Decodes all given files into a new array at the given path, in parallel."""
+    images = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+    del images
+
+    tasks = [
+        (path, start, files[start:start + chunk_size], image_size, crop_size)
+        for start in range(0, len(files), chunk_size)]
+
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            pool.map(_decode_chunk_star, tasks, chunksize=1)
+    else:
+        for t in tasks:
+            _decode_chunk(*t)
+
+
+def build_image_cache(items: Sequence[Tuple[str, int]], cache_root: str, split: str,
+                      image_size: int=256, num_workers: int=1, chunk_size: int=1024):
+    """Decodes the given images into a memory-mapped uint8 array.
+
+    The images are written into a temporary file which is only moved in place once
+    all images have been decoded, so that a partially written cache is never used.
+
+    Parameters
+    ----------
+    items : Sequence[Tuple[str, int]]
+        List of paths to encoded images and their corresponding labels.
+    cache_root : str
+        Directory in which to write the cache.
+    split : str
+        Name of the split, used to name the cache files.
+    image_size : int
+        Size of the decoded images. Images of a different size are resized.
+    num_workers : int
+        Number of processes used to decode the images.
+    chunk_size : int
+        Number of images decoded by each task.
+    """
+    os.makedirs(cache_root, exist_ok=True)
+
+    files = [file for file, _ in items]
+    labels = np.array([label for _, label in items], dtype=np.int16)
+
+    tmp_path = images_path(cache_root, split) + '.tmp'
+    _decode_all(
+        tmp_path, files, (len(files), image_size, image_size, 3),
+        image_size, None, num_workers, chunk_size)
+
+    np.save(labels_path(cache_root, split), labels)
+    os.replace(tmp_path, images_path(cache_root, split))
+
+
+def build_eval_cache(items: Sequence[Tuple[str, int]], cache_root: str, split: str='val',
+                     image_size: int=256, crop_size: int=224, num_workers: int=1, chunk_size: int=1024):
+    """Decodes and center-crops the given images into a memory-mapped uint8 array in CHW layout.
+
+    This corresponds to the (deterministic) evaluation transform, up to normalization,
+    which is applied by the model on the device.
+    Parameters are as for `build_image_cache`, with `crop_size` the size of the center crop.
+    """
+    os.makedirs(cache_root, exist_ok=True)
+
+    files = [file for file, _ in items]
+    labels = np.array([label for _, label in items], dtype=np.int16)
+
+    tmp_path = eval_images_path(cache_root, split, crop_size) + '.tmp'
+    _decode_all(
+        tmp_path, files, (len(files), 3, crop_size, crop_size),
+        image_size, crop_size, num_workers, chunk_size)
+
+    np.save(eval_labels_path(cache_root, split, crop_size), labels)
+    os.replace(tmp_path, eval_images_path(cache_root, split, crop_size))
+
+
+class MemmapPlacesDataset(torch.utils.data.Dataset):
+    """Dataset reading pre-decoded images from the cache created by `build_image_cache`.
+
+    Images are returned as uint8 tensors in CHW layout, which are views into the memory-mapped
+    file (no copy is made until the transform is applied). The file is opened lazily,
+    so that each dataloader worker holds its own mapping instead of pickling the array.
+    """
+
+    def __init__(self, cache_root: str, split: str, transform: Optional[Callable]=None):
+        super().__init__()
+
+        self.cache_root = cache_root
+        self.split = split
+        self.transform = transform
+        self.labels = np.load(labels_path(cache_root, split))
+        self._images = None
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            # Open in copy-on-write mode, which creates a writable array
+            # (as expected by torch.from_numpy) without ever modifying the file.
+            self._images = np.load(images_path(self.cache_root, self.split), mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        img = torch.from_numpy(self.images[idx]).permute(2, 0, 1)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, int(self.labels[idx])
+
+
+class EvalCacheDataset(torch.utils.data.Dataset):
+    """Dataset reading complete batches from the cache created by `build_eval_cache`.
+
+    Each item of this dataset is a batch of consecutive images, which is read as a single
+    contiguous slice of the cache. It should thus be used with `batch_size=None` in the dataloader.
+    Images are returned as uint8 tensors, and should be normalized on the device.
+
+    When evaluating with several processes, each process reads its own contiguous range of the
+    images, given by `rank` and `world_size`. As the batches are formed within this range,
+    the dataset must not be sharded again by a sampler, which would repeat (or drop) complete batches.
+    """
+
+    def __init__(self, cache_root: str, batch_size: int, split: str='val', crop_size: int=224,
+                 rank: int=0, world_size: int=1):
+        super().__init__()
+
+        self.path = eval_images_path(cache_root, split, crop_size)
+        self.batch_size = batch_size
+        self.labels = torch.from_numpy(np.load(eval_labels_path(cache_root, split, crop_size)).astype(np.int64))
+        self.start = rank * len(self.labels) // world_size
+        self.end = (rank + 1) * len(self.labels) // world_size
+        self._images = None
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def num_samples(self):
+        """Number of samples read by this process."""
+        return self.end - self.start
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        if idx >= len(self):
+            raise IndexError(idx)
+
+        start = self.start + idx * self.batch_size
+        batch = slice(start, min(start + self.batch_size, self.end))
+        return torch.from_numpy(self.images[batch]), self.labels[batch]
+
+
+@dataclasses.dataclass
+class ImageCacheConfig:
+    """Configuration for creating the decoded image cache.
+
+    Attributes
+    ----------
+    root : str
+        Root directory of the places365 dataset.
+    output : str
+        Directory in which to write the cache.
+    splits : List[str]
+        List of splits to decode.
+    num_workers : int
+        Number of processes used to decode images.
+    """
+    root: str = '/places365'
+    output: str = '/dev/shm/places365_cache'
+    splits: List[str] = dataclasses.field(default_factory=lambda: ['train-standard', 'val'])
+    num_workers: int = 8
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: ImageCacheConfig):
+    import torchvision
+
+    output = hydra.utils.to_absolute_path(config.output)
+
+    for split in config.splits:
+        ds = torchvision.datasets.Places365(config.root, split=split, small=True)
+        print(f'Decoding {len(ds)} images from split {split}.')
+        build_image_cache(ds.imgs, output, split, num_workers=config.num_workers)
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=ImageCacheConfig)
+    main()
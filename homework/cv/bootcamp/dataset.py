@@ -1,9 +1,40 @@
 """This module encapsulates the places365 dataset as provided by torchvision
 as a pytorch-lightning datamodule.
+
+In addition to reading the original image files, the datamodule may also read
+from packed shards created by `bootcamp.shards` by setting `data_format='shards'`,
+or from pre-decoded images created by `bootcamp.cache` by setting `data_format='memmap'`.
+
+By default, augmentations are applied to each image separately in the dataloader workers.
+When `augment_on` is set to `'collate'` or `'device'`, the workers instead produce batches of
+uint8 images, which are augmented as a batch (see `bootcamp.augment`), either in the collate function
+or on the device (in `PlacesModel.on_after_batch_transfer`).
+
+As the validation transform is deterministic, the preprocessed validation set may also be
+cached (see `bootcamp.cache.build_eval_cache`) by setting `val_cache=True`. The cache is created
+in `prepare_data` if it does not exist, and read in large contiguous batches afterwards.
+
+When reading the original image files, the list of images is read from a persistent
+index (see `bootcamp.index`), which is created the first time the dataset is used.
+
+Setting `resolution_schedule` changes the training crop size and batch size between epochs
+without re-creating the dataloader workers, through the shared `resolution` state of the datamodule
+(see `bootcamp.progressive`). The trainer must then reload the dataloaders every epoch.
+
+When training with several processes, the datamodule shards the data between them itself, and
+the trainer must not replace the samplers (`replace_sampler_ddp=False`), which would re-create the
+dataloaders. The training samples are split by a `DistributedSampler`, and the validation samples
+into contiguous ranges without padding, so that no sample is evaluated twice.
+
+Setting `profile=True` records the time spent in each stage of loading training samples
+in the dataloader workers (see `bootcamp.monitor.ProfiledDataset`).
 """
 
-from typing import Optional
+import functools
+import os
+from typing import Optional, Tuple
 
+import numpy as np
 import pytorch_lightning
 
 import torch
@@ -11,53 +42,270 @@ import torch.utils.data
 import torchvision
 import torchvision.transforms
 
+from . import augment, cache, index, monitor, progressive, shards
+
 
 class PlacesDataModule(pytorch_lightning.LightningDataModule):
-    def __init__(self, batch_size: int, root='/places365', num_data_workers: int=4):
+    def __init__(self, batch_size: int, root='/places365', num_data_workers: int=4,
+                 data_format: str='folder', shards_root: Optional[str]=None, shuffle_buffer: int=8192,
+                 cache_root: Optional[str]=None, augment_on: str='sample',
+                 val_cache: bool=False, val_batch_size: Optional[int]=None,
+                 index_cache_dir: str=index.DEFAULT_CACHE_DIR, profile: bool=False,
+                 resolution_schedule: Optional[progressive.ResolutionSchedule]=None):
         super().__init__()
 
+        if data_format not in ('folder', 'shards', 'memmap'):
+            raise ValueError(f'Unknown data format {data_format}')
+
+        if data_format == 'shards' and shards_root is None:
+            raise ValueError('shards_root must be specified when using the shards data format')
+
+        if data_format == 'memmap' and cache_root is None:
+            raise ValueError('cache_root must be specified when using the memmap data format')
+
+        if val_cache and cache_root is None:
+            raise ValueError('cache_root must be specified when caching the validation set')
+
+        if augment_on not in ('sample', 'collate', 'device'):
+            raise ValueError(f'Unknown augmentation mode {augment_on}')
+
+        if resolution_schedule is not None and data_format == 'shards':
+            raise ValueError('Progressive resizing is not supported with the shards data format')
+
         self.batch_size = batch_size
         self.root = root
         self.train_ds = None
         self.val_ds = None
         self.num_data_workers = num_data_workers
+        self.data_format = data_format
+        self.shards_root = shards_root
+        self.shuffle_buffer = shuffle_buffer
+        self.cache_root = cache_root
+        self.augment_on = augment_on
+        self.val_cache = val_cache
+        self.val_batch_size = val_batch_size if val_batch_size is not None else batch_size
+        self.index_cache_dir = index_cache_dir
+        self.resolution_schedule = resolution_schedule
+        self._train_dataloader = None
+        self._val_dataloader = None
 
+        if profile:
+            # Must be created before the workers are started, to be shared with them
+            self.data_timings = monitor.StageTimings(
+                ['getitem', 'io', 'decode', 'transform', 'collate'],
+                max_workers=num_data_workers)
+        else:
+            self.data_timings = None
+
+        if resolution_schedule is not None:
+            # Also shared with the workers, and updated at the start of each epoch in `train_dataloader`
+            self.resolution = progressive.ResolutionState(224, batch_size)
+        else:
+            self.resolution = None
+
+    def num_train_samples(self) -> int:
+        """Number of samples in the training set.
+
+        This is computed from the metadata of the current data format, and does
+        not require the datamodule to be set up.
+        """
+        if self.data_format == 'shards':
+            return shards.load_manifest(self.shards_root, 'train-standard')['num_records']
+        elif self.data_format == 'memmap':
+            return len(np.load(cache.labels_path(self.cache_root, 'train-standard'), mmap_mode='r'))
+        else:
+            return index.index_length(self.root, 'train-standard', self.index_cache_dir)
+
+    def prepare_data(self) -> None:
+        if not self.val_cache:
+            return
+
+        if (os.path.exists(cache.eval_images_path(self.cache_root, 'val', 224)) and
+                os.path.exists(cache.eval_labels_path(self.cache_root, 'val', 224))):
+            return
+
+        ds = index.PlacesIndexDataset(self.root, 'val', cache_dir=self.index_cache_dir)
+        cache.build_eval_cache(ds.imgs, self.cache_root, 'val', crop_size=224, num_workers=max(self.num_data_workers, 1))
+
+    def _make_transform(self, train: bool):
+        """Creates the per-sample transform for the current data format and augmentation mode."""
+        if self.augment_on != 'sample':
+            # Images are only converted to uint8 tensors, and augmented as a batch later.
+            # Cached images are already uint8 tensors.
+            if self.data_format == 'memmap':
+                return None
+            return torchvision.transforms.PILToTensor()
 
-    def setup(self, stage: Optional[str]=None) -> None:
-        # Values taken from ImageNet
         normalize = torchvision.transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225])
+            mean=augment.IMAGENET_MEAN,
+            std=augment.IMAGENET_STD)
+
+        if train:
+            if self.resolution is not None:
+                random_crop = progressive.ScheduledRandomCrop(self.resolution)
+            else:
+                random_crop = torchvision.transforms.RandomCrop(224)
 
-        self.train_ds = torchvision.datasets.Places365(
-            self.root, small=True,
-            transform=torchvision.transforms.Compose([
-                torchvision.transforms.RandomCrop(224),
+            crop = [
+                random_crop,
                 torchvision.transforms.RandomHorizontalFlip(),
-                torchvision.transforms.ToTensor(),
-                normalize
-            ]))
+            ]
+        else:
+            crop = [torchvision.transforms.CenterCrop(224)]
+
+        if self.data_format == 'memmap':
+            # Cached images are already decoded as uint8 tensors,
+            # so we crop them before converting to floating point.
+            to_tensor = torchvision.transforms.ConvertImageDtype(torch.float32)
+        else:
+            to_tensor = torchvision.transforms.ToTensor()
 
-        self.val_ds = torchvision.datasets.Places365(
-            self.root, split='val', small=True,
-            transform=torchvision.transforms.Compose([
-                torchvision.transforms.CenterCrop(224),
-                torchvision.transforms.ToTensor(),
-                normalize
-            ]))
+        return torchvision.transforms.Compose(crop + [to_tensor, normalize])
+
+    def _make_collate(self, train: bool):
+        if self.augment_on != 'collate':
+            return None
+
+        augmentation = augment.BatchAugmentation(224)
+        augmentation.train(train)
+
+        if train and self.resolution is not None:
+            return functools.partial(progressive.scheduled_collate, augmentation=augmentation, state=self.resolution)
+
+        return functools.partial(augment.collate_and_augment, augmentation=augmentation)
+
+    def _rank_info(self) -> Tuple[int, int]:
+        """Rank of the current process and number of processes, or `(0, 1)` outside of a trainer."""
+        if self.trainer is None:
+            return 0, 1
+        return self.trainer.global_rank, self.trainer.world_size
+
+    def _train_sampler(self, ds) -> torch.utils.data.Sampler:
+        rank, world_size = self._rank_info()
+        if world_size > 1:
+            return torch.utils.data.DistributedSampler(ds, num_replicas=world_size, rank=rank, shuffle=True)
+        return torch.utils.data.RandomSampler(ds)
+
+    def setup(self, stage: Optional[str]=None) -> None:
+        self._train_dataloader = None
+        self._val_dataloader = None
+        train_transform = self._make_transform(train=True)
+        val_transform = self._make_transform(train=False)
+
+        if self.val_cache:
+            rank, world_size = self._rank_info()
+            self.val_ds = cache.EvalCacheDataset(
+                self.cache_root, self.val_batch_size, 'val', crop_size=224, rank=rank, world_size=world_size)
+
+        if self.data_format == 'shards':
+            self.train_ds = shards.ShardedPlacesDataset(
+                self.shards_root, 'train-standard',
+                transform=train_transform,
+                shuffle_buffer=self.shuffle_buffer,
+                num_workers=self.num_data_workers,
+                # Each worker produces complete batches, so that the length of the dataloader is exact
+                batch_size=self.batch_size)
+
+            if not self.val_cache:
+                # All validation records are read, so that ranks may produce different numbers of batches
+                self.val_ds = shards.ShardedPlacesDataset(
+                    self.shards_root, 'val',
+                    transform=val_transform,
+                    num_workers=self.num_data_workers,
+                    drop_remainder=False)
+        elif self.data_format == 'memmap':
+            self.train_ds = cache.MemmapPlacesDataset(
+                self.cache_root, 'train-standard',
+                transform=train_transform)
+
+            if not self.val_cache:
+                self.val_ds = cache.MemmapPlacesDataset(
+                    self.cache_root, 'val',
+                    transform=val_transform)
+        else:
+            self.train_ds = index.PlacesIndexDataset(
+                self.root, 'train-standard',
+                transform=train_transform,
+                cache_dir=self.index_cache_dir)
+
+            if not self.val_cache:
+                self.val_ds = index.PlacesIndexDataset(
+                    self.root, 'val',
+                    transform=val_transform,
+                    cache_dir=self.index_cache_dir)
 
 
     def train_dataloader(self):
+        ds = self.train_ds
+        collate_fn = self._make_collate(train=True)
+
+        if self.data_timings is not None:
+            # Only map-style datasets can be profiled per sample
+            if not isinstance(ds, torch.utils.data.IterableDataset):
+                ds = monitor.ProfiledDataset(ds, self.data_timings)
+            collate_fn = monitor.ProfiledCollate(collate_fn, self.data_timings)
+
+        if self.resolution is not None:
+            # Requested again by the trainer at the start of each epoch, so that the
+            # length of the dataloader follows the batch size of the current phase.
+            epoch = self.trainer.current_epoch if self.trainer is not None else 0
+            self.resolution.set_phase(self.resolution_schedule.phase(epoch), self._rank_info()[1])
+
+            # The same dataloader is returned for every epoch, so that its workers are kept
+            if self._train_dataloader is None:
+                self._train_dataloader = torch.utils.data.DataLoader(
+                    ds,
+                    batch_sampler=progressive.ScheduledBatchSampler(self._train_sampler(ds), self.resolution),
+                    num_workers=self.num_data_workers,
+                    collate_fn=collate_fn,
+                    persistent_workers=self.num_data_workers > 0)
+
+            # Reshuffles (the shard of) the samples every epoch
+            self._train_dataloader.batch_sampler.set_epoch(epoch)
+            return self._train_dataloader
+
+        if isinstance(ds, torch.utils.data.IterableDataset):
+            # Iterable datasets handle sharding and shuffling internally
+            sampler = None
+        else:
+            sampler = self._train_sampler(ds)
+
         return torch.utils.data.DataLoader(
-            self.train_ds,
+            ds,
             batch_size=self.batch_size,
-            shuffle=True,
+            sampler=sampler,
             num_workers=self.num_data_workers,
+            collate_fn=collate_fn,
             persistent_workers=True)
 
     def val_dataloader(self):
+        # Also requested every epoch when progressive resizing reloads the dataloaders
+        if self._val_dataloader is None:
+            self._val_dataloader = self._make_val_dataloader()
+        return self._val_dataloader
+
+    def _make_val_dataloader(self):
+        if self.val_cache:
+            # The dataset already produces complete (uint8) batches, from the range of samples of this process
+            return torch.utils.data.DataLoader(
+                self.val_ds,
+                batch_size=None,
+                shuffle=False,
+                num_workers=self.num_data_workers,
+                pin_memory=True,
+                persistent_workers=self.num_data_workers > 0)
+
+        ds = self.val_ds
+        rank, world_size = self._rank_info()
+        if world_size > 1 and not isinstance(ds, torch.utils.data.IterableDataset):
+            # Contiguous range of the samples, as padding (as done by `DistributedSampler`) would repeat samples
+            ds = torch.utils.data.Subset(ds, range(rank * len(ds) // world_size, (rank + 1) * len(ds) // world_size))
+
         return torch.utils.data.DataLoader(
-            self.val_ds,
-            batch_size=self.batch_size,
+            ds,
+            batch_size=self.val_batch_size,
             shuffle=False,
-            num_workers=self.num_data_workers)
+            num_workers=self.num_data_workers,
+            collate_fn=self._make_collate(train=False),
+            pin_memory=True,
+            persistent_workers=self.num_data_workers > 0)
@@ -0,0 +1,70 @@
+"""Data-parallel training on CPU.
+
+When training without GPUs, a single process leaves many cores of a large node idle,
+as each step is only partially parallelized. Instead, we may run several data-parallel
+processes with DDP over the gloo backend, each pinned to a disjoint set of cores and using
+as many threads as it has cores. The data is sharded across the processes as for GPU training.
+
+This is the canonical version of this module: homework/nlp keeps a copy,
+as the two projects are installed independently. Changes should be made to both.
+
+"""
+
+import os
+from typing import Any, List, Optional, Sequence
+
+import pytorch_lightning.strategies
+import torch
+
+
+def rank_cores(local_rank: int, num_ranks: int, cores: Optional[Sequence[int]]=None) -> List[int]:
+    """Computes the cores assigned to the given rank, as a contiguous block of the available cores.
+
+    The cores are split as evenly as possible between the ranks. If there are fewer cores
+    than ranks, each rank is assigned a single core, shared with other ranks.
+
+    Parameters
+    ----------
+    local_rank : int
+        The rank of the process on the current node.
+    num_ranks : int
+        The number of processes on the current node.
+    cores : Sequence[int], optional
+        The cores available to all processes, by default the cores this process may run on.
+    """
+    if cores is None:
+        cores = os.sched_getaffinity(0)
+
+    cores = sorted(cores)
+
+    if num_ranks > len(cores):
+        return [cores[local_rank % len(cores)]]
+
+    start = local_rank * len(cores) // num_ranks
+    end = (local_rank + 1) * len(cores) // num_ranks
+    return cores[start:end]
+
+
+def pin_to_cores(cores: Sequence[int]):
+    """Restricts the current process to the given cores, and uses one thread per core."""
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+class CPUDDPStrategy(pytorch_lightning.strategies.DDPStrategy):
+    """DDP strategy for training on CPU, pinning each process to its own set of cores.
+
+    Dataloader workers inherit the affinity of their process, and thus do not
+    compete with the computation of other processes.
+    """
+
+    def __init__(self, **kwargs: Any):
+        kwargs.setdefault('process_group_backend', 'gloo')
+        super().__init__(**kwargs)
+
+        # Record the available cores before any process is pinned
+        self._available_cores = sorted(os.sched_getaffinity(0))
+
+    def setup_environment(self) -> None:
+        pin_to_cores(rank_cores(self.local_rank, self.num_processes, self._available_cores))
+        super().setup_environment()
@@ -0,0 +1,175 @@
+"""Persistent index of the places365 file lists.
+
+Constructing `torchvision.datasets.Places365` parses the text file listing all images
+of the split (1.8M lines for the training split) into a list of python tuples, and checks
+the md5 sum of the metadata files. This happens every time the dataset is created, and in
+every process when training on multiple GPUs.
+
+Instead, this module parses the file list once, and stores it as compact numpy arrays
+(the concatenated relative paths, their offsets, and the labels) in a cache directory.
+The cache is keyed by the location of the dataset and the split, and loaded as memory-mapped
+arrays, so that loading the index (or simply querying its length) is nearly free.
+
+"""
+
+import hashlib
+import os
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.datasets.folder
+
+
+DEFAULT_CACHE_DIR = '~/.cache/bootcamp/places365'
+
+_FILE_LISTS = {
+    'train-standard': 'places365_train_standard.txt',
+    'train-challenge': 'places365_train_challenge.txt',
+    'val': 'places365_val.txt',
+}
+
+
+def file_list_path(root: str, split: str) -> str:
+    return os.path.join(root, _FILE_LISTS[split])
+
+
+def images_dir(root: str, split: str) -> str:
+    """Directory containing the small images of the given split, as laid out by torchvision."""
+    if split.startswith('train'):
+        variant = 'challenge' if 'challenge' in split else 'standard'
+        return os.path.join(root, f'data_256_{variant}')
+    return os.path.join(root, f'{split}_256')
+
+
+def _cache_prefix(root: str, split: str, cache_dir: str) -> str:
+    file_list = file_list_path(root, split)
+    stat = os.stat(file_list)
+
+    # Key by the location and version of the file list, so that the index is rebuilt if it changes.
+    key = f'{os.path.abspath(file_list)}:{stat.st_size}:{stat.st_mtime_ns}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(cache_dir), f'{split}-{digest}')
+
+
+def _parse_file_list(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    names = []
+    labels = []
+
+    with open(path, 'rb') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+
+            names.append(parts[0].lstrip(b'/'))
+            labels.append(int(parts[1]) if len(parts) > 1 else -1)
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in names], out=offsets[1:])
+    paths = np.frombuffer(b''.join(names), dtype=np.uint8)
+
+    return paths, offsets, np.array(labels, dtype=np.int16)
+
+
+def _save_array(path: str, array: np.ndarray):
+    # Write to a temporary file unique to this process, so that several
+    # processes concurrently building the same index do not interfere.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def build_index(root: str, split: str, cache_dir: str=DEFAULT_CACHE_DIR) -> str:
+    """Parses the file list of the given split and saves it to the cache.
+
+    Returns
+    -------
+    str
+        The prefix of the files composing the index in the cache.
+    """
+    prefix = _cache_prefix(root, split, cache_dir)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+    paths, offsets, labels = _parse_file_list(file_list_path(root, split))
+
+    _save_array(prefix + '_paths.npy', paths)
+    _save_array(prefix + '_offsets.npy', offsets)
+    # The labels are written last, their presence indicates a complete index
+    _save_array(prefix + '_labels.npy', labels)
+
+    return prefix
+
+
+def _get_index_prefix(root: str, split: str, cache_dir: str) -> str:
+    prefix = _cache_prefix(root, split, cache_dir)
+
+    if not os.path.exists(prefix + '_labels.npy'):
+        build_index(root, split, cache_dir)
+
+    return prefix
+
+
+def index_length(root: str, split: str, cache_dir: str=DEFAULT_CACHE_DIR) -> int:
+    """Returns the number of images in the given split, building the index if necessary."""
+    prefix = _get_index_prefix(root, split, cache_dir)
+    return len(np.load(prefix + '_labels.npy', mmap_mode='r'))
+
+
+class PlacesIndexDataset(torch.utils.data.Dataset):
+    """Places365 dataset backed by the cached index.
+
+    This dataset is equivalent to `torchvision.datasets.Places365` with `small=True`,
+    but reads the list of images from the memory-mapped index instead of the original file list.
+    """
+
+    def __init__(self, root: str, split: str='train-standard', transform: Optional[Callable]=None,
+                 cache_dir: str=DEFAULT_CACHE_DIR, loader: Callable=torchvision.datasets.folder.default_loader):
+        super().__init__()
+
+        prefix = _get_index_prefix(root, split, cache_dir)
+
+        self.root = root
+        self.split = split
+        self.images_dir = images_dir(root, split)
+        self.transform = transform
+        self.loader = loader
+        self._prefix = prefix
+        self._load()
+
+    def _load(self):
+        self.paths = np.load(self._prefix + '_paths.npy', mmap_mode='r')
+        self.offsets = np.load(self._prefix + '_offsets.npy', mmap_mode='r')
+        self.targets = np.load(self._prefix + '_labels.npy', mmap_mode='r')
+
+    def __getstate__(self):
+        # Re-open the memory-mapped arrays in each worker instead of copying them
+        state = self.__dict__.copy()
+        del state['paths'], state['offsets'], state['targets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def image_path(self, idx: int) -> str:
+        name = self.paths[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode()
+        return os.path.join(self.images_dir, name)
+
+    @property
+    def imgs(self):
+        """List of (image path, label) tuples, as for `torchvision.datasets.Places365`."""
+        return [(self.image_path(i), int(self.targets[i])) for i in range(len(self))]
+
+    def __getitem__(self, idx):
+        image = self.loader(self.image_path(idx))
+
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, int(self.targets[idx])
@@ -0,0 +1,67 @@
+"""Fused top-k accuracy metric.
+
+Computing the top-1 and top-5 accuracies with separate `torchmetrics.Accuracy` objects
+performs a separate top-k selection over the logits for each of them. Instead, we compute
+a single `topk` for the largest requested k, from which the accuracies for all smaller
+values of k may be derived.
+
+"""
+
+from typing import Dict, Sequence
+
+import torch
+import torchmetrics
+
+
+def topk_correct(logits: torch.Tensor, target: torch.Tensor, top_k: Sequence[int]=(1, 5)) -> torch.Tensor:
+    """Counts the number of samples for which the target is within the top-k predictions.
+
+    Parameters
+    ----------
+    logits : torch.Tensor
+        Tensor of shape `[batch, num_classes]` of predicted scores.
+    target : torch.Tensor
+        Tensor of shape `[batch]` of target classes.
+    top_k : Sequence[int]
+        Values of k for which to count correct predictions.
+
+    Returns
+    -------
+    torch.Tensor
+        Integer tensor of shape `[len(top_k)]` of correct prediction counts for each k.
+    """
+    with torch.no_grad():
+        _, pred = logits.topk(max(top_k), dim=-1)
+        # As the predictions are sorted, the target is in the top-k
+        # iff it is within the first k columns, so a cumulative sum suffices.
+        correct = pred.eq(target.unsqueeze(-1)).cumsum(dim=-1)
+        return torch.stack([correct[:, k - 1].sum() for k in top_k])
+
+
+def topk_accuracy(logits: torch.Tensor, target: torch.Tensor, top_k: Sequence[int]=(1, 5)) -> Dict[str, torch.Tensor]:
+    """Computes the top-k accuracies of the given batch for each given k."""
+    accuracies = topk_correct(logits, target, top_k).float() / target.shape[0]
+    return {f'accuracy_top{k}': acc for k, acc in zip(top_k, accuracies)}
+
+
+class TopKAccuracy(torchmetrics.Metric):
+    """Accumulates top-k accuracies for several values of k from a single top-k selection.
+
+    `compute` returns a dictionary of accuracies, keyed by `accuracy_top{k}`.
+    """
+    full_state_update = False
+
+    def __init__(self, top_k: Sequence[int]=(1, 5), **kwargs):
+        super().__init__(**kwargs)
+
+        self.top_k = tuple(top_k)
+        self.add_state('correct', default=torch.zeros(len(self.top_k), dtype=torch.long), dist_reduce_fx='sum')
+        self.add_state('total', default=torch.tensor(0, dtype=torch.long), dist_reduce_fx='sum')
+
+    def update(self, logits: torch.Tensor, target: torch.Tensor):
+        self.correct += topk_correct(logits, target, self.top_k)
+        self.total += target.shape[0]
+
+    def compute(self) -> Dict[str, torch.Tensor]:
+        accuracies = self.correct.float() / self.total.clamp(min=1)
+        return {f'accuracy_top{k}': acc for k, acc in zip(self.top_k, accuracies)}
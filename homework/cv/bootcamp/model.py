@@ -4,13 +4,14 @@ as a pytorch lightning module.
 """
 
 import dataclasses
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import omegaconf
 import pytorch_lightning
 import torchvision
 import torch
-import torchmetrics
+
+from . import augment, metrics, optim, progressive
 
 
 @dataclasses.dataclass
@@ -23,6 +24,13 @@ class PlacesOptimConfig:
     learning_rate: float = 1e-2
     weight_decay: float = 1e-5
     grad_clip_norm: Optional[float] = None
+    # One of sgd, lars or lamb (see `optim.create_optimizer`)
+    optimizer: str = 'sgd'
+    momentum: float = 0.9
+    # Trust ratio options of lars and lamb (by default, the coefficient is 0.001 for lars and 1 for lamb)
+    trust_coefficient: Optional[float] = None
+    max_trust_ratio: Optional[float] = 10.0
+    exclude_bias_and_norm: bool = True
 
 
 @dataclasses.dataclass
@@ -30,18 +38,54 @@ class PlacesDataConfig:
     root: str = '/places365'
     dataset_size: Optional[int] = None
     num_workers: int = 4
+    format: str = 'folder'
+    shards_root: Optional[str] = None
+    shuffle_buffer: int = 8192
+    cache_root: Optional[str] = None
+    augment_on: str = 'sample'
+    val_cache: bool = False
+    val_batch_size: Optional[int] = None
+    index_cache_dir: str = '~/.cache/bootcamp/places365'
+    profile: bool = False
+
+
+@dataclasses.dataclass
+class PlacesProgressiveConfig:
+    # Crop size of each phase of training (progressive resizing is disabled if empty)
+    crop_sizes: List[int] = dataclasses.field(default_factory=list)
+    # Number of epochs of each phase but the last, which runs until `max_epochs`
+    epochs: List[int] = dataclasses.field(default_factory=list)
+    scale_batch_size: bool = True
 
 
 @dataclasses.dataclass
 class PlacesTrainingConfig:
-    data: PlacesDataConfig = PlacesDataConfig()
-    model: PlacesModelConfig = PlacesModelConfig()
-    optim: PlacesOptimConfig = PlacesOptimConfig()
+    data: PlacesDataConfig = dataclasses.field(default_factory=PlacesDataConfig)
+    model: PlacesModelConfig = dataclasses.field(default_factory=PlacesModelConfig)
+    optim: PlacesOptimConfig = dataclasses.field(default_factory=PlacesOptimConfig)
+    progressive: PlacesProgressiveConfig = dataclasses.field(default_factory=PlacesProgressiveConfig)
     lightning: Dict[str, Any] = dataclasses.field(default_factory=dict)
     precision: int = 32
     batch_size: int = 256
     max_epochs: int = 60
     gpus: int = 1
+    # Number of data-parallel processes when training on CPU (gpus=0)
+    cpu_processes: int = 1
+    # Compute the training accuracy every n steps only (0 to disable)
+    train_metrics_every_n_steps: int = 1
+
+
+def resolution_schedule(config: PlacesTrainingConfig) -> Optional[progressive.ResolutionSchedule]:
+    """Creates the progressive resizing schedule of the given configuration, if enabled.
+
+    Batch sizes in the schedule are given across all devices, as `config.batch_size`.
+    """
+    if not config.progressive.crop_sizes:
+        return None
+
+    return progressive.ResolutionSchedule.from_crop_sizes(
+        config.progressive.crop_sizes, config.progressive.epochs, config.batch_size,
+        scale_batch_size=config.progressive.scale_batch_size)
 
 
 class PlacesModel(pytorch_lightning.LightningModule):
@@ -56,51 +100,81 @@ class PlacesModel(pytorch_lightning.LightningModule):
         self.save_hyperparameters(config)
         self.model = torchvision.models.mobilenet.mobilenet_v3_large(num_classes=365, _width_mult=config.model.width_multiplier)
         self.criterion = torch.nn.CrossEntropyLoss()
-        self.accuracy_top1 = torchmetrics.Accuracy(num_classes=365)
-        self.accuracy_top5 = torchmetrics.Accuracy(num_classes=365, top_k=5)
+        self.val_accuracy = metrics.TopKAccuracy(top_k=(1, 5))
+        self.batch_augmentation = augment.BatchAugmentation(224)
 
     def forward(self, img):
         return self.model(img)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        img, label = batch
+
+        # Batches of uint8 images have not been augmented by the dataloader
+        # (see `PlacesDataConfig.augment_on`), augment them on the device instead.
+        # Note that the batch augmentation follows the training / evaluation mode of the model.
+        if img.dtype == torch.uint8:
+            img = self.batch_augmentation(img)
+
+        return img, label
+
     def _compute_loss(self, batch):
         img, label = batch
         logits = self(img)
 
         loss = self.criterion(logits, label)
-        acc_top1 = self.accuracy_top1(logits, label)
-        acc_top5 = self.accuracy_top5(logits, label)
 
-        return loss, {'accuracy_top1': acc_top1, 'accuracy_top5': acc_top5}
+        return loss, logits
+
+    def _should_compute_train_metrics(self) -> bool:
+        every_n_steps = self.hparams.train_metrics_every_n_steps
+        return every_n_steps > 0 and self.global_step % every_n_steps == 0
 
     def training_step(self, batch, *_):
-        loss, metrics = self._compute_loss(batch)
+        loss, logits = self._compute_loss(batch)
 
-        self.log('accuracy', metrics['accuracy_top1'], prog_bar=True)
+        if self._should_compute_train_metrics():
+            # Only the top-1 accuracy is logged during training, which only requires a max over the logits
+            accuracy = metrics.topk_accuracy(logits, batch[1], top_k=(1,))
+            self.log('accuracy', accuracy['accuracy_top1'], prog_bar=True)
 
         return loss
 
     def validation_step(self, batch, *_):
-        loss, _ = self._compute_loss(batch)
+        loss, logits = self._compute_loss(batch)
+        self.val_accuracy.update(logits, batch[1])
 
         self.log('val/loss', loss)
-        self.log('val/accuracy_top1', self.accuracy_top1)
-        self.log('val/accuracy_top5', self.accuracy_top5)
+
+    def validation_epoch_end(self, outputs):
+        accuracy = self.val_accuracy.compute()
+        self.log_dict({f'val/{k}': v for k, v in accuracy.items()})
+        self.val_accuracy.reset()
 
     def configure_optimizers(self):
         base_lr = self.hparams.optim.learning_rate / 256 * self.hparams.batch_size
 
-        opt = torch.optim.SGD(
-            self.parameters(),
-            base_lr, momentum=0.9,
-            weight_decay=self.hparams.optim.weight_decay)
+        config = self.hparams.optim
+        opt = optim.create_optimizer(
+            config.optimizer, self.model, base_lr,
+            weight_decay=config.weight_decay,
+            momentum=config.momentum,
+            trust_coefficient=config.trust_coefficient,
+            max_trust_ratio=config.max_trust_ratio,
+            exclude_bias_and_norm=config.exclude_bias_and_norm)
+
+        schedule = resolution_schedule(self.hparams)
 
-        steps_per_epoch = (self.hparams.data.dataset_size + self.hparams.batch_size - 1) // self.hparams.batch_size
+        if schedule is not None:
+            # The number of steps per epoch changes with the batch size of each phase
+            total_steps = schedule.total_steps(self.hparams.data.dataset_size, self.hparams.max_epochs)
+        else:
+            steps_per_epoch = (self.hparams.data.dataset_size + self.hparams.batch_size - 1) // self.hparams.batch_size
+            total_steps = steps_per_epoch * self.hparams.max_epochs
 
         lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
             opt,
             max_lr=base_lr * 10,
-            epochs=self.hparams.max_epochs,
-            steps_per_epoch=steps_per_epoch)
+            total_steps=total_steps)
 
         scheduler_config = {
             'scheduler': lr_scheduler,
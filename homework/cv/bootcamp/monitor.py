@@ -0,0 +1,421 @@
+"""Monitoring of training performance.
+
+The `ThroughputMonitor` callback records how long each training step waits for data,
+and how long it spends computing (forward, backward and optimizer step). This makes it
+possible to determine whether training is limited by the input pipeline (data-starved)
+or by the computation itself.
+
+When the input pipeline is the bottleneck, `ProfiledDataset` may be used to break down
+the time spent in each stage of loading a sample (file I/O, decoding, transforms and collation)
+inside the dataloader workers. Timings are accumulated into a histogram in shared memory
+(see `StageTimings`), and reported from the main process by the `DataPipelineMonitor` callback.
+
+This is the canonical version of this module: homework/nlp keeps a trimmed copy (with token counting),
+as the two projects are installed independently. Changes to the shared parts should be made to both.
+
+"""
+
+import copy
+import io
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import PIL.Image
+import pytorch_lightning
+import torch
+import torch.utils.data
+from pytorch_lightning.utilities.rank_zero import rank_zero_info, rank_zero_warn
+
+
+def _batch_size(batch: Any) -> int:
+    """Finds the number of samples in a batch, from the first tensor in the batch."""
+    if isinstance(batch, torch.Tensor):
+        return batch.shape[0]
+
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+
+    if isinstance(batch, (list, tuple)):
+        for b in batch:
+            size = _batch_size(b)
+            if size > 0:
+                return size
+
+    return 0
+
+
+def _num_tokens(batch: Any) -> Optional[int]:
+    """Finds the number of (non-padding) tokens in a batch, for batches of tokenized text."""
+    if not isinstance(batch, dict):
+        return None
+
+    if 'attention_mask' in batch:
+        return int(batch['attention_mask'].sum())
+
+    if 'input_ids' in batch:
+        return batch['input_ids'].numel()
+
+    return None
+
+
+class ThroughputMonitor(pytorch_lightning.Callback):
+    """Records the time spent waiting for data and computing at every training step.
+
+    At every step, the following are recorded:
+    - data: time between the end of the previous step and the start of the current step.
+      This includes fetching the batch from the dataloader and transferring it to the device.
+    - forward, backward, optimizer: time spent in each phase of the step.
+    - throughput in samples per second (and in tokens per second for text batches).
+
+    At the end of each epoch, percentiles of these timings are logged and printed, and
+    a warning is issued if the fraction of time spent waiting for data exceeds `starved_threshold`.
+
+    Parameters
+    ----------
+    synchronize : bool
+        If `True`, synchronizes CUDA devices at phase boundaries, so that the timings reflect
+        the actual computation instead of the time to enqueue kernels. This has a small cost.
+        It has no effect on CPU.
+    starved_threshold : float
+        Fraction of the step time spent waiting for data above which the run is flagged as data-starved.
+    log_every_n_steps : int
+        Frequency at which per-step values are sent to the logger.
+    """
+
+    def __init__(self, synchronize: bool=True, starved_threshold: float=0.1, log_every_n_steps: int=50):
+        super().__init__()
+
+        self.synchronize = synchronize
+        self.starved_threshold = starved_threshold
+        self.log_every_n_steps = log_every_n_steps
+        self.epoch_summaries: List[Dict[str, float]] = []
+
+        self._reset()
+
+    def _reset(self):
+        self._timings = {k: [] for k in ('data', 'forward', 'backward', 'optimizer', 'step')}
+        self._num_samples = 0
+        self._num_tokens = 0
+        self._has_tokens = False
+        self._last_step_end = None
+        self._phase_start = None
+
+    def _now(self, pl_module: pytorch_lightning.LightningModule) -> float:
+        if self.synchronize and pl_module.device.type == 'cuda':
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._reset()
+        self._last_step_end = self._now(pl_module)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        now = self._now(pl_module)
+
+        self._timings['data'].append(now - self._last_step_end)
+        self._step_start = now
+        self._phase_start = now
+
+        # Values are filled in by the phase hooks, if the step reaches them.
+        self._forward_time = 0.0
+        self._backward_time = 0.0
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        now = self._now(pl_module)
+        self._forward_time = now - self._phase_start
+        self._phase_start = now
+
+    def on_after_backward(self, trainer, pl_module):
+        now = self._now(pl_module)
+        self._backward_time = now - self._phase_start
+        self._phase_start = now
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        now = self._now(pl_module)
+
+        data_time = self._timings['data'][-1]
+        step_time = now - self._step_start
+
+        self._timings['forward'].append(self._forward_time)
+        self._timings['backward'].append(self._backward_time)
+        self._timings['optimizer'].append(now - self._phase_start)
+        self._timings['step'].append(step_time)
+
+        num_samples = _batch_size(batch)
+        num_tokens = _num_tokens(batch)
+
+        self._num_samples += num_samples
+        if num_tokens is not None:
+            self._has_tokens = True
+            self._num_tokens += num_tokens
+
+        if batch_idx % self.log_every_n_steps == 0:
+            total_time = data_time + step_time
+            metrics = {
+                'perf/data_time': data_time,
+                'perf/step_time': step_time,
+                'perf/samples_per_sec': num_samples / total_time,
+            }
+            if num_tokens is not None:
+                metrics['perf/tokens_per_sec'] = num_tokens / total_time
+
+            pl_module.log_dict(metrics, on_step=True, on_epoch=False)
+
+        # Measure the next data wait from here, so that it excludes the time spent in this hook.
+        self._last_step_end = self._now(pl_module)
+
+    def summarize(self) -> Dict[str, float]:
+        """Summarizes the timings recorded since the start of the epoch."""
+        summary = {}
+
+        for name, values in self._timings.items():
+            if not values:
+                continue
+            for q in (50, 90, 99):
+                summary[f'{name}_time_p{q}'] = float(np.percentile(values, q))
+
+        total_data = float(np.sum(self._timings['data']))
+        total_time = total_data + float(np.sum(self._timings['step']))
+
+        if total_time > 0:
+            summary['data_fraction'] = total_data / total_time
+            summary['samples_per_sec'] = self._num_samples / total_time
+            if self._has_tokens:
+                summary['tokens_per_sec'] = self._num_tokens / total_time
+
+        return summary
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        summary = self.summarize()
+        if not summary:
+            return
+
+        self.epoch_summaries.append(summary)
+        pl_module.log_dict({f'perf/epoch_{k}': v for k, v in summary.items()})
+
+        message = (
+            f'Epoch {trainer.current_epoch}: {summary["samples_per_sec"]:.1f} samples / s, '
+            f'data wait p50 / p99: {summary["data_time_p50"] * 1e3:.1f} / {summary["data_time_p99"] * 1e3:.1f} ms, '
+            f'step p50 / p99: {summary["step_time_p50"] * 1e3:.1f} / {summary["step_time_p99"] * 1e3:.1f} ms, '
+            f'{summary["data_fraction"]:.1%} of time waiting for data.')
+        rank_zero_info(message)
+
+        if summary['data_fraction'] > self.starved_threshold:
+            rank_zero_warn(
+                f'Training is data-starved: {summary["data_fraction"]:.1%} of the time is spent waiting for data. '
+                'Consider increasing the number of dataloader workers or optimizing the input pipeline.')
+
+
+class StageTimings:
+    """Histogram of the time spent in each stage of the data pipeline, shared across processes.
+
+    The histogram is stored in a shared memory tensor, so that dataloader workers (which hold
+    a copy of this object) record into the same memory as the main process. Each worker
+    records into its own row, so that no synchronization is required.
+
+    To keep the overhead of timing negligible, only one in `sample_every` samples is timed.
+
+    Parameters
+    ----------
+    stages : Sequence[str]
+        Names of the stages to record.
+    max_workers : int
+        Maximum number of dataloader workers which will record timings.
+    sample_every : int
+        Only one in `sample_every` samples (or batches) is timed.
+    """
+    # Logarithmic bins from 1us to 10s
+    _MIN_TIME = 1e-6
+    _BINS_PER_DECADE = 8
+    _NUM_BINS = 7 * _BINS_PER_DECADE
+
+    def __init__(self, stages: Sequence[str], max_workers: int, sample_every: int=16):
+        self.stages = list(stages)
+        self.sample_every = sample_every
+        # Row 0 is used by the main process (when not using workers), row i + 1 by worker i.
+        self.counts = torch.zeros((max_workers + 1, len(self.stages), self._NUM_BINS), dtype=torch.int64).share_memory_()
+        self.totals = torch.zeros((max_workers + 1, len(self.stages)), dtype=torch.float64).share_memory_()
+        self.active = False
+        self._counter = 0
+
+    def sample(self) -> bool:
+        """Decides whether the current sample should be timed, and sets `active` accordingly."""
+        self._counter += 1
+        self.active = self._counter % self.sample_every == 0
+        return self.active
+
+    def record(self, stage: str, seconds: float):
+        worker_info = torch.utils.data.get_worker_info()
+        row = worker_info.id + 1 if worker_info is not None else 0
+        stage_idx = self.stages.index(stage)
+
+        bin_idx = int(math.log10(max(seconds, self._MIN_TIME) / self._MIN_TIME) * self._BINS_PER_DECADE)
+        self.counts[row, stage_idx, min(bin_idx, self._NUM_BINS - 1)] += 1
+        self.totals[row, stage_idx] += seconds
+
+    def reset(self):
+        self.counts.zero_()
+        self.totals.zero_()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Aggregates the timings recorded by all workers.
+
+        Percentiles are estimated from the histogram, and are thus accurate up to the bin width (~30%).
+        """
+        counts = self.counts.sum(dim=0).numpy()
+        totals = self.totals.sum(dim=0).numpy()
+        # Geometric center of each bin
+        centers = self._MIN_TIME * 10 ** ((np.arange(self._NUM_BINS) + 0.5) / self._BINS_PER_DECADE)
+
+        result = {}
+        for i, stage in enumerate(self.stages):
+            n = counts[i].sum()
+            if n == 0:
+                continue
+
+            cumulative = np.cumsum(counts[i])
+            result[stage] = {
+                'count': int(n),
+                'mean': float(totals[i] / n),
+                'p50': float(centers[np.searchsorted(cumulative, 0.5 * n)]),
+                'p99': float(centers[np.searchsorted(cumulative, 0.99 * n)]),
+            }
+
+        return result
+
+
+class _TimedCall:
+    """Wraps a callable to record its duration into the given stage, when timing is active."""
+
+    def __init__(self, fn: Callable, timings: StageTimings, stage: str):
+        self.fn = fn
+        self.timings = timings
+        self.stage = stage
+
+    def __call__(self, *args, **kwargs):
+        if not self.timings.active:
+            return self.fn(*args, **kwargs)
+
+        start = time.perf_counter()
+        result = self.fn(*args, **kwargs)
+        self.timings.record(self.stage, time.perf_counter() - start)
+        return result
+
+
+class _TimedImageLoader:
+    """Image loader which separately records the time spent reading the file and decoding it."""
+
+    def __init__(self, timings: StageTimings):
+        self.timings = timings
+
+    def __call__(self, path: str) -> PIL.Image.Image:
+        if not self.timings.active:
+            with PIL.Image.open(path) as img:
+                return img.convert('RGB')
+
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            data = f.read()
+        read_end = time.perf_counter()
+
+        with PIL.Image.open(io.BytesIO(data)) as img:
+            img = img.convert('RGB')
+
+        self.timings.record('io', read_end - start)
+        self.timings.record('decode', time.perf_counter() - read_end)
+        return img
+
+
+class ProfiledDataset(torch.utils.data.Dataset):
+    """Wraps a map-style dataset to record the time spent in each stage of loading a sample.
+
+    The total time spent in `__getitem__` is always recorded (stage `getitem`). In addition,
+    if the dataset has a `transform` attribute, the time spent in the transform is recorded
+    (stage `transform`), and if it has a `loader` attribute (as torchvision image datasets do),
+    it is replaced by a loader which records file reads (stage `io`) and decoding (stage `decode`).
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset, timings: StageTimings):
+        super().__init__()
+
+        # Shallow copy, so that the instrumentation does not modify the original dataset
+        dataset = copy.copy(dataset)
+
+        if getattr(dataset, 'transform', None) is not None:
+            dataset.transform = _TimedCall(dataset.transform, timings, 'transform')
+
+        if getattr(dataset, 'loader', None) is not None:
+            dataset.loader = _TimedImageLoader(timings)
+
+        self.dataset = dataset
+        self.timings = timings
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if not self.timings.sample():
+            return self.dataset[idx]
+
+        start = time.perf_counter()
+        result = self.dataset[idx]
+        self.timings.record('getitem', time.perf_counter() - start)
+        self.timings.active = False
+        return result
+
+
+class ProfiledCollate:
+    """Wraps a collate function to record the time spent collating batches (stage `collate`)."""
+
+    def __init__(self, collate_fn: Optional[Callable], timings: StageTimings):
+        self.collate_fn = collate_fn if collate_fn is not None else torch.utils.data.default_collate
+        self.timings = timings
+        self._counter = 0
+
+    def __call__(self, batch):
+        self._counter += 1
+        if self._counter % self.timings.sample_every != 0:
+            return self.collate_fn(batch)
+
+        start = time.perf_counter()
+        result = self.collate_fn(batch)
+        self.timings.record('collate', time.perf_counter() - start)
+        return result
+
+
+class DataPipelineMonitor(pytorch_lightning.Callback):
+    """Reports the stage timings recorded by the dataloader workers at the end of each training epoch.
+
+    Parameters
+    ----------
+    timings : StageTimings
+        The timings into which the (profiled) training dataset records.
+    """
+
+    def __init__(self, timings: StageTimings):
+        super().__init__()
+        self.timings = timings
+        self.epoch_summaries: List[Dict[str, Dict[str, float]]] = []
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.timings.reset()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        summary = self.timings.summary()
+        if not summary:
+            return
+
+        self.epoch_summaries.append(summary)
+
+        pl_module.log_dict({
+            f'data/{stage}_{k}': v
+            for stage, values in summary.items()
+            for k, v in values.items() if k != 'count'
+        })
+
+        message = ', '.join(
+            f'{stage} {values["mean"] * 1e3:.2f} ms (p99 {values["p99"] * 1e3:.2f} ms)'
+            for stage, values in summary.items())
+        rank_zero_info(f'Epoch {trainer.current_epoch} data pipeline: {message}.')
@@ -0,0 +1,358 @@
+"""Batch inference with trained places365 models.
+
+This module loads the MobileNetV3 from a `PlacesModel` checkpoint, optionally exports it
+to TorchScript or ONNX, and computes the top-5 predictions for a directory of images or
+a shard created by `bootcamp.shards`. The predictions are written as json lines.
+
+Images are decoded, resized and center-cropped by a pool of threads (decoding images with PIL
+releases the GIL), and assembled into batches dynamically: a batch is run as soon as it is
+full, or when the first image in the batch has waited for `max_wait_ms`. The model is run
+in channels-last layout under `torch.inference_mode`.
+
+"""
+
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import hydra
+import numpy as np
+import PIL.Image
+import torch
+
+from . import augment, cache, shards
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def load_model(checkpoint: str) -> torch.nn.Module:
+    """Loads the network of the `PlacesModel` saved in the given Lightning checkpoint, for inference on CPU."""
+    from .model import PlacesModel
+
+    network = PlacesModel.load_from_checkpoint(checkpoint, map_location='cpu').model
+    network.eval()
+    return network.to(memory_format=torch.channels_last)
+
+
+def export_model(network: torch.nn.Module, path: str, format: str='torchscript', crop_size: int=224) -> torch.nn.Module:
+    """Exports the given model to TorchScript or ONNX.
+
+    The exported model takes normalized float32 images of shape `[N, 3, crop_size, crop_size]`,
+    with a dynamic batch size, and returns the logits.
+
+    Returns
+    -------
+    torch.nn.Module
+        The frozen TorchScript module if exporting to TorchScript, otherwise the given network.
+    """
+    example = torch.zeros(1, 3, crop_size, crop_size).contiguous(memory_format=torch.channels_last)
+
+    if format == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(network, example))
+        traced.save(path)
+        return traced
+    elif format == 'onnx':
+        with torch.no_grad():
+            torch.onnx.export(
+                network, example, path,
+                input_names=['images'], output_names=['logits'],
+                dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}})
+        return network
+    else:
+        raise ValueError(f'Unknown export format {format}')
+
+
+def _center_crop(img: np.ndarray, crop_size: int) -> torch.Tensor:
+    height, width = img.shape[:2]
+    top = (height - crop_size) // 2
+    left = (width - crop_size) // 2
+    img = img[top:top + crop_size, left:left + crop_size]
+    return torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+
+
+def decode_file(path: str, image_size: int=256, crop_size: int=224) -> torch.Tensor:
+    """Decodes the given image as the evaluation transform, returning a uint8 tensor in CHW layout."""
+    return _center_crop(cache.load_image(path, image_size), crop_size)
+
+
+def decode_bytes(data: bytes, image_size: int=256, crop_size: int=224) -> torch.Tensor:
+    """As `decode_file`, for an encoded image in memory."""
+    img = shards.decode_image(data)
+    if img.size != (image_size, image_size):
+        img = img.resize((image_size, image_size), PIL.Image.BILINEAR)
+    return _center_crop(np.asarray(img), crop_size)
+
+
+def image_files(directory: str) -> List[str]:
+    """Lists the image files under the given directory, recursively and in sorted order."""
+    files = []
+
+    for dirpath, _, filenames in os.walk(directory):
+        files.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+
+    return sorted(files)
+
+
+def iter_inputs(path: str) -> Tuple[Iterator[Tuple[str, Any]], Callable[[Any], torch.Tensor]]:
+    """Lists the images at the given path, which is either a directory of images or a shard.
+
+    Returns
+    -------
+    Iterator[Tuple[str, Any]]
+        An iterator over the name of each image and its source (path or encoded image).
+    Callable[[Any], torch.Tensor]
+        Function decoding an image from its source.
+    """
+    if os.path.isdir(path):
+        return ((f, f) for f in image_files(path)), decode_file
+
+    name = os.path.basename(path)
+    records = ((f'{name}:{i}', data) for i, (data, _) in enumerate(shards.read_shard(path)))
+    return records, decode_bytes
+
+
+def decode_in_threads(items: Iterable[Tuple[str, Any]], decode: Callable[[Any], torch.Tensor],
+                      num_threads: int=4, max_pending: Optional[int]=None) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Decodes the given items in a thread pool, yielding the results in order.
+
+    At most `max_pending` items (by default four per thread) are decoded ahead of the consumer.
+    """
+    if max_pending is None:
+        max_pending = 4 * num_threads
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        pending = collections.deque()
+
+        for name, source in items:
+            pending.append((name, executor.submit(decode, source)))
+
+            if len(pending) >= max_pending:
+                name, future = pending.popleft()
+                yield name, future.result()
+
+        while pending:
+            name, future = pending.popleft()
+            yield name, future.result()
+
+
+_END = object()
+
+
+def dynamic_batches(items: Iterable[Tuple[str, torch.Tensor]], max_batch_size: int,
+                    max_wait: float) -> Iterator[Tuple[List[str], List[torch.Tensor], List[float]]]:
+    """Groups the given items into batches as they become available.
+
+    The items are consumed by a background thread, and a batch is emitted as soon as it contains
+    `max_batch_size` items, or when its first item has waited for `max_wait` seconds.
+
+    Yields
+    ------
+    Tuple[List[str], List[torch.Tensor], List[float]]
+        The names and images of the batch, and the time at which each image became available.
+    """
+    available = queue.Queue(maxsize=4 * max_batch_size)
+    errors = []
+
+    def produce():
+        try:
+            for name, image in items:
+                available.put((name, image, time.perf_counter()))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            available.put(_END)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    done = False
+
+    while not done:
+        item = available.get()
+        if item is _END:
+            break
+
+        batch = [item]
+        deadline = item[2] + max_wait
+
+        while len(batch) < max_batch_size:
+            timeout = deadline - time.perf_counter()
+
+            try:
+                item = available.get(timeout=timeout) if timeout > 0 else available.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is _END:
+                done = True
+                break
+
+            batch.append(item)
+
+        names, images, arrivals = zip(*batch)
+        yield list(names), list(images), list(arrivals)
+
+    producer.join()
+
+    if errors:
+        raise errors[0]
+
+
+class Predictor:
+    """Computes top-k predictions of the given model on batches of uint8 images.
+
+    Parameters
+    ----------
+    network : torch.nn.Module
+        The network, taking normalized float32 images. It is run in channels-last layout.
+    top_k : int
+        Number of predictions to return for each image.
+    """
+
+    def __init__(self, network: torch.nn.Module, top_k: int=5):
+        self.network = network
+        self.top_k = top_k
+        # Fold the conversion from [0, 255] to [0, 1] into the normalization, as in `augment.BatchAugmentation`
+        self.mean = torch.tensor(augment.IMAGENET_MEAN).mul_(255).view(1, -1, 1, 1)
+        self.std = torch.tensor(augment.IMAGENET_STD).mul_(255).view(1, -1, 1, 1)
+
+    def __call__(self, images: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the top-k probabilities and classes for the given images."""
+        with torch.inference_mode():
+            batch = torch.stack(images).contiguous(memory_format=torch.channels_last)
+            batch = batch.float().sub_(self.mean).div_(self.std)
+            probs = self.network(batch).softmax(dim=-1)
+            return probs.topk(self.top_k, dim=-1)
+
+
+def predict(predictor: Predictor, batches: Iterable[Tuple[List[str], List[torch.Tensor], List[float]]],
+            output=None) -> Dict[str, float]:
+    """Runs the predictor over the given batches, and reports throughput and latency.
+
+    Parameters
+    ----------
+    predictor : Predictor
+        The predictor to run.
+    batches : Iterable[Tuple[List[str], List[torch.Tensor], List[float]]]
+        Batches, as produced by `dynamic_batches`.
+    output : file-like, optional
+        If not `None`, the predictions are written to this file as json lines.
+
+    Returns
+    -------
+    Dict[str, float]
+        The number of images processed, the throughput in images per second, and percentiles
+        of the latency of each image (from the time it was decoded until its prediction is
+        available) and of the model on each batch, in milliseconds.
+    """
+    latencies = []
+    batch_latencies = []
+    num_images = 0
+    start = time.perf_counter()
+
+    for names, images, arrivals in batches:
+        batch_start = time.perf_counter()
+        scores, classes = predictor(images)
+        end = time.perf_counter()
+
+        batch_latencies.append(end - batch_start)
+        latencies.extend(end - a for a in arrivals)
+        num_images += len(names)
+
+        if output is not None:
+            for name, s, c in zip(names, scores.tolist(), classes.tolist()):
+                output.write(json.dumps({'image': name, 'classes': c, 'scores': s}) + '\n')
+
+    elapsed = time.perf_counter() - start
+
+    if not latencies:
+        return {'images': 0}
+
+    latencies = np.array(latencies) * 1000
+    batch_latencies = np.array(batch_latencies) * 1000
+
+    return {
+        'images': num_images,
+        'images_per_sec': num_images / elapsed,
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'batch_latency_p50_ms': float(np.percentile(batch_latencies, 50)),
+        'batch_latency_p99_ms': float(np.percentile(batch_latencies, 99)),
+    }
+
+
+@dataclasses.dataclass
+class PredictConfig:
+    """Configuration for batch inference.
+
+    Attributes
+    ----------
+    checkpoint : str
+        Path to the Lightning checkpoint of the `PlacesModel` to use.
+    input : str
+        Directory of images (searched recursively), or path to a single shard.
+    output : str
+        Path of the json lines file in which to write the predictions.
+    export : str, optional
+        If not `None`, format (`torchscript` or `onnx`) to which to export the model.
+        When exporting to TorchScript, the exported model is used for inference.
+    export_path : str, optional
+        Path of the exported model, by default next to the checkpoint.
+    max_batch_size : int
+        Maximum number of images in a batch.
+    max_wait_ms : float
+        Maximum time an image waits for its batch to fill up.
+    decode_threads : int
+        Number of threads decoding images.
+    num_threads : int, optional
+        Number of threads used by torch for inference, by default the torch default.
+    """
+    checkpoint: str = '???'
+    input: str = '???'
+    output: str = 'predictions.jsonl'
+    export: Optional[str] = None
+    export_path: Optional[str] = None
+    max_batch_size: int = 64
+    max_wait_ms: float = 10.0
+    decode_threads: int = 4
+    num_threads: Optional[int] = None
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: PredictConfig):
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    checkpoint = hydra.utils.to_absolute_path(config.checkpoint)
+    network = load_model(checkpoint)
+
+    if config.export is not None:
+        extension = {'torchscript': '.pt', 'onnx': '.onnx'}.get(config.export, '')
+        export_path = config.export_path or os.path.splitext(checkpoint)[0] + extension
+        network = export_model(network, hydra.utils.to_absolute_path(export_path), config.export)
+        print(f'Exported model to {export_path}')
+
+    items, decode = iter_inputs(hydra.utils.to_absolute_path(config.input))
+    batches = dynamic_batches(
+        decode_in_threads(items, decode, config.decode_threads),
+        config.max_batch_size, config.max_wait_ms / 1000)
+
+    with open(hydra.utils.to_absolute_path(config.output), 'w') as output:
+        report = predict(Predictor(network), batches, output)
+
+    print(', '.join(f'{k}: {v:.1f}' for k, v in report.items()))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=PredictConfig)
+    main()
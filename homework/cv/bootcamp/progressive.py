@@ -0,0 +1,206 @@
+"""Progressive resizing of the training images.
+
+Training on smaller crops in the early epochs is several times cheaper, and has little
+impact on the final accuracy as long as the last epochs are trained at full resolution.
+As smaller images use less memory, the batch size may be scaled up accordingly in these phases.
+
+A `ResolutionSchedule` describes the crop size and batch size of each phase of training.
+The current values are held by a `ResolutionState` in shared memory, so that they may
+be changed at the start of each epoch (by `PlacesDataModule.train_dataloader`) without
+rebuilding the dataloader or its workers:
+
+- the batch size is read by the `ScheduledBatchSampler` in the main process,
+- the crop size is read by the `ScheduledRandomCrop` transform or the `scheduled_collate`
+  function in the dataloader workers, or set on the batch augmentation of the model
+  (by the `ProgressiveResizing` callback) when augmenting on the device.
+
+The trainer only reads the number of batches of an epoch when the training dataloader is requested,
+so it must be requested again at the start of each epoch (`reload_dataloaders_every_n_epochs=1`).
+The datamodule then returns the same dataloader, whose length follows the current batch size.
+When training with several processes, the samples are sharded by a `DistributedSampler` within the
+`ScheduledBatchSampler`, and the trainer must not replace the sampler (`replace_sampler_ddp=False`),
+as it would then re-create the dataloader and its workers on every reload.
+
+"""
+
+from typing import List, NamedTuple, Optional, Sequence
+
+import pytorch_lightning
+import torch
+import torch.utils.data
+import torchvision.transforms
+import torchvision.transforms.functional
+
+from . import augment
+
+
+class ResolutionPhase(NamedTuple):
+    crop_size: int
+    batch_size: int
+    epochs: Optional[int]
+
+
+class ResolutionSchedule:
+    """Schedule of crop sizes and batch sizes over the epochs of training.
+
+    Parameters
+    ----------
+    phases : List[ResolutionPhase]
+        The phases of training, in order. The last phase runs until the end of training,
+        and its number of epochs is ignored.
+    """
+
+    def __init__(self, phases: List[ResolutionPhase]):
+        if not phases:
+            raise ValueError('The schedule must contain at least one phase')
+
+        self.phases = list(phases)
+
+    @classmethod
+    def from_crop_sizes(cls, crop_sizes: Sequence[int], epochs: Sequence[int], batch_size: int,
+                        base_crop_size: int=224, scale_batch_size: bool=True) -> 'ResolutionSchedule':
+        """Creates a schedule from the crop size and number of epochs of each phase.
+
+        Parameters
+        ----------
+        crop_sizes : Sequence[int]
+            The crop size of each phase.
+        epochs : Sequence[int]
+            The number of epochs of each phase but the last, which runs until the end of training.
+        batch_size : int
+            The batch size at the base crop size.
+        base_crop_size : int
+            The crop size for which `batch_size` is given.
+        scale_batch_size : bool
+            If `True`, the batch size of each phase is scaled inversely to the number of pixels
+            in the crop (rounded down to a multiple of 8), so that memory usage remains roughly constant.
+        """
+        if len(epochs) != len(crop_sizes) - 1:
+            raise ValueError('The number of epochs must be given for each phase but the last')
+
+        phases = []
+
+        for i, crop_size in enumerate(crop_sizes):
+            phase_batch_size = batch_size
+
+            if scale_batch_size and crop_size < base_crop_size:
+                phase_batch_size = max(int(batch_size * (base_crop_size / crop_size) ** 2) // 8 * 8, batch_size)
+
+            phases.append(ResolutionPhase(crop_size, phase_batch_size, epochs[i] if i < len(epochs) else None))
+
+        return cls(phases)
+
+    def phase(self, epoch: int) -> ResolutionPhase:
+        """Returns the phase of training for the given epoch."""
+        for phase in self.phases[:-1]:
+            if epoch < phase.epochs:
+                return phase
+            epoch -= phase.epochs
+
+        return self.phases[-1]
+
+    def total_steps(self, num_samples: int, max_epochs: int) -> int:
+        """Total number of optimization steps for the given number of samples per epoch."""
+        return sum(
+            (num_samples + batch_size - 1) // batch_size
+            for batch_size in (self.phase(epoch).batch_size for epoch in range(max_epochs)))
+
+
+class ResolutionState:
+    """Current crop size and batch size of training, in shared memory.
+
+    This object must be created before the dataloader workers are started, in order to be shared with them.
+    """
+
+    def __init__(self, crop_size: int, batch_size: int):
+        self._values = torch.tensor([crop_size, batch_size], dtype=torch.int64).share_memory_()
+
+    @property
+    def crop_size(self) -> int:
+        return int(self._values[0])
+
+    @crop_size.setter
+    def crop_size(self, value: int):
+        self._values[0] = value
+
+    @property
+    def batch_size(self) -> int:
+        return int(self._values[1])
+
+    @batch_size.setter
+    def batch_size(self, value: int):
+        self._values[1] = value
+
+    def set_phase(self, phase: ResolutionPhase, world_size: int=1):
+        """Sets the crop size and batch size of the given phase, splitting the batch size between devices."""
+        self.crop_size = phase.crop_size
+        self.batch_size = phase.batch_size // world_size
+
+
+class ScheduledRandomCrop(torch.nn.Module):
+    """Random crop transform, with the crop size read from the given state."""
+
+    def __init__(self, state: ResolutionState):
+        super().__init__()
+        self.state = state
+
+    def forward(self, img):
+        size = self.state.crop_size
+        top, left, height, width = torchvision.transforms.RandomCrop.get_params(img, (size, size))
+        return torchvision.transforms.functional.crop(img, top, left, height, width)
+
+
+def scheduled_collate(batch, augmentation: augment.BatchAugmentation, state: ResolutionState):
+    """As `augment.collate_and_augment`, with the crop size read from the given state."""
+    augmentation.crop_size = state.crop_size
+    return augment.collate_and_augment(batch, augmentation)
+
+
+class ScheduledBatchSampler(torch.utils.data.BatchSampler):
+    """Batch sampler with the batch size read from the given state.
+
+    The batch size is read when starting to iterate over the sampler, so that it may be
+    changed between epochs without re-creating the dataloader.
+    """
+
+    def __init__(self, sampler, state: ResolutionState, drop_last: bool=False):
+        super().__init__(sampler, state.batch_size, drop_last)
+        self.state = state
+
+    def __iter__(self):
+        self.batch_size = self.state.batch_size
+        return super().__iter__()
+
+    def __len__(self):
+        self.batch_size = self.state.batch_size
+        return super().__len__()
+
+    def set_epoch(self, epoch: int):
+        # Forward to the underlying (distributed) sampler
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+class ProgressiveResizing(pytorch_lightning.Callback):
+    """Sets the crop size of the batch augmentation of the model at the start of each epoch, and logs the current phase.
+
+    The crop size and batch size of the dataloader are set by the datamodule (see `PlacesDataModule.train_dataloader`).
+
+    Parameters
+    ----------
+    schedule : ResolutionSchedule
+        The schedule of training, with batch sizes given across all devices.
+    """
+
+    def __init__(self, schedule: ResolutionSchedule):
+        super().__init__()
+        self.schedule = schedule
+
+    def on_train_epoch_start(self, trainer: pytorch_lightning.Trainer, pl_module: pytorch_lightning.LightningModule):
+        phase = self.schedule.phase(trainer.current_epoch)
+
+        batch_augmentation = getattr(pl_module, 'batch_augmentation', None)
+        if batch_augmentation is not None:
+            batch_augmentation.crop_size = phase.crop_size
+
+        pl_module.log_dict({'crop_size': float(phase.crop_size), 'batch_size': float(phase.batch_size)})
@@ -0,0 +1,253 @@
+"""Int8 quantization of trained places365 models for CPU inference.
+
+MobileNetV3 quantizes well: this module converts the network of a `PlacesModel` checkpoint
+to int8 through FX graph mode quantization. The quantization parameters of the activations
+are calibrated on a few batches of the validation split (static post-training quantization).
+Optionally, the network may instead be fine-tuned on the training split with fake quantization
+(quantization-aware training) before being converted.
+
+The quantized network is evaluated on the remaining batches of the validation split, and
+compared to the original network in terms of accuracy, latency and size.
+
+"""
+
+import copy
+import dataclasses
+import io
+import itertools
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import hydra
+import numpy as np
+import torch
+import torch.ao.nn.intrinsic.qat
+import torch.ao.quantization
+import torch.ao.quantization.quantize_fx
+
+from . import augment, metrics
+
+
+def _prepare_batch(batch, augmentation: augment.BatchAugmentation) -> Tuple[torch.Tensor, torch.Tensor]:
+    # As `PlacesModel.on_after_batch_transfer`, uint8 batches are augmented here
+    img, label = batch
+    if img.dtype == torch.uint8:
+        img = augmentation(img)
+    return img, label
+
+
+def _example_inputs(crop_size: int=224) -> Tuple[torch.Tensor]:
+    return (torch.zeros(1, 3, crop_size, crop_size),)
+
+
+def quantize_static(network: torch.nn.Module, calibration_batches: Iterable, backend: str='x86') -> torch.nn.Module:
+    """Quantizes the given network to int8, calibrating activations on the given batches.
+
+    Parameters
+    ----------
+    network : torch.nn.Module
+        The floating point network to quantize. It is not modified.
+    calibration_batches : Iterable
+        Batches of (images, labels), as produced by the validation dataloader of `PlacesDataModule`.
+    backend : str
+        The quantized engine for which to quantize the network (`x86`, `fbgemm` or `qnnpack`).
+    """
+    network = copy.deepcopy(network).eval()
+    augmentation = augment.BatchAugmentation(224).eval()
+
+    prepared = torch.ao.quantization.quantize_fx.prepare_fx(
+        network, torch.ao.quantization.get_default_qconfig_mapping(backend), _example_inputs())
+
+    with torch.inference_mode():
+        for batch in calibration_batches:
+            img, _ = _prepare_batch(batch, augmentation)
+            prepared(img)
+
+    return torch.ao.quantization.quantize_fx.convert_fx(prepared)
+
+
+def quantize_aware_training(network: torch.nn.Module, train_batches: Iterable, learning_rate: float=1e-4,
+                            backend: str='x86', freeze_bn_after: Optional[int]=None) -> torch.nn.Module:
+    """Fine-tunes the given network with fake quantization, and converts it to int8.
+
+    Parameters
+    ----------
+    network : torch.nn.Module
+        The floating point network to quantize. It is not modified.
+    train_batches : Iterable
+        Batches of (images, labels) to fine-tune on, as produced by the training dataloader of `PlacesDataModule`.
+    learning_rate : float
+        Learning rate of the fine-tuning (SGD with momentum).
+    backend : str
+        The quantized engine for which to quantize the network.
+    freeze_bn_after : int, optional
+        If not `None`, the batch norm statistics are frozen after the given number of steps.
+    """
+    network = copy.deepcopy(network).train()
+    augmentation = augment.BatchAugmentation(224).train()
+
+    prepared = torch.ao.quantization.quantize_fx.prepare_qat_fx(
+        network, torch.ao.quantization.get_default_qat_qconfig_mapping(backend), _example_inputs())
+
+    optimizer = torch.optim.SGD(prepared.parameters(), lr=learning_rate, momentum=0.9)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    for step, batch in enumerate(train_batches):
+        if freeze_bn_after is not None and step == freeze_bn_after:
+            prepared.apply(torch.ao.nn.intrinsic.qat.freeze_bn_stats)
+
+        img, label = _prepare_batch(batch, augmentation)
+        loss = criterion(prepared(img), label)
+
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+    prepared.eval()
+    return torch.ao.quantization.quantize_fx.convert_fx(prepared)
+
+
+def evaluate(network: torch.nn.Module, batches: Iterable) -> Dict[str, float]:
+    """Computes the top-1 and top-5 accuracy of the given network on the given batches."""
+    network.eval()
+    augmentation = augment.BatchAugmentation(224).eval()
+    accuracy = metrics.TopKAccuracy(top_k=(1, 5))
+
+    with torch.inference_mode():
+        for batch in batches:
+            img, label = _prepare_batch(batch, augmentation)
+            accuracy.update(network(img), label)
+
+    return {k: float(v) for k, v in accuracy.compute().items()}
+
+
+def measure_latency(network: torch.nn.Module, batch_size: int=1, iterations: int=50, warmup: int=5) -> Dict[str, float]:
+    """Measures the latency of the given network on random inputs, in milliseconds."""
+    network.eval()
+    img = torch.randn(batch_size, 3, 224, 224)
+    latencies = []
+
+    with torch.inference_mode():
+        for i in range(warmup + iterations):
+            start = time.perf_counter()
+            network(img)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    return {'latency_p50_ms': float(np.percentile(latencies, 50)), 'latency_p99_ms': float(np.percentile(latencies, 99))}
+
+
+def model_size_mb(network: torch.nn.Module) -> float:
+    """Size of the serialized parameters of the given network, in megabytes."""
+    buffer = io.BytesIO()
+    torch.save(network.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def compare(networks: Dict[str, torch.nn.Module], eval_batches: Iterable, batch_sizes: Iterable[int]=(1, 32)) -> Dict[str, Dict[str, float]]:
+    """Reports the accuracy, latency (for each batch size) and size of each of the given networks."""
+    eval_batches = list(eval_batches)
+    report = {}
+
+    for name, network in networks.items():
+        result = evaluate(network, eval_batches)
+        result['size_mb'] = model_size_mb(network)
+
+        for batch_size in batch_sizes:
+            latency = measure_latency(network, batch_size)
+            result.update({f'bs{batch_size}_{k}': v for k, v in latency.items()})
+
+        report[name] = result
+
+    return report
+
+
+@dataclasses.dataclass
+class QuantizeConfig:
+    """Configuration for quantizing a trained model.
+
+    Attributes
+    ----------
+    checkpoint : str
+        Path to the Lightning checkpoint of the `PlacesModel` to quantize.
+    output : str
+        Path at which to save the quantized network (as TorchScript).
+    root : str
+        Root directory of the places365 dataset.
+    data_format : str
+        Format of the dataset, see `PlacesDataModule`.
+    cache_root : str, optional
+        Directory of the decoded image cache, see `PlacesDataModule`.
+    num_workers : int
+        Number of dataloader workers.
+    batch_size : int
+        Batch size used for calibration, fine-tuning and evaluation.
+    calibration_batches : int
+        Number of validation batches used for calibration. Evaluation is performed on the remaining batches.
+    eval_batches : int, optional
+        If not `None`, number of validation batches used for evaluation.
+    qat_steps : int
+        If positive, number of steps of quantization-aware training, instead of post-training quantization.
+    qat_learning_rate : float
+        Learning rate of quantization-aware training.
+    backend : str
+        The quantized engine to target.
+    """
+    checkpoint: str = '???'
+    output: str = 'model_int8.pt'
+    root: str = '/places365'
+    data_format: str = 'folder'
+    cache_root: Optional[str] = None
+    num_workers: int = 4
+    batch_size: int = 64
+    calibration_batches: int = 32
+    eval_batches: Optional[int] = None
+    qat_steps: int = 0
+    qat_learning_rate: float = 1e-4
+    backend: str = 'x86'
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: QuantizeConfig):
+    from . import dataset, predict
+
+    torch.backends.quantized.engine = config.backend
+
+    network = predict.load_model(hydra.utils.to_absolute_path(config.checkpoint))
+    network = network.to(memory_format=torch.contiguous_format)
+
+    dm = dataset.PlacesDataModule(
+        config.batch_size, config.root, config.num_workers,
+        data_format=config.data_format,
+        cache_root=config.cache_root,
+        augment_on='device')
+    dm.setup()
+
+    val_batches = iter(dm.val_dataloader())
+    calibration = list(itertools.islice(val_batches, config.calibration_batches))
+
+    if config.qat_steps > 0:
+        train_batches = itertools.islice(dm.train_dataloader(), config.qat_steps)
+        quantized = quantize_aware_training(
+            network, train_batches, config.qat_learning_rate, config.backend,
+            freeze_bn_after=config.qat_steps // 2)
+    else:
+        quantized = quantize_static(network, calibration, config.backend)
+
+    with torch.inference_mode():
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, _example_inputs()))
+    torch.jit.save(scripted, hydra.utils.to_absolute_path(config.output))
+
+    eval_batches = itertools.islice(val_batches, config.eval_batches)
+    report = compare({'fp32': network, 'int8': quantized}, eval_batches)
+
+    for name, result in report.items():
+        print(f'{name}: ' + ', '.join(f'{k}: {v:.3f}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=QuantizeConfig)
+    main()
@@ -0,0 +1,379 @@
+"""Packed shard format for the places365 dataset.
+
+The places365 dataset is distributed as a large number of small jpeg files, which
+are slow to access on networked file systems. This module provides a one-time converter
+which packs the raw (still encoded) images of a split into a small number of large shard files,
+and a streaming `IterableDataset` which reads these shards sequentially.
+
+Each shard is a flat binary file made of consecutive records. Each record is composed
+of a header (label and length of the payload, both as little-endian uint32), followed by the
+bytes of the encoded image. Next to each shard, we store the offsets of each record
+as a numpy array, and a json manifest describes all the shards of a given split.
+
+"""
+
+import dataclasses
+import io
+import json
+import multiprocessing
+import os
+import random
+import struct
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import hydra
+import numpy as np
+import PIL.Image
+import pytorch_lightning
+import torch
+import torch.distributed
+import torch.utils.data
+
+
+_RECORD_HEADER = struct.Struct('<II')
+_READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def _shard_name(split: str, index: int) -> str:
+    return f'{split}-{index:05d}.bin'
+
+
+def manifest_path(shards_root: str, split: str) -> str:
+    """Path to the manifest describing the shards for the given split."""
+    return os.path.join(shards_root, f'{split}.json')
+
+
+def load_manifest(shards_root: str, split: str) -> Dict[str, Any]:
+    with open(manifest_path(shards_root, split), 'r') as f:
+        return json.load(f)
+
+
+def _write_shard(path: str, items: Sequence[Tuple[str, int]]) -> int:
+    """Writes the given (file, label) items into a single shard at the given path.
+
+    The shard is first written to a temporary file and then moved in place,
+    so that an interrupted conversion never leaves a truncated shard behind.
+    """
+    offsets = np.zeros(len(items), dtype=np.int64)
+
+    with open(path + '.tmp', 'wb', buffering=_READ_BUFFER_SIZE) as f:
+        position = 0
+        for i, (file, label) in enumerate(items):
+            with open(file, 'rb') as img_f:
+                data = img_f.read()
+
+            offsets[i] = position
+            f.write(_RECORD_HEADER.pack(label, len(data)))
+            f.write(data)
+            position += _RECORD_HEADER.size + len(data)
+
+    np.save(path + '.idx.npy', offsets)
+    os.replace(path + '.tmp', path)
+    return len(items)
+
+
+def _write_shard_star(args):
+    return _write_shard(*args)
+
+
+def write_shards(items: Sequence[Tuple[str, int]], shards_root: str, split: str, num_shards: int,
+                 num_workers: int=1, seed: int=0) -> Dict[str, Any]:
+    """Packs the given list of (file, label) items into shards.
+
+    The items are shuffled once before being distributed over the shards,
+    so that each shard contains a mix of all classes. This is required
+    for the shuffle buffer of `ShardedPlacesDataset` to produce well-mixed batches.
+
+    Parameters
+    ----------
+    items : Sequence[Tuple[str, int]]
+        List of paths to encoded images and their corresponding labels.
+    shards_root : str
+        Directory in which to write the shards.
+    split : str
+        Name of the split, used to name the shards and the manifest.
+    num_shards : int
+        Number of shards to create. Shards are of equal size up to one record.
+    num_workers : int
+        Number of processes to use to write shards in parallel.
+    seed : int
+        Seed used to shuffle the items before sharding.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The manifest describing the written shards.
+    """
+    os.makedirs(shards_root, exist_ok=True)
+
+    items = list(items)
+    random.Random(seed).shuffle(items)
+    num_shards = max(min(num_shards, len(items)), 1)
+
+    chunks = np.array_split(np.arange(len(items)), num_shards)
+    tasks = [
+        (os.path.join(shards_root, _shard_name(split, i)), [items[j] for j in chunk])
+        for i, chunk in enumerate(chunks)]
+
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            counts = pool.map(_write_shard_star, tasks, chunksize=1)
+    else:
+        counts = [_write_shard(*t) for t in tasks]
+
+    manifest = {
+        'split': split,
+        'num_records': sum(counts),
+        'shards': [
+            {'file': os.path.basename(path), 'num_records': count}
+            for (path, _), count in zip(tasks, counts)
+        ]
+    }
+
+    with open(manifest_path(shards_root, split) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path(shards_root, split) + '.tmp', manifest_path(shards_root, split))
+
+    return manifest
+
+
+def read_shard(path: str, start: int=0, stop: Optional[int]=None) -> Iterator[Tuple[bytes, int]]:
+    """Sequentially reads records from the shard at the given path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the shard file.
+    start : int
+        Index of the first record to read. Seeking uses the offsets stored alongside the shard.
+    stop : int, optional
+        If not `None`, index of the record at which to stop reading.
+
+    Yields
+    ------
+    Tuple[bytes, int]
+        The encoded image and its label.
+    """
+    with open(path, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        if start > 0:
+            offsets = np.load(path + '.idx.npy', mmap_mode='r')
+            if start >= len(offsets):
+                return
+            f.seek(int(offsets[start]))
+
+        index = start
+        while stop is None or index < stop:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+
+            label, length = _RECORD_HEADER.unpack(header)
+            yield f.read(length), label
+            index += 1
+
+
+def decode_image(data: bytes) -> PIL.Image.Image:
+    with PIL.Image.open(io.BytesIO(data)) as img:
+        return img.convert('RGB')
+
+
+def _distributed_info() -> Tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class ShardedPlacesDataset(torch.utils.data.IterableDataset):
+    """Streaming dataset reading the shards created by `write_shards`.
+
+    The shards are concatenated (in an order which is reshuffled every epoch when shuffling),
+    and the resulting sequence of records is split into contiguous ranges, one for each worker
+    of the dataloader in each distributed rank. Each worker reads its range sequentially
+    (which usually spans a few shards), and shuffles the records through a buffer of the given size.
+
+    When `drop_remainder` is `True`, all ranges have the same size, so that all ranks produce the same
+    number of batches (which is required when training with DDP): the last `num_records % (world_size * num_workers)`
+    records of the concatenation are skipped in each epoch. Otherwise, all records are read, but the
+    sizes of the ranges differ by at most one record (which is suitable for validation).
+
+    If `batch_size` is given (with `drop_remainder`), the size of the ranges is also rounded down to a multiple
+    of the batch size, so that each worker only produces complete batches.
+
+    The length of the dataset is the number of records read by the current rank, and requires
+    `num_workers` to be the number of workers of the dataloader.
+
+    The shard order is determined by the seed and the epoch, which must be set through `set_epoch`
+    (e.g. by the `ShardEpoch` callback) before iteration starts. The epoch is held in shared memory,
+    so that it is also seen by persistent dataloader workers.
+    """
+
+    def __init__(self, shards_root: str, split: str, transform: Optional[Callable]=None,
+                 shuffle_buffer: int=0, seed: int=0, num_workers: int=0, drop_remainder: bool=True,
+                 batch_size: Optional[int]=None):
+        super().__init__()
+
+        manifest = load_manifest(shards_root, split)
+
+        self.shards_root = shards_root
+        self.split = split
+        self.shard_files = [s['file'] for s in manifest['shards']]
+        self.shard_sizes = [s['num_records'] for s in manifest['shards']]
+        self.num_records = manifest['num_records']
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_workers = num_workers
+        self.drop_remainder = drop_remainder
+        self.batch_size = batch_size
+        self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+
+    @property
+    def epoch(self) -> int:
+        return int(self._epoch)
+
+    def set_epoch(self, epoch: int):
+        self._epoch.fill_(epoch)
+
+    def __len__(self):
+        # Number of records read by the workers of the current rank
+        rank, world_size = _distributed_info()
+        num_workers = max(self.num_workers, 1)
+
+        return sum(
+            stop - start
+            for start, stop in (self._stream_range(rank * num_workers + w, world_size * num_workers) for w in range(num_workers)))
+
+    def _shard_order(self) -> List[int]:
+        order = list(range(len(self.shard_files)))
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order
+
+    def _stream_range(self, stream: int, num_streams: int) -> Tuple[int, int]:
+        """Computes the range of positions in the concatenation of the shards read by the given stream."""
+        if self.drop_remainder:
+            size = self.num_records // num_streams
+            if self.batch_size is not None:
+                size = size // self.batch_size * self.batch_size
+            return stream * size, (stream + 1) * size
+
+        return stream * self.num_records // num_streams, (stream + 1) * self.num_records // num_streams
+
+    def _assigned_ranges(self, rank: int, world_size: int, worker_id: int, num_workers: int) -> List[Tuple[int, int, int]]:
+        """Computes the records read by the given worker, as a list of `(shard, start, stop)` ranges within shards."""
+        start, stop = self._stream_range(rank * num_workers + worker_id, world_size * num_workers)
+        ranges = []
+        position = 0
+
+        for i in self._shard_order():
+            size = self.shard_sizes[i]
+            lo, hi = max(start, position), min(stop, position + size)
+            if lo < hi:
+                ranges.append((i, lo - position, hi - position))
+            position += size
+
+        return ranges
+
+    def _iter_records(self, ranges: Sequence[Tuple[int, int, int]]) -> Iterator[Tuple[bytes, int]]:
+        for i, start, stop in ranges:
+            yield from read_shard(os.path.join(self.shards_root, self.shard_files[i]), start=start, stop=stop)
+
+    def _iter_shuffled(self, records: Iterator[Tuple[bytes, int]], rng: random.Random) -> Iterator[Tuple[bytes, int]]:
+        buffer = []
+
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = record
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        rank, world_size = _distributed_info()
+
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        records = self._iter_records(self._assigned_ranges(rank, world_size, worker_id, num_workers))
+
+        if self.shuffle_buffer > 0:
+            rng = random.Random(hash((self.seed, self.epoch, rank, worker_id)))
+            records = self._iter_shuffled(records, rng)
+
+        for data, label in records:
+            img = decode_image(data)
+
+            if self.transform is not None:
+                img = self.transform(img)
+
+            yield img, label
+
+
+class ShardEpoch(pytorch_lightning.Callback):
+    """Sets the epoch of the sharded training dataset of the datamodule at the start of each epoch."""
+
+    def on_train_epoch_start(self, trainer: pytorch_lightning.Trainer, pl_module: pytorch_lightning.LightningModule):
+        ds = getattr(trainer.datamodule, 'train_ds', None)
+
+        if isinstance(ds, ShardedPlacesDataset):
+            ds.set_epoch(trainer.current_epoch)
+
+
+@dataclasses.dataclass
+class ShardConversionConfig:
+    """Configuration for converting the places365 dataset to shards.
+
+    Attributes
+    ----------
+    root : str
+        Root directory of the places365 dataset.
+    output : str
+        Directory in which to write the shards.
+    splits : List[str]
+        List of splits to convert.
+    num_shards : int
+        Number of shards to create for the training split. The validation split
+        is divided into proportionally fewer shards.
+    num_workers : int
+        Number of processes used to write shards in parallel.
+    """
+    root: str = '/places365'
+    output: str = '/places365_shards'
+    splits: List[str] = dataclasses.field(default_factory=lambda: ['train-standard', 'val'])
+    num_shards: int = 256
+    num_workers: int = 8
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: ShardConversionConfig):
+    import torchvision
+
+    output = hydra.utils.to_absolute_path(config.output)
+    num_train = None
+
+    for split in config.splits:
+        ds = torchvision.datasets.Places365(config.root, split=split, small=True)
+
+        if num_train is None:
+            num_train = len(ds)
+            num_shards = config.num_shards
+        else:
+            num_shards = max(config.num_shards * len(ds) // num_train, 1)
+
+        print(f'Writing {len(ds)} records from split {split} into {num_shards} shards.')
+        write_shards(ds.imgs, output, split, num_shards, num_workers=config.num_workers)
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=ShardConversionConfig)
+    main()
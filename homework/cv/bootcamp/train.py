@@ -2,7 +2,7 @@ import hydra
 import pytorch_lightning
 import pytorch_lightning.callbacks
 
-from . import model, dataset
+from . import model, dataset, distributed, monitor, progressive, shards
 
 
 @hydra.main(config_name='conf', config_path=None)
@@ -10,10 +10,51 @@ def main(config: model.PlacesTrainingConfig):
     callbacks = [
         pytorch_lightning.callbacks.DeviceStatsMonitor(),
         pytorch_lightning.callbacks.LearningRateMonitor(log_momentum=True),
+        monitor.ThroughputMonitor(),
     ]
 
+    num_processes = config.gpus if config.gpus > 0 else max(config.cpu_processes, 1)
+
+    val_batch_size = config.data.val_batch_size
+    if val_batch_size is not None:
+        val_batch_size = val_batch_size // num_processes
+
+    schedule = model.resolution_schedule(config)
+
+    dm = dataset.PlacesDataModule(
+        config.batch_size // num_processes,
+        config.data.root,
+        config.data.num_workers,
+        data_format=config.data.format,
+        shards_root=config.data.shards_root,
+        shuffle_buffer=config.data.shuffle_buffer,
+        cache_root=config.data.cache_root,
+        augment_on=config.data.augment_on,
+        val_cache=config.data.val_cache,
+        val_batch_size=val_batch_size,
+        index_cache_dir=config.data.index_cache_dir,
+        profile=config.data.profile,
+        resolution_schedule=schedule)
+
+    if config.data.format == 'shards':
+        # Reshuffles the order of the shards every epoch
+        callbacks.append(shards.ShardEpoch())
+
+    if config.data.profile:
+        callbacks.append(monitor.DataPipelineMonitor(dm.data_timings))
+
+    if schedule is not None:
+        callbacks.append(progressive.ProgressiveResizing(schedule))
+
     trainer_kwargs = { **config.lightning }
 
+    # Each process reads its own shard of the data, see `PlacesDataModule`
+    trainer_kwargs['replace_sampler_ddp'] = False
+
+    if schedule is not None:
+        # The number of batches of each epoch is only known when requesting the training dataloader
+        trainer_kwargs['reload_dataloaders_every_n_epochs'] = 1
+
     if config.optim.grad_clip_norm is not None:
         trainer_kwargs['gradient_clip_val'] = config.optim.grad_clip_norm
 
@@ -23,20 +64,18 @@ def main(config: model.PlacesTrainingConfig):
     else:
         trainer_kwargs['accelerator'] = 'cpu'
 
+        if num_processes > 1:
+            trainer_kwargs['devices'] = num_processes
+            trainer_kwargs['strategy'] = distributed.CPUDDPStrategy()
+
     trainer_kwargs['callbacks'] = callbacks
     trainer_kwargs['max_epochs'] = config.max_epochs
     trainer_kwargs['precision'] = config.precision
 
     trainer = pytorch_lightning.Trainer(**trainer_kwargs)
 
-    dm = dataset.PlacesDataModule(
-        config.batch_size // max(config.gpus, 1),
-        config.data.root,
-        config.data.num_workers)
-
-    dm.setup()
-
-    config.data.dataset_size = len(dm.train_ds)
+    # Note: this only reads the metadata of the dataset, the datamodule is set up by the trainer.
+    config.data.dataset_size = dm.num_train_samples()
 
     mymodel = model.PlacesModel(config)
 
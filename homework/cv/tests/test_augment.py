@@ -0,0 +1,51 @@
+import functools
+
+import torch
+import torchvision.transforms
+
+from bootcamp import augment
+
+
+def test_batch_augmentation_center_crop_matches_torchvision():
+    images = torch.randint(0, 256, (4, 3, 32, 40), dtype=torch.uint8)
+
+    augmentation = augment.BatchAugmentation(24).eval()
+    result = augmentation(images)
+
+    expected = torchvision.transforms.Compose([
+        torchvision.transforms.CenterCrop(24),
+        torchvision.transforms.ConvertImageDtype(torch.float32),
+        torchvision.transforms.Normalize(augment.IMAGENET_MEAN, augment.IMAGENET_STD),
+    ])(images)
+
+    assert result.dtype == torch.float32
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_batch_augmentation_random_crops_are_valid():
+    # Encode the position of each pixel in the image, so that crops can be recovered
+    rows = torch.arange(16).view(16, 1).expand(16, 16)
+    cols = torch.arange(16).view(1, 16).expand(16, 16)
+    images = torch.stack([rows, cols, torch.zeros_like(rows)]).to(torch.uint8).expand(64, 3, 16, 16)
+
+    augmentation = augment.BatchAugmentation(8, mean=(0, 0, 0), std=(1 / 255, 1 / 255, 1 / 255))
+    result = augmentation(images).round().long()
+
+    crop_rows, crop_cols = result[:, 0], result[:, 1]
+    offsets = torch.arange(8)
+
+    # Each crop is a contiguous window, possibly flipped horizontally
+    assert torch.equal(crop_rows, (crop_rows[:, :1, :1] + offsets.view(1, 8, 1)).expand_as(crop_rows))
+    col_steps = crop_cols[:, :, 1:] - crop_cols[:, :, :-1]
+    assert ((col_steps == 1).all(dim=(1, 2)) | (col_steps == -1).all(dim=(1, 2))).all()
+    assert (col_steps == -1).any()
+    assert crop_rows.max() < 16 and crop_cols.max() < 16
+
+
+def test_collate_and_augment():
+    samples = [(torch.randint(0, 256, (3, 32, 32), dtype=torch.uint8), i) for i in range(5)]
+    collate = functools.partial(augment.collate_and_augment, augmentation=augment.BatchAugmentation(24))
+
+    images, labels = collate(samples)
+    assert images.shape == (5, 3, 24, 24)
+    assert labels.tolist() == list(range(5))
@@ -0,0 +1,88 @@
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+
+from bootcamp import cache
+
+
+@pytest.fixture
+def image_items(tmp_path):
+    rng = np.random.default_rng(0)
+    items = []
+
+    for i in range(10):
+        path = tmp_path / f'{i}.png'
+        # Use a lossless format so that decoded images can be compared exactly
+        PIL.Image.fromarray(rng.integers(0, 255, size=(32, 32, 3), dtype=np.uint8)).save(path)
+        items.append((str(path), i % 3))
+
+    return items
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_build_image_cache(image_items, tmp_path, num_workers):
+    output = str(tmp_path / 'cache')
+    cache.build_image_cache(image_items, output, 'train', image_size=32, num_workers=num_workers, chunk_size=3)
+
+    ds = cache.MemmapPlacesDataset(output, 'train')
+    assert len(ds) == 10
+
+    for i, (path, label) in enumerate(image_items):
+        img, ds_label = ds[i]
+        expected = np.asarray(PIL.Image.open(path))
+
+        assert img.dtype == torch.uint8
+        assert img.shape == (3, 32, 32)
+        assert np.array_equal(img.permute(1, 2, 0).numpy(), expected)
+        assert ds_label == label
+
+
+def test_image_cache_resizes(image_items, tmp_path):
+    output = str(tmp_path / 'cache')
+    cache.build_image_cache(image_items, output, 'val', image_size=16)
+
+    img, _ = cache.MemmapPlacesDataset(output, 'val')[0]
+    assert img.shape == (3, 16, 16)
+
+
+def test_eval_cache_batches(image_items, tmp_path):
+    output = str(tmp_path / 'cache')
+    cache.build_eval_cache(image_items, output, 'val', image_size=32, crop_size=24, num_workers=2, chunk_size=4)
+
+    ds = cache.EvalCacheDataset(output, batch_size=4, split='val', crop_size=24)
+    assert len(ds) == 3
+
+    images, labels = ds[2]
+    assert images.shape == (2, 3, 24, 24)
+    assert labels.tolist() == [label for _, label in image_items[8:]]
+
+    expected = np.asarray(PIL.Image.open(image_items[9][0]))[4:28, 4:28].transpose(2, 0, 1)
+    assert np.array_equal(images[1].numpy(), expected)
+
+
+def test_eval_cache_ranks(image_items, tmp_path):
+    output = str(tmp_path / 'cache')
+    cache.build_eval_cache(image_items, output, 'val', image_size=32, crop_size=24)
+
+    labels = []
+    for rank in range(3):
+        ds = cache.EvalCacheDataset(output, batch_size=2, split='val', crop_size=24, rank=rank, world_size=3)
+        batches = [ds[i] for i in range(len(ds))]
+
+        # Ranks read 3, 3 and 4 of the 10 images, without repeating any
+        assert [len(b[1]) for b in batches] == [[2, 1], [2, 1], [2, 2]][rank]
+        labels.extend(l for _, b in batches for l in b.tolist())
+
+    assert labels == [label for _, label in image_items]
+
+
+def test_eval_cache_keeps_image_cache_labels(image_items, tmp_path):
+    output = str(tmp_path / 'cache')
+    cache.build_image_cache(image_items, output, 'val', image_size=32)
+    # Build the evaluation cache of a subset, which must not overwrite the labels of the image cache
+    cache.build_eval_cache(image_items[:4], output, 'val', image_size=32, crop_size=24)
+
+    assert len(cache.MemmapPlacesDataset(output, 'val')) == len(image_items)
+    assert cache.EvalCacheDataset(output, batch_size=4, split='val', crop_size=24).labels.tolist() == [
+        label for _, label in image_items[:4]]
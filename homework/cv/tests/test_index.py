@@ -0,0 +1,48 @@
+import os
+import pickle
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from bootcamp import index
+
+
+@pytest.fixture
+def places_root(tmp_path):
+    root = tmp_path / 'places365'
+    lines = []
+
+    for i in range(6):
+        name = f'{"ab"[i % 2]}/category_{i % 2}/{i:08d}.jpg'
+        path = root / 'data_256_standard' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        PIL.Image.fromarray(np.full((8, 8, 3), i, dtype=np.uint8)).save(path)
+        lines.append(f'/{name} {i % 2}\n')
+
+    (root / 'places365_train_standard.txt').write_text(''.join(lines))
+    return str(root)
+
+
+def test_index_dataset(places_root, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    ds = index.PlacesIndexDataset(places_root, 'train-standard', cache_dir=cache_dir)
+
+    assert len(ds) == 6
+    assert index.index_length(places_root, 'train-standard', cache_dir) == 6
+    assert ds.image_path(3) == os.path.join(places_root, 'data_256_standard', 'b/category_1/00000003.jpg')
+
+    img, label = ds[3]
+    assert label == 1
+    assert np.asarray(img)[0, 0, 0] == 3
+
+
+def test_index_is_reused_and_picklable(places_root, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    index.build_index(places_root, 'train-standard', cache_dir)
+    files = sorted(os.listdir(cache_dir))
+
+    ds = pickle.loads(pickle.dumps(index.PlacesIndexDataset(places_root, 'train-standard', cache_dir=cache_dir)))
+
+    assert sorted(os.listdir(cache_dir)) == files
+    assert [label for _, label in ds.imgs] == [0, 1, 0, 1, 0, 1]
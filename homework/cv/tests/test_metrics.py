@@ -0,0 +1,36 @@
+import torch
+import torchmetrics
+
+from bootcamp import metrics
+
+
+def test_topk_accuracy_matches_torchmetrics():
+    torch.manual_seed(0)
+    logits = torch.randn(64, 365)
+    target = torch.randint(0, 365, (64,))
+    target[:10] = logits[:10].argmax(dim=-1)
+
+    accuracy = metrics.topk_accuracy(logits, target, top_k=(1, 5))
+
+    for k in (1, 5):
+        expected = torchmetrics.functional.accuracy(logits, target, top_k=k)
+        assert torch.allclose(accuracy[f'accuracy_top{k}'], expected)
+
+
+def test_topk_metric_accumulates():
+    torch.manual_seed(0)
+    metric = metrics.TopKAccuracy(top_k=(1, 5))
+    reference = torchmetrics.Accuracy(num_classes=365, top_k=5)
+
+    for batch_size in (16, 7):
+        logits = torch.randn(batch_size, 365)
+        target = torch.randint(0, 365, (batch_size,))
+        metric.update(logits, target)
+        reference.update(logits, target)
+
+    result = metric.compute()
+    assert set(result) == {'accuracy_top1', 'accuracy_top5'}
+    assert torch.allclose(result['accuracy_top5'], reference.compute())
+
+    metric.reset()
+    assert metric.total == 0
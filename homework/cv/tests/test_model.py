@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from bootcamp import model, optim
+
+
+@pytest.mark.parametrize('name,optimizer_cls', [('lars', optim.LARS), ('lamb', optim.LAMB)])
+def test_configure_large_batch_optimizers(name, optimizer_cls):
+    config = model.PlacesTrainingConfig(batch_size=512, max_epochs=2)
+    config.model.width_multiplier = 0.25
+    config.data.dataset_size = 1000
+    config.optim.optimizer = name
+
+    places_model = model.PlacesModel(config)
+    [opt], [scheduler_config] = places_model.configure_optimizers()
+
+    assert isinstance(opt, optimizer_cls)
+    # Biases and normalization parameters are excluded from weight decay and from the trust ratio
+    assert opt.param_groups[0]['weight_decay'] == config.optim.weight_decay
+    assert opt.param_groups[1]['weight_decay'] == 0.0
+    assert opt.param_groups[1]['trust_ratio'] is False
+    assert sum(len(g['params']) for g in opt.param_groups) == len(list(places_model.parameters()))
+
+    # The one-cycle schedule (which also cycles the momentum of lars, or the first beta of lamb) peaks at
+    # 10 times the learning rate scaled to the batch size.
+    scheduler = scheduler_config['scheduler']
+    assert scheduler.total_steps == 2 * 2
+    assert opt.param_groups[0]['max_lr'] == pytest.approx(10 * config.optim.learning_rate * 512 / 256)
+
+    before = [p.detach().clone() for p in places_model.parameters()]
+    places_model.train()
+    loss = places_model(torch.randn(2, 3, 64, 64)).logsumexp(dim=-1).mean()
+    loss.backward()
+    opt.step()
+    scheduler.step()
+
+    assert any(not torch.equal(p, q) for p, q in zip(places_model.parameters(), before))
+    assert all(torch.isfinite(p).all() for p in places_model.parameters())
@@ -0,0 +1,79 @@
+import pytorch_lightning
+import torch
+import torch.utils.data
+
+from bootcamp import monitor
+
+
+class _LinearModel(pytorch_lightning.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(8, 2)
+
+    def training_step(self, batch, *_):
+        x, y = batch
+        return torch.nn.functional.cross_entropy(self.linear(x), y)
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def test_throughput_monitor_cpu():
+    ds = torch.utils.data.TensorDataset(torch.randn(40, 8), torch.randint(0, 2, (40,)))
+    throughput = monitor.ThroughputMonitor(log_every_n_steps=1)
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', max_epochs=2, callbacks=[throughput], logger=False,
+        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(_LinearModel(), torch.utils.data.DataLoader(ds, batch_size=8))
+
+    assert len(throughput.epoch_summaries) == 2
+
+    summary = throughput.epoch_summaries[-1]
+    assert summary['samples_per_sec'] > 0
+    assert 0 <= summary['data_fraction'] <= 1
+    assert summary['step_time_p50'] <= summary['step_time_p99']
+    assert 'tokens_per_sec' not in summary
+
+
+class _ImageFolderDataset(torch.utils.data.Dataset):
+    """Minimal dataset following the torchvision conventions (`loader` and `transform` attributes)."""
+
+    def __init__(self, paths, transform=None):
+        self.paths = paths
+        self.transform = transform
+        self.loader = lambda path: None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        img = self.loader(self.paths[idx])
+        return self.transform(img), idx % 2
+
+
+def test_profiled_dataset_records_stages_across_workers(tmp_path):
+    import numpy as np
+    import PIL.Image
+    import torchvision.transforms
+
+    paths = []
+    for i in range(32):
+        path = str(tmp_path / f'{i}.png')
+        PIL.Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+
+    timings = monitor.StageTimings(['getitem', 'io', 'decode', 'transform', 'collate'], max_workers=2, sample_every=2)
+    ds = monitor.ProfiledDataset(_ImageFolderDataset(paths, torchvision.transforms.PILToTensor()), timings)
+    dataloader = torch.utils.data.DataLoader(
+        ds, batch_size=4, num_workers=2, collate_fn=monitor.ProfiledCollate(None, timings))
+
+    for images, _ in dataloader:
+        assert images.shape == (4, 3, 8, 8)
+
+    summary = timings.summary()
+    # Each worker times one in two samples (and batches) it loads
+    assert summary['getitem']['count'] == 16
+    assert summary['io']['count'] == summary['decode']['count'] == summary['transform']['count'] == 16
+    assert summary['collate']['count'] == 4
+    assert summary['getitem']['mean'] >= summary['transform']['mean']
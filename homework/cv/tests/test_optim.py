@@ -0,0 +1,125 @@
+import pytest
+import torch
+
+from bootcamp import optim
+
+
+def _make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+
+
+def _make_mlp():
+    # Without normalization, as the gradient of the bias before a normalization layer is only rounding noise,
+    # which adaptive optimizers amplify.
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+
+
+def _loss(model, generator=None):
+    x = torch.randn(16, 4, generator=generator)
+    return model(x).pow(2).mean()
+
+
+def test_parameter_groups_exclude_bias_and_norm():
+    model = _make_model()
+    groups = optim.parameter_groups(model, weight_decay=1e-4)
+
+    assert [p.shape for p in groups[0]['params']] == [torch.Size([8, 4]), torch.Size([2, 8])]
+    assert len(groups[1]['params']) == 4
+    assert groups[1]['weight_decay'] == 0.0
+    assert groups[1]['trust_ratio'] is False
+
+    assert len(optim.parameter_groups(model, exclude_bias_and_norm=False)[0]['params']) == 6
+
+
+@pytest.mark.parametrize('momentum', [0.0, 0.9])
+def test_lars_without_trust_ratio_matches_sgd(momentum):
+    model = _make_mlp()
+    reference = _make_mlp()
+
+    opt = optim.LARS(model.parameters(), lr=0.1, momentum=momentum, weight_decay=1e-2, trust_ratio=False)
+    reference_opt = torch.optim.SGD(reference.parameters(), lr=0.1, momentum=momentum, weight_decay=1e-2)
+
+    for step in range(3):
+        for m, o in ((model, opt), (reference, reference_opt)):
+            o.zero_grad()
+            _loss(m, torch.Generator().manual_seed(step)).backward()
+            o.step()
+
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p, q, atol=1e-6)
+
+
+def test_lars_trust_ratio():
+    weight = torch.nn.Parameter(torch.full((2, 2), 3.0))
+    opt = optim.LARS([weight], lr=1.0, momentum=0.0, trust_coefficient=0.01, max_trust_ratio=None)
+
+    weight.grad = torch.full((2, 2), 0.5)
+    opt.step()
+
+    # ||w|| = 6, ||g|| = 1, so that the update is 0.01 * 6 * g
+    assert torch.allclose(weight, torch.full((2, 2), 3.0 - 0.03))
+
+
+def test_trust_ratio_clipping_and_zero_weights():
+    weight = torch.nn.Parameter(torch.full((2, 2), 3.0))
+    zeros = torch.nn.Parameter(torch.zeros(2, 2))
+    opt = optim.LARS([weight, zeros], lr=1.0, momentum=0.0, trust_coefficient=1.0, max_trust_ratio=2.0)
+
+    weight.grad = torch.full((2, 2), 0.5)
+    zeros.grad = torch.full((2, 2), 0.5)
+    opt.step()
+
+    assert torch.allclose(weight, torch.full((2, 2), 2.0))
+    assert torch.allclose(zeros, torch.full((2, 2), -0.5))
+
+
+def test_lamb_first_step():
+    weight = torch.nn.Parameter(torch.full((2, 2), 3.0))
+    opt = optim.LAMB([weight], lr=0.1, weight_decay=0.0, max_trust_ratio=None)
+
+    weight.grad = torch.tensor([[1.0, -1.0], [2.0, -2.0]])
+    opt.step()
+
+    # The first Adam update is the sign of the gradient, of norm 2, so that the trust ratio is 6 / 2
+    expected = torch.full((2, 2), 3.0) - 0.1 * 3.0 * torch.tensor([[1.0, -1.0], [1.0, -1.0]])
+    assert torch.allclose(weight, expected, atol=1e-5)
+
+
+def test_lamb_without_trust_ratio_matches_adam():
+    model = _make_mlp()
+    reference = _make_mlp()
+
+    opt = optim.LAMB(model.parameters(), lr=1e-2, eps=1e-8, trust_ratio=False)
+    reference_opt = torch.optim.Adam(reference.parameters(), lr=1e-2, eps=1e-8)
+
+    for step in range(3):
+        for m, o in ((model, opt), (reference, reference_opt)):
+            o.zero_grad()
+            _loss(m, torch.Generator().manual_seed(step)).backward()
+            o.step()
+
+    for p, q in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p, q, atol=1e-5)
+
+
+@pytest.mark.parametrize('name', optim.OPTIMIZERS)
+def test_create_optimizer_reduces_loss(name):
+    model = _make_model()
+    lr = {'sgd': 0.1, 'lars': 1.0, 'lamb': 1e-2}[name]
+    opt = optim.create_optimizer(name, model, lr, weight_decay=1e-4)
+
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(64, 4, generator=generator)
+    initial = model(x).pow(2).mean().item()
+
+    for _ in range(20):
+        opt.zero_grad()
+        model(x).pow(2).mean().backward()
+        opt.step()
+
+    assert model(x).pow(2).mean().item() < initial
+
+    with pytest.raises(ValueError):
+        optim.create_optimizer('adagrad', model, lr)
@@ -0,0 +1,59 @@
+import io
+import json
+import time
+
+import numpy as np
+import PIL.Image
+import torch
+
+from bootcamp import predict
+
+
+def _make_network():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, 3, stride=4),
+        torch.nn.AdaptiveAvgPool2d(1),
+        torch.nn.Flatten(),
+        torch.nn.Linear(8, 365)).eval()
+
+
+def test_dynamic_batches():
+    def items():
+        for i in range(10):
+            yield str(i), torch.zeros(1)
+        # Simulate a slow source, so that the remaining items are emitted as a partial batch
+        time.sleep(0.2)
+        for i in range(10, 12):
+            yield str(i), torch.zeros(1)
+
+    batches = list(predict.dynamic_batches(items(), max_batch_size=4, max_wait=0.05))
+
+    assert [len(names) for names, _, _ in batches] == [4, 4, 2, 2]
+    assert [n for names, _, _ in batches for n in names] == [str(i) for i in range(12)]
+
+
+def test_predict_image_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        PIL.Image.fromarray(rng.integers(0, 255, size=(300, 280, 3), dtype=np.uint8)).save(tmp_path / f'{i}.png')
+
+    network = predict.export_model(_make_network(), str(tmp_path / 'model.pt'), 'torchscript')
+
+    items, decode = predict.iter_inputs(str(tmp_path))
+    batches = predict.dynamic_batches(predict.decode_in_threads(items, decode, num_threads=2), 2, 0.01)
+
+    output = io.StringIO()
+    report = predict.predict(predict.Predictor(network), batches, output)
+
+    assert report['images'] == 5
+    assert report['latency_p99_ms'] >= report['latency_p50_ms'] > 0
+
+    predictions = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [p['image'].rsplit('/', 1)[1] for p in predictions] == [f'{i}.png' for i in range(5)]
+
+    # The exported model gives the same predictions as the original one
+    image = predict.decode_file(str(tmp_path / '0.png'))
+    _, expected = predict.Predictor(_make_network())([image])
+    assert predictions[0]['classes'] == expected[0].tolist()
+    assert len(predictions[0]['scores']) == 5
@@ -0,0 +1,180 @@
+import json
+import os
+import socket
+
+import numpy as np
+import PIL.Image
+import pytorch_lightning
+import torch
+import torch.utils.data
+
+from bootcamp import cache, dataset, distributed, progressive
+
+
+def test_schedule_phases():
+    schedule = progressive.ResolutionSchedule.from_crop_sizes([128, 160, 224], [2, 3], batch_size=256)
+
+    assert [p.crop_size for p in schedule.phases] == [128, 160, 224]
+    assert [p.batch_size for p in schedule.phases] == [784, 496, 256]
+
+    assert schedule.phase(1).crop_size == 128
+    assert schedule.phase(2).crop_size == 160
+    assert schedule.phase(4).crop_size == 160
+    assert schedule.phase(10).crop_size == 224
+
+    expected = 2 * 2 + 3 * 3 + 5 * 4
+    assert schedule.total_steps(1000, max_epochs=10) == expected
+
+
+class _ImageDataset(torch.utils.data.Dataset):
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __len__(self):
+        return 12
+
+    def __getitem__(self, idx):
+        return self.transform(torch.zeros(3, 32, 32, dtype=torch.uint8))
+
+
+def test_resolution_changes_without_new_workers():
+    state = progressive.ResolutionState(crop_size=16, batch_size=4)
+    ds = _ImageDataset(progressive.ScheduledRandomCrop(state))
+
+    dataloader = torch.utils.data.DataLoader(
+        ds,
+        batch_sampler=progressive.ScheduledBatchSampler(torch.utils.data.SequentialSampler(ds), state),
+        num_workers=2,
+        persistent_workers=True)
+
+    assert [b.shape for b in dataloader] == [(4, 3, 16, 16)] * 3
+    workers = dataloader._iterator._workers
+
+    state.crop_size = 24
+    state.batch_size = 6
+
+    assert len(dataloader) == 2
+    assert [b.shape for b in dataloader] == [(6, 3, 24, 24)] * 2
+    assert dataloader._iterator._workers is workers
+
+
+class _BatchRecorder(pytorch_lightning.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(3, 4)
+        self.epochs = []
+
+    def on_train_epoch_start(self):
+        self.epochs.append({'num_batches': self.trainer.num_training_batches, 'shapes': []})
+
+    def training_step(self, batch, batch_idx):
+        images, labels = batch
+        self.epochs[-1]['shapes'].append(tuple(images.shape))
+        return torch.nn.functional.cross_entropy(self.linear(images.mean(dim=(2, 3))), labels)
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def _build_cache(tmp_path) -> str:
+    rng = np.random.default_rng(0)
+    items = []
+
+    for i in range(24):
+        path = tmp_path / f'{i}.png'
+        PIL.Image.fromarray(rng.integers(0, 255, size=(32, 32, 3), dtype=np.uint8)).save(path)
+        items.append((str(path), i % 4))
+
+    cache_root = str(tmp_path / 'cache')
+    cache.build_image_cache(items, cache_root, 'train-standard', image_size=32, num_workers=1)
+    cache.build_image_cache(items[:4], cache_root, 'val', image_size=32, num_workers=1)
+    return cache_root
+
+
+def _make_schedule() -> progressive.ResolutionSchedule:
+    return progressive.ResolutionSchedule([
+        progressive.ResolutionPhase(16, 8, 1),
+        progressive.ResolutionPhase(24, 6, None),
+    ])
+
+
+def test_phase_change_during_fit(tmp_path):
+    cache_root = _build_cache(tmp_path)
+    schedule = _make_schedule()
+
+    dm = dataset.PlacesDataModule(4, data_format='memmap', cache_root=cache_root, num_data_workers=0, resolution_schedule=schedule)
+    model = _BatchRecorder()
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', max_epochs=3, limit_val_batches=0, reload_dataloaders_every_n_epochs=1,
+        callbacks=[progressive.ProgressiveResizing(schedule)], logger=False,
+        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(model, datamodule=dm)
+
+    assert [e['num_batches'] for e in model.epochs] == [3, 4, 4]
+    assert model.epochs[0]['shapes'] == [(8, 3, 16, 16)] * 3
+    assert model.epochs[1]['shapes'] == [(6, 3, 24, 24)] * 4
+    assert model.epochs[2]['shapes'] == [(6, 3, 24, 24)] * 4
+
+
+class _LoaderRecorder(_BatchRecorder):
+    """Records the dataloaders and their worker processes at the first batch of each epoch."""
+
+    def training_step(self, batch, batch_idx):
+        if batch_idx == 0:
+            loader = self.trainer.train_dataloader.loaders
+            self.epochs[-1]['loader'] = id(loader)
+            self.epochs[-1]['workers'] = [w.pid for w in loader._iterator._workers]
+            self.epochs[-1]['val_samples'] = 0
+        return super().training_step(batch, batch_idx)
+
+    def validation_step(self, batch, batch_idx):
+        if batch_idx == 0:
+            self.epochs[-1]['val_loader'] = id(self.trainer.val_dataloaders[0])
+        self.epochs[-1]['val_samples'] += len(batch[0])
+
+
+def _fit_ddp(rank: int, port: int, cache_root: str, output: str):
+    # The processes are created here, rather than by the strategy re-running the current command
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), NODE_RANK='0', LOCAL_RANK=str(rank), WORLD_SIZE='2')
+
+    schedule = _make_schedule()
+    dm = dataset.PlacesDataModule(4, data_format='memmap', cache_root=cache_root, num_data_workers=1, resolution_schedule=schedule)
+    model = _LoaderRecorder()
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', devices=2, strategy=distributed.CPUDDPStrategy(), max_epochs=3,
+        num_sanity_val_steps=0, reload_dataloaders_every_n_epochs=1, replace_sampler_ddp=False,
+        callbacks=[progressive.ProgressiveResizing(schedule)], logger=False,
+        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(model, datamodule=dm)
+
+    with open(os.path.join(output, f'{rank}.json'), 'w') as f:
+        json.dump(model.epochs, f)
+
+
+def test_loaders_kept_with_ddp(tmp_path):
+    cache_root = _build_cache(tmp_path)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    torch.multiprocessing.spawn(_fit_ddp, args=(port, cache_root, str(tmp_path)), nprocs=2)
+
+    for rank in range(2):
+        with open(tmp_path / f'{rank}.json') as f:
+            epochs = json.load(f)
+
+        # Each process reads half of the samples, with half of the batch size of each phase
+        assert [e['num_batches'] for e in epochs] == [3, 4, 4]
+        assert epochs[0]['shapes'] == [[4, 3, 16, 16]] * 3
+        assert epochs[1]['shapes'] == [[3, 3, 24, 24]] * 4
+
+        # Each validation sample is evaluated by a single process
+        assert [e['val_samples'] for e in epochs] == [2] * 3
+
+        assert len({e['loader'] for e in epochs}) == 1
+        assert len({e['val_loader'] for e in epochs}) == 1
+        assert len(epochs[0]['workers']) == 1
+        assert len({tuple(e['workers']) for e in epochs}) == 1
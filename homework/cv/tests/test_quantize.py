@@ -0,0 +1,74 @@
+import torch
+import torchvision
+
+from bootcamp import augment, quantize
+
+
+def _batches(num_batches, batch_size=4):
+    generator = torch.Generator().manual_seed(0)
+    return [
+        (torch.randint(0, 256, (batch_size, 3, 256, 256), dtype=torch.uint8, generator=generator),
+         torch.randint(0, 365, (batch_size,), generator=generator))
+        for _ in range(num_batches)]
+
+
+def _network():
+    torch.manual_seed(0)
+    return torchvision.models.mobilenet.mobilenet_v3_large(num_classes=365, _width_mult=0.25).eval()
+
+
+def _small_network():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 7, stride=4), torch.nn.BatchNorm2d(16), torch.nn.ReLU(),
+        torch.nn.Conv2d(16, 32, 3, stride=2), torch.nn.BatchNorm2d(32), torch.nn.ReLU(),
+        torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(32, 10)).eval()
+
+
+def _smooth_batches(num_batches, batch_size=16):
+    # Images interpolated from a few random colors, which (unlike uniform noise) the
+    # untrained network does not map to nearly identical outputs.
+    generator = torch.Generator().manual_seed(0)
+    batches = []
+
+    for _ in range(num_batches):
+        colors = torch.randint(0, 256, (batch_size, 3, 2, 2), generator=generator).float()
+        img = torch.nn.functional.interpolate(colors, size=256, mode='bilinear').round().to(torch.uint8)
+        batches.append((img, torch.randint(0, 10, (batch_size,), generator=generator)))
+
+    return batches
+
+
+def test_quantize_static_matches_float():
+    network = _small_network()
+    calibration = _smooth_batches(2)
+    quantized = quantize.quantize_static(network, calibration)
+
+    augmentation = augment.BatchAugmentation(224).eval()
+    with torch.inference_mode():
+        # Label the calibration batches with the predictions of the float network
+        predictions = [(img, network(augmentation(img)).argmax(dim=-1)) for img, _ in calibration]
+
+    assert quantize.evaluate(quantized, predictions)['accuracy_top1'] >= 0.9
+
+
+def test_quantize_static_report():
+    network = _network()
+    quantized = quantize.quantize_static(network, _batches(2))
+
+    report = quantize.compare({'fp32': network, 'int8': quantized}, _batches(1), batch_sizes=(1,))
+
+    assert set(report['int8']) == {'accuracy_top1', 'accuracy_top5', 'size_mb', 'bs1_latency_p50_ms', 'bs1_latency_p99_ms'}
+    assert report['int8']['size_mb'] < report['fp32']['size_mb'] / 2
+
+    # The network itself is not modified
+    assert all(p.dtype == torch.float32 for p in network.parameters())
+
+
+def test_quantize_aware_training():
+    quantized = quantize.quantize_aware_training(_network(), _batches(2), freeze_bn_after=1)
+
+    with torch.inference_mode():
+        logits = quantized(torch.randn(2, 3, 224, 224))
+
+    assert logits.shape == (2, 365)
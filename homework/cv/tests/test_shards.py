@@ -0,0 +1,134 @@
+import numpy as np
+import PIL.Image
+import pytest
+import torch
+import torch.utils.data
+
+from bootcamp import shards
+
+
+@pytest.fixture
+def image_items(tmp_path):
+    rng = np.random.default_rng(0)
+    items = []
+
+    for i in range(20):
+        path = tmp_path / f'{i}.jpg'
+        PIL.Image.fromarray(rng.integers(0, 255, size=(16, 16, 3), dtype=np.uint8)).save(path)
+        items.append((str(path), i % 5))
+
+    return items
+
+
+def test_write_read_shards(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    manifest = shards.write_shards(image_items, str(output), 'train', num_shards=3)
+
+    assert manifest['num_records'] == 20
+    assert len(manifest['shards']) == 3
+
+    expected = {}
+    for path, label in image_items:
+        with open(path, 'rb') as f:
+            expected[f.read()] = label
+
+    records = []
+    for s in manifest['shards']:
+        records.extend(shards.read_shard(str(output / s['file'])))
+
+    assert len(records) == 20
+    assert all(expected[data] == label for data, label in records)
+
+
+def test_read_shard_seek(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    manifest = shards.write_shards(image_items, str(output), 'train', num_shards=1)
+    path = str(output / manifest['shards'][0]['file'])
+
+    records = list(shards.read_shard(path))
+    assert list(shards.read_shard(path, start=5, stop=8)) == records[5:8]
+
+
+def test_sharded_dataset_iterates_all_records(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    shards.write_shards(image_items, str(output), 'train', num_shards=4)
+
+    ds = shards.ShardedPlacesDataset(str(output), 'train', shuffle_buffer=8)
+    labels = [label for _, label in ds]
+
+    assert len(ds) == 20
+    assert sorted(labels) == sorted(label for _, label in image_items)
+
+
+def _assigned_records(ds, world_size, num_workers):
+    assigned = {}
+    for rank in range(world_size):
+        for worker_id in range(num_workers):
+            ranges = ds._assigned_ranges(rank, world_size, worker_id, num_workers)
+            assigned[rank, worker_id] = [(i, j) for i, start, stop in ranges for j in range(start, stop)]
+    return assigned
+
+
+def test_sharded_dataset_ranks_are_disjoint_and_balanced(image_items, tmp_path, monkeypatch):
+    output = tmp_path / 'shards'
+    shards.write_shards(image_items, str(output), 'train', num_shards=7)
+
+    ds = shards.ShardedPlacesDataset(str(output), 'train', shuffle_buffer=8, num_workers=2)
+    world_size, num_workers = 3, 2
+
+    for epoch in range(2):
+        ds.set_epoch(epoch)
+        assigned = _assigned_records(ds, world_size, num_workers)
+
+        records = [r for rs in assigned.values() for r in rs]
+        assert len(set(records)) == len(records)
+        # 20 records over 6 workers, the last 2 records are skipped
+        assert all(len(rs) == 3 for rs in assigned.values())
+
+    # The length is the number of records read by the workers of the current rank
+    monkeypatch.setattr(shards, '_distributed_info', lambda: (1, world_size))
+    assert len(ds) == 6
+
+
+def test_sharded_dataset_complete_batches(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    shards.write_shards(image_items, str(output), 'train', num_shards=3)
+
+    ds = shards.ShardedPlacesDataset(
+        str(output), 'train', transform=lambda img: 0, num_workers=2, batch_size=4)
+    loader = torch.utils.data.DataLoader(ds, batch_size=4, num_workers=2)
+
+    # Each worker reads 10 records, rounded down to 8 to form complete batches
+    assert len(ds) == 16
+    assert len(loader) == 4
+    assert [len(labels) for _, labels in loader] == [4, 4, 4, 4]
+
+
+def test_sharded_dataset_without_dropping_remainder(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    shards.write_shards(image_items, str(output), 'val', num_shards=3)
+
+    ds = shards.ShardedPlacesDataset(str(output), 'val', num_workers=1, drop_remainder=False)
+    assigned = _assigned_records(ds, world_size=3, num_workers=1)
+
+    # All records are read, and ranks differ by at most one record
+    assert sorted(len(rs) for rs in assigned.values()) == [6, 7, 7]
+    assert len({r for rs in assigned.values() for r in rs}) == 20
+
+
+def test_sharded_dataset_epoch_is_shared_with_workers(image_items, tmp_path):
+    output = tmp_path / 'shards'
+    shards.write_shards(image_items, str(output), 'train', num_shards=4)
+
+    ds = shards.ShardedPlacesDataset(str(output), 'train', transform=lambda img: 0, shuffle_buffer=4, num_workers=1)
+    loader = torch.utils.data.DataLoader(ds, batch_size=None, num_workers=1, persistent_workers=True)
+
+    orders = []
+    for epoch in [0, 1, 0]:
+        ds.set_epoch(epoch)
+        orders.append([label for _, label in loader])
+
+    # The order only depends on the epoch, and not on the number of iterations
+    assert orders[0] == orders[2]
+    assert orders[0] != orders[1]
+    assert sorted(orders[0]) == sorted(orders[1])
@@ -1,8 +1,110 @@
 import dataclasses
+from typing import Any, List, Optional
 
 @dataclasses.dataclass
 class BertFineTuningConfig:
-    precision: int = 32
+    # 32, 16 or bf16 (bf16 autocast is also supported on CPU)
+    precision: Any = 32
     max_epochs: int = 20
     batch_size: int = 8
     gpus: int = 1
+    # Number of data-parallel processes when training on CPU (gpus=0)
+    cpu_processes: int = 1
+    profile_data: bool = False
+    max_length: int = 512
+    # Directory in which the tokenized datasets are cached
+    data_cache_dir: str = '~/.cache/bootcamp/yelp'
+    # Pad batches to their longest review, grouping reviews of similar length
+    dynamic_padding: bool = False
+    bucket_batches: int = 50
+    # Concatenate several reviews into each row of max_length tokens, batch_size is then the number of rows
+    sequence_packing: bool = False
+    # Number of batches whose gradients are accumulated before each optimizer step,
+    # the effective batch size is batch_size * accumulate_grad_batches
+    accumulate_grad_batches: int = 1
+    # Recompute the activations of the encoder in the backward pass, to save memory
+    gradient_checkpointing: bool = False
+    # Fetch each batch from the arrow table at once, instead of one review at a time
+    batched_fetch: bool = True
+
+
+@dataclasses.dataclass
+class FeatureHeadConfig:
+    # Pretrained encoder (and tokenizer), which is frozen
+    model_name: str = 'bert-base-cased'
+    # Features to cache: 'pooled' output, or [CLS] output of every 'layers'
+    pooling: str = 'pooled'
+    max_length: int = 512
+    data_cache_dir: str = '~/.cache/bootcamp/yelp'
+    # Number of reviews encoded at once when extracting the features
+    extract_batch_size: int = 64
+    batch_size: int = 256
+    num_workers: int = 2
+    learning_rate: float = 1e-3
+    weight_decay: float = 0.01
+    dropout: float = 0.1
+    max_epochs: int = 20
+    gpus: int = 1
+
+
+@dataclasses.dataclass
+class ServeConfig:
+    # Lightning checkpoint of the PretrainedBertModel to serve, or the pretrained model_name if None
+    checkpoint: Optional[str] = None
+    # Pretrained model (and tokenizer) of the checkpoint
+    model_name: str = 'bert-base-cased'
+    host: str = '127.0.0.1'
+    port: int = 8080
+    max_batch_size: int = 32
+    # Maximum time a text waits for its batch to fill up
+    max_wait_ms: float = 5.0
+    # Lengths to which batches are padded
+    length_buckets: List[int] = dataclasses.field(default_factory=lambda: [64, 128, 256, 512])
+    tokenize_threads: int = 2
+    # Number of threads used by torch for inference, by default the torch default
+    num_threads: Optional[int] = None
+
+
+@dataclasses.dataclass
+class ExportConfig:
+    # Lightning checkpoint of the PretrainedBertModel to export
+    checkpoint: str = '???'
+    # Directory in which to save the traced buckets
+    output: str = 'model_int8'
+    # Pretrained model (and tokenizer) of the checkpoint
+    model_name: str = 'bert-base-cased'
+    # Lengths for which the quantized model is traced, reviews are truncated to the largest
+    length_buckets: List[int] = dataclasses.field(default_factory=lambda: [64, 128, 256, 512])
+    max_batch_size: int = 64
+    data_cache_dir: str = '~/.cache/bootcamp/yelp'
+    # Number of test reviews used to compare the exported model to the original model
+    eval_size: int = 1000
+    num_threads: Optional[int] = None
+
+
+@dataclasses.dataclass
+class ScoreConfig:
+    # Directory of the traced buckets, see bootcamp.quantize
+    model: str = '???'
+    # Json lines or parquet file of reviews
+    input: str = '???'
+    output: str = 'scores.jsonl'
+    model_name: str = 'bert-base-cased'
+    text_field: str = 'text'
+    # Field identifying each review, copied to the output if not None
+    id_field: Optional[str] = None
+    # Number of reviews read and tokenized at once, which bounds memory
+    chunk_size: int = 1024
+    max_batch_size: int = 64
+    num_threads: Optional[int] = None
+
+
+@dataclasses.dataclass
+class FetchBenchmarkConfig:
+    # Numbers of dataloader workers to compare
+    num_workers: List[int] = dataclasses.field(default_factory=lambda: [0, 2, 4])
+    batch_size: int = 32
+    num_batches: int = 100
+    max_length: int = 512
+    data_cache_dir: str = '~/.cache/bootcamp/yelp'
+    dynamic_padding: bool = False
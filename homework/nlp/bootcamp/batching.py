@@ -0,0 +1,144 @@
+"""Dynamic padding of tokenized reviews.
+
+Padding every review to the maximum length wastes most of the computation of the model,
+as most reviews are much shorter. Instead, reviews may be stored unpadded (see `load_tokenized`),
+and padded to the longest review of each batch by `pad_collate`.
+
+To further reduce padding, `LengthBucketBatchSampler` groups reviews of similar length
+into the same batches: indices drawn from the underlying (random) sampler are split into
+large chunks, which are sorted by length and cut into batches, and the batches of each chunk
+are then shuffled. The order of the reviews thus remains random, up to the chunk size.
+
+"""
+
+import random
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def pad_collate(features: Sequence[Dict[str, torch.Tensor]], pad_token_id: int=0,
+                pad_to_multiple_of: Optional[int]=8) -> Dict[str, torch.Tensor]:
+    """Collates unpadded tokenized reviews, padding them to the longest review in the batch.
+
+    Parameters
+    ----------
+    features : Sequence[Dict[str, torch.Tensor]]
+        Reviews, with 1-dimensional `input_ids` (and optionally `token_type_ids`) of varying length.
+    pad_token_id : int
+        Id of the padding token.
+    pad_to_multiple_of : int, optional
+        If not `None`, the padded length is rounded up to a multiple of this value,
+        which is more efficient on tensor cores.
+
+    Returns
+    -------
+    Dict[str, torch.Tensor]
+        The batch, with `input_ids`, `token_type_ids` and `attention_mask` of shape `[batch, length]`,
+        and `labels` if present in the features.
+    """
+    lengths = [len(f['input_ids']) for f in features]
+    length = max(lengths)
+
+    if pad_to_multiple_of is not None:
+        length = (length + pad_to_multiple_of - 1) // pad_to_multiple_of * pad_to_multiple_of
+
+    input_ids = torch.full((len(features), length), pad_token_id, dtype=torch.int64)
+    token_type_ids = torch.zeros((len(features), length), dtype=torch.int64)
+    attention_mask = torch.zeros((len(features), length), dtype=torch.int64)
+
+    for i, (f, n) in enumerate(zip(features, lengths)):
+        input_ids[i, :n] = f['input_ids']
+        attention_mask[i, :n] = 1
+        if 'token_type_ids' in f:
+            token_type_ids[i, :n] = f['token_type_ids']
+
+    batch = {'input_ids': input_ids, 'token_type_ids': token_type_ids, 'attention_mask': attention_mask}
+
+    if 'labels' in features[0]:
+        batch['labels'] = torch.as_tensor([int(f['labels']) for f in features])
+
+    return batch
+
+
+class LengthBucketBatchSampler(torch.utils.data.BatchSampler):
+    """Batch sampler grouping samples of similar length.
+
+    Parameters
+    ----------
+    sampler : torch.utils.data.Sampler
+        Sampler producing the order of the samples, e.g. a `RandomSampler` (or a `DistributedSampler`).
+    lengths : Sequence[int]
+        Length of each sample of the dataset.
+    batch_size : int
+        Number of samples in each batch.
+    drop_last : bool
+        If `True`, drops the last incomplete batch of each chunk.
+    bucket_batches : int
+        Number of batches in each chunk of indices sorted by length. Larger values reduce padding,
+        at the cost of a less random order.
+    shuffle : bool
+        If `True`, shuffles the batches within each chunk. Otherwise, batches are produced
+        by increasing length within each chunk.
+    seed : int
+        Seed for shuffling the batches, combined with the epoch (see `set_epoch`).
+    """
+
+    def __init__(self, sampler, lengths: Sequence[int], batch_size: int, drop_last: bool=False,
+                 bucket_batches: int=50, shuffle: bool=True, seed: int=0):
+        super().__init__(sampler, batch_size, drop_last)
+
+        self.lengths = np.asarray(lengths)
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def _chunk_batches(self, chunk: List[int]) -> List[List[int]]:
+        # Stable sort, so that samples of equal length remain in random order
+        order = np.argsort(self.lengths[chunk], kind='stable')
+        chunk = [chunk[i] for i in order]
+
+        batches = [chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        # Use a different order in the next epoch, even if `set_epoch` is not called
+        self.epoch += 1
+
+        chunk_size = self.batch_size * self.bucket_batches
+        chunk = []
+
+        for idx in self.sampler:
+            chunk.append(int(idx))
+
+            if len(chunk) == chunk_size:
+                yield from self._shuffled(self._chunk_batches(chunk), rng)
+                chunk = []
+
+        if chunk:
+            yield from self._shuffled(self._chunk_batches(chunk), rng)
+
+    def _shuffled(self, batches: List[List[int]], rng: random.Random) -> List[List[int]]:
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        # Each complete chunk produces exactly `bucket_batches` batches
+        chunk_size = self.batch_size * self.bucket_batches
+        full_chunks, remainder = divmod(len(self.sampler), chunk_size)
+
+        if self.drop_last:
+            return full_chunks * self.bucket_batches + remainder // self.batch_size
+        return full_chunks * self.bucket_batches + (remainder + self.batch_size - 1) // self.batch_size
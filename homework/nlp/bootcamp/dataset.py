@@ -1,9 +1,31 @@
 """This module provides a convenient interface to the yelp dataset through
 pytorch lightning and huggingface datasets.
+
+We only train on a random subset of the dataset, which is selected before tokenization.
+The tokenized subsets are saved in a cache directory, keyed by the tokenizer, maximum length,
+seed and sizes of the subsets, so that later runs with the same parameters simply
+memory-map the cached arrow files (see `load_tokenized`).
+
+By default, reviews are padded to the maximum length. Setting `dynamic_padding=True` instead
+stores the reviews unpadded, pads each batch to its longest review, and groups reviews of
+similar length into batches (see `bootcamp.batching`). Setting `sequence_packing=True` also
+stores the reviews unpadded, but concatenates several reviews into each row of `max_length`
+tokens (see `bootcamp.packing`), in which case `batch_size` is the number of rows in each batch.
+
+Unless `batched_fetch=False`, the dataloaders fetch each batch from the arrow table at once,
+instead of one review at a time (see `bootcamp.fetch`).
+
+Setting `profile=True` records the time spent fetching and collating training samples
+in the dataloader workers (see `bootcamp.monitor.ProfiledDataset`). In this case, training
+samples are fetched one at a time.
 """
 
 import functools
+import hashlib
+import json
 import os
+import shutil
+from typing import Callable, Optional
 
 import datasets
 import pytorch_lightning
@@ -11,45 +33,286 @@ import torch
 import torch.utils.data
 from transformers import AutoTokenizer
 
+from . import batching, fetch, monitor, packing
+
+
+DEFAULT_CACHE_DIR = '~/.cache/bootcamp/yelp'
+
+# Increment when changing the contents of the cache, to invalidate existing caches
+_CACHE_VERSION = 2
+
+
+def _tokenize(examples, tokenizer, max_length, padding=True):
+    if padding:
+        return tokenizer(examples["text"], padding='max_length', truncation=True, max_length=max_length)
+
+    result = tokenizer(examples["text"], truncation=True, max_length=max_length)
+    result['length'] = [len(ids) for ids in result['input_ids']]
+    return result
+
+
+def cache_path(cache_dir: str, tokenizer_name: str, max_length: int, seed: int, train_size: int, test_size: int,
+               padding: bool=True) -> str:
+    """Path of the cached tokenized subsets for the given parameters."""
+    if os.path.isdir(tokenizer_name):
+        # Local tokenizers are identified by their location
+        tokenizer_name = os.path.abspath(tokenizer_name)
+
+    key = json.dumps({
+        'dataset': 'yelp_review_full',
+        'tokenizer': tokenizer_name,
+        'max_length': max_length,
+        'seed': seed,
+        'train_size': train_size,
+        'test_size': test_size,
+        'padding': padding,
+        'version': _CACHE_VERSION,
+    }, sort_keys=True)
+
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(cache_dir), f'yelp-{digest}')
 
-def _tokenize(examples, tokenizer):
-    return tokenizer(examples["text"], padding='max_length', truncation=True)
 
-def _load_ds():
-    ds = datasets.load_dataset("yelp_review_full")
-    tokenizer = AutoTokenizer.from_pretrained("bert-base-cased", use_fast=True)
+def _select_and_tokenize(raw: datasets.DatasetDict, tokenizer_name: str, max_length: int,
+                         seed: int, train_size: int, test_size: int, padding: bool,
+                         num_proc: Optional[int]=None) -> datasets.DatasetDict:
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+
+    # Select the subsets first, so that only the selected reviews are tokenized
+    ds = datasets.DatasetDict({
+        'train': raw['train'].shuffle(seed=seed).select(range(train_size)),
+        'test': raw['test'].shuffle(seed=seed).select(range(test_size)),
+    })
+
     ds = ds.map(
-        functools.partial(_tokenize, tokenizer=tokenizer),
+        functools.partial(_tokenize, tokenizer=tokenizer, max_length=max_length, padding=padding),
         batched=True,
-        num_proc=len(os.sched_getaffinity(0)))
+        num_proc=num_proc or len(os.sched_getaffinity(0)))
     ds = ds.remove_columns(["text"])
     ds = ds.rename_column("label", "labels")
+    return ds
+
+
+def write_atomically(path: str, write: Callable[[str], None]):
+    """Creates the cache directory `path` with the given function, such that it is never partially written.
+
+    `write` is called with a temporary directory unique to this process, which is then moved in place.
+    If another process has created `path` concurrently, its version is kept.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write(tmp_path)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process has created the cache concurrently
+        shutil.rmtree(tmp_path)
+
+
+def prepare_tokenized(tokenizer_name: str='bert-base-cased', max_length: int=512, seed: int=42,
+                      train_size: int=20000, test_size: int=1000, cache_dir: str=DEFAULT_CACHE_DIR,
+                      padding: bool=True, raw: Optional[datasets.DatasetDict]=None,
+                      num_proc: Optional[int]=None) -> str:
+    """Tokenizes the train and test subsets of the yelp dataset into the cache, if they are not already cached.
+
+    Parameters
+    ----------
+    tokenizer_name : str
+        Name or path of the pretrained tokenizer.
+    max_length : int
+        Length to which reviews are truncated (and padded if `padding` is `True`).
+    seed : int
+        Seed used to select the random subsets.
+    train_size : int
+        Number of reviews in the training subset.
+    test_size : int
+        Number of reviews in the test subset.
+    cache_dir : str
+        Directory in which the tokenized subsets are cached.
+    padding : bool
+        If `True`, reviews are padded to `max_length`. Otherwise, reviews are stored
+        unpadded, with their number of tokens in the `length` column.
+    raw : datasets.DatasetDict, optional
+        The raw dataset, by default downloaded from the huggingface hub if the subsets are not cached.
+    num_proc : int, optional
+        Number of processes tokenizing the reviews, by default the number of cores available to this process.
+
+    Returns
+    -------
+    str
+        The path of the cached subsets.
+    """
+    path = cache_path(cache_dir, tokenizer_name, max_length, seed, train_size, test_size, padding)
+
+    if not os.path.exists(path):
+        if raw is None:
+            raw = datasets.load_dataset("yelp_review_full")
+
+        ds = _select_and_tokenize(raw, tokenizer_name, max_length, seed, train_size, test_size, padding, num_proc)
+
+        write_atomically(path, ds.save_to_disk)
+
+    return path
+
+
+def load_tokenized(tokenizer_name: str='bert-base-cased', max_length: int=512, seed: int=42,
+                   train_size: int=20000, test_size: int=1000, cache_dir: str=DEFAULT_CACHE_DIR,
+                   padding: bool=True, raw: Optional[datasets.DatasetDict]=None,
+                   num_proc: Optional[int]=None) -> datasets.DatasetDict:
+    """Loads the tokenized train and test subsets of the yelp dataset, from the cache if possible.
+
+    The parameters are those of `prepare_tokenized`.
+
+    Returns
+    -------
+    datasets.DatasetDict
+        The tokenized subsets, memory-mapped from the cache, in torch format.
+    """
+    path = prepare_tokenized(tokenizer_name, max_length, seed, train_size, test_size, cache_dir, padding, raw, num_proc)
+
+    ds = datasets.load_from_disk(path)
     ds.set_format("torch")
     return ds
 
 
+def shard_range(num_samples: int, num_shards: int, index: int) -> range:
+    """Contiguous range of samples in the given shard.
+
+    All shards have the same size, so that all processes run the same number of steps.
+    The last `num_samples % num_shards` samples are thus not part of any shard.
+    """
+    size = num_samples // num_shards
+    return range(index * size, (index + 1) * size)
+
+
 class YelpDataModule(pytorch_lightning.LightningDataModule):
-    def __init__(self, batch_size: int = 8, num_workers: int = 4):
+    """Datamodule for the yelp dataset.
+
+    Following the Lightning contract, the subsets are tokenized into the cache by `prepare_data`,
+    which is only called by one process on each node, and memory-mapped from the cache by `setup`,
+    which is called by every process. When training with several processes, each process only reads
+    its own contiguous shard of the subsets, which slices the memory-mapped arrow tables without copying them.
+    As the data is already sharded, the trainer should not replace the samplers (`replace_sampler_ddp=False`).
+    """
+
+    def __init__(self, batch_size: int = 8, num_workers: int = 4, profile: bool = False,
+                 tokenizer_name: str = 'bert-base-cased', max_length: int = 512, seed: int = 42,
+                 train_size: int = 20000, test_size: int = 1000, cache_dir: str = DEFAULT_CACHE_DIR,
+                 dynamic_padding: bool = False, bucket_batches: int = 50, sequence_packing: bool = False,
+                 num_proc: Optional[int] = None, batched_fetch: bool = True):
         super().__init__()
 
+        if dynamic_padding and sequence_packing:
+            raise ValueError('dynamic_padding and sequence_packing are mutually exclusive')
+
         # We work on a small subset of the dataset to speed up processing
-        ds = _load_ds()
-        self.ds_train = ds["train"].shuffle(seed=42).select(range(20000))
-        self.ds_test = ds["test"].shuffle(seed=42).select(range(1000))
+        self.tokenized_kwargs = dict(
+            tokenizer_name=tokenizer_name, max_length=max_length, seed=seed,
+            train_size=train_size, test_size=test_size, cache_dir=cache_dir,
+            padding=not (dynamic_padding or sequence_packing))
+        self.tokenizer_name = tokenizer_name
+        self.max_length = max_length
+        self.seed = seed
+        self.num_proc = num_proc
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.dynamic_padding = dynamic_padding
+        self.bucket_batches = bucket_batches
+        self.sequence_packing = sequence_packing
+        self.batched_fetch = batched_fetch
+        self.pad_token_id = 0
+
+        self.ds_train = None
+        self.ds_test = None
+        self.collate_fn = None
+
+        if profile:
+            # Must be created before the workers are started, to be shared with them
+            self.data_timings = monitor.StageTimings(['getitem', 'collate'], max_workers=num_workers)
+        else:
+            self.data_timings = None
+
+    def prepare_data(self) -> None:
+        prepare_tokenized(**self.tokenized_kwargs, num_proc=self.num_proc)
+
+    def _shard(self):
+        """Number of shards and index of the shard read by this process."""
+        if self.trainer is None:
+            return 1, 0
+        return self.trainer.world_size, self.trainer.global_rank
+
+    def setup(self, stage: Optional[str] = None) -> None:
+        if self.ds_train is not None:
+            return
+
+        ds = load_tokenized(**self.tokenized_kwargs)
+        num_shards, index = self._shard()
+
+        if self.sequence_packing:
+            pad_token_id = AutoTokenizer.from_pretrained(self.tokenizer_name).pad_token_id
+            # Reviews are packed identically by all processes, which then shard the rows,
+            # so that all processes have the same number of rows
+            train = self._packed(ds['train'], pad_token_id)
+            test = self._packed(ds['test'], pad_token_id)
+            self.ds_train = train.select(shard_range(len(train), num_shards, index))
+            self.ds_test = test.select(shard_range(len(test), num_shards, index))
+            self.collate_fn = packing.packed_collate
+            return
+
+        self.ds_train = ds['train'].select(shard_range(len(ds['train']), num_shards, index))
+        self.ds_test = ds['test'].select(shard_range(len(ds['test']), num_shards, index))
+
+        if self.dynamic_padding:
+            self.pad_token_id = AutoTokenizer.from_pretrained(self.tokenizer_name).pad_token_id
+            self.collate_fn = functools.partial(batching.pad_collate, pad_token_id=self.pad_token_id)
+
+    def _packed(self, ds, pad_token_id):
+        lengths = ds.with_format('numpy', columns=['length'])['length']
+        return packing.PackedDataset(ds, lengths, self.max_length, pad_token_id, seed=self.seed)
+
+    def _make_dataloader(self, ds, shuffle, collate_fn=None, lengths=None):
+        if self.batched_fetch and not self.sequence_packing and not isinstance(ds, monitor.ProfiledDataset):
+            # Fetch whole batches from the arrow table, instead of one review at a time
+            ds = fetch.ArrowBatchDataset(ds, self.pad_token_id)
+            collate_fn = fetch.collate_fetched
+
+        if self.dynamic_padding:
+            sampler = torch.utils.data.RandomSampler(ds) if shuffle else torch.utils.data.SequentialSampler(ds)
+
+            return torch.utils.data.DataLoader(
+                ds,
+                batch_sampler=batching.LengthBucketBatchSampler(
+                    sampler, lengths, self.batch_size,
+                    bucket_batches=self.bucket_batches, shuffle=shuffle),
+                num_workers=self.num_workers,
+                collate_fn=collate_fn,
+                pin_memory=True,
+                persistent_workers=self.num_workers > 0)
 
-    def _make_dataloader(self, ds, shuffle):
         return torch.utils.data.DataLoader(
             ds,
             batch_size=self.batch_size,
             shuffle=shuffle,
             num_workers=self.num_workers,
+            collate_fn=collate_fn,
             pin_memory=True,
             persistent_workers=self.num_workers > 0)
 
+    def _lengths(self, ds):
+        if not self.dynamic_padding:
+            return None
+        return ds.with_format('numpy', columns=['length'])['length']
+
     def train_dataloader(self):
-        return self._make_dataloader(self.ds_train, True)
+        lengths = self._lengths(self.ds_train)
+
+        if self.data_timings is not None:
+            return self._make_dataloader(
+                monitor.ProfiledDataset(self.ds_train, self.data_timings), True,
+                collate_fn=monitor.ProfiledCollate(self.collate_fn, self.data_timings),
+                lengths=lengths)
+
+        return self._make_dataloader(self.ds_train, True, collate_fn=self.collate_fn, lengths=lengths)
 
     def val_dataloader(self):
-        return self._make_dataloader(self.ds_test, False)
+        return self._make_dataloader(self.ds_test, False, collate_fn=self.collate_fn, lengths=self._lengths(self.ds_test))
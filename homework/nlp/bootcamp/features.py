@@ -0,0 +1,270 @@
+"""Training classification heads on cached features of a frozen encoder.
+
+Many experiments only change the classification head or its hyperparameters, yet fine-tuning
+runs full forward and backward passes through the encoder at every step. Instead, `prepare_features`
+runs the frozen pretrained encoder once over the tokenized subsets, and stores the features of each
+review in a memory-mapped float16 array: either the pooled output (`pooling='pooled'`), which the
+classifier of `PretrainedBertModel` uses, or the output at the [CLS] token of every layer
+(`pooling='layers'`). `FeatureHeadModel` then trains a classification head on the cached features,
+which takes seconds instead of hours.
+
+The features are cached next to the tokenized subsets, keyed by the tokenized subsets, the encoder
+and the pooling, so that later runs only train the head.
+
+"""
+
+import hashlib
+import json
+import os
+from typing import Optional
+
+import datasets
+import hydra
+import numpy as np
+import pytorch_lightning
+import torch
+import torch.utils.data
+import torchmetrics
+from transformers import AutoModel
+
+from . import batching, dataset
+
+from ._config import FeatureHeadConfig
+
+
+POOLINGS = ('pooled', 'layers')
+
+# Increment when changing the contents of the cache, to invalidate existing caches
+_CACHE_VERSION = 1
+
+
+def feature_cache_path(tokenized_path: str, model_name: str, pooling: str) -> str:
+    """Path of the cached features of the tokenized subsets at the given path."""
+    if os.path.isdir(model_name):
+        # Local models are identified by their location
+        model_name = os.path.abspath(model_name)
+
+    key = json.dumps({
+        'tokenized': os.path.basename(tokenized_path),
+        'model': model_name,
+        'pooling': pooling,
+        'version': _CACHE_VERSION,
+    }, sort_keys=True)
+
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(tokenized_path), f'features-{digest}')
+
+
+def _encode(encoder: torch.nn.Module, batch, pooling: str) -> torch.Tensor:
+    outputs = encoder(**batch, output_hidden_states=pooling == 'layers')
+
+    if pooling == 'pooled':
+        return outputs.pooler_output
+
+    return torch.stack([h[:, 0] for h in outputs.hidden_states], dim=1)
+
+
+def extract_features(encoder: torch.nn.Module, ds: datasets.Dataset, path: str, pooling: str='pooled',
+                     batch_size: int=64, device: Optional[torch.device]=None):
+    """Runs the encoder over the given reviews, and saves their features and labels in the given directory.
+
+    Reviews are encoded by increasing length, so that batches contain little padding.
+
+    Parameters
+    ----------
+    encoder : torch.nn.Module
+        The pretrained encoder, e.g. a `BertModel`.
+    ds : datasets.Dataset
+        Unpadded tokenized reviews, with a `length` column (see `load_tokenized`).
+    path : str
+        Directory in which to save the features (`features.npy`) and the labels (`labels.npy`).
+    pooling : str
+        `pooled` to save the pooled output, of shape `[reviews, hidden]`, or `layers` to save the output
+        at the [CLS] token of the embeddings and of every layer, of shape `[reviews, layers + 1, hidden]`.
+    batch_size : int
+        Number of reviews encoded at once.
+    device : torch.device, optional
+        Device on which to run the encoder, by default the device of the encoder.
+    """
+    if pooling not in POOLINGS:
+        raise ValueError(f'Unknown pooling {pooling}, expected one of {POOLINGS}')
+
+    config = encoder.config
+    shape = (len(ds), config.hidden_size)
+    if pooling == 'layers':
+        shape = (len(ds), config.num_hidden_layers + 1, config.hidden_size)
+
+    if device is not None:
+        encoder = encoder.to(device)
+    device = next(encoder.parameters()).device
+    encoder.eval()
+
+    os.makedirs(path, exist_ok=True)
+    features = np.lib.format.open_memmap(os.path.join(path, 'features.npy'), mode='w+', dtype=np.float16, shape=shape)
+
+    lengths = ds.with_format('numpy', columns=['length'])['length']
+    order = np.argsort(lengths, kind='stable')
+
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            batch = batching.pad_collate([ds[int(i)] for i in indices], config.pad_token_id or 0)
+            batch.pop('labels', None)
+            batch = {k: v.to(device) for k, v in batch.items()}
+
+            features[indices] = _encode(encoder, batch, pooling).cpu().numpy()
+
+    features.flush()
+    np.save(os.path.join(path, 'labels.npy'), ds.with_format('numpy', columns=['labels'])['labels'])
+
+
+def prepare_features(model_name: str, ds: datasets.DatasetDict, path: str, pooling: str='pooled',
+                     batch_size: int=64, device: Optional[torch.device]=None) -> str:
+    """Extracts the features of each split of the given subsets into the cache, if they are not already cached.
+
+    See `extract_features` for the parameters. The encoder is only loaded if the features are not cached.
+    """
+    if os.path.exists(path):
+        return path
+
+    encoder = AutoModel.from_pretrained(model_name)
+
+    def write(tmp_path: str):
+        for split in ds:
+            extract_features(encoder, ds[split], os.path.join(tmp_path, split), pooling, batch_size, device)
+
+    dataset.write_atomically(path, write)
+    return path
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """Dataset of cached features and labels, memory-mapped from the directory created by `extract_features`."""
+
+    def __init__(self, path: str):
+        self.features = np.load(os.path.join(path, 'features.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.features[idx].astype(np.float32)), int(self.labels[idx])
+
+
+class FeatureHeadModel(pytorch_lightning.LightningModule):
+    """Classification head trained on cached features.
+
+    For pooled features, the head is the classifier of `PretrainedBertModel` (dropout and linear layer).
+    For per-layer features, the [CLS] outputs of the layers are first combined with learned
+    softmax-normalized weights, and passed through a pooler (linear layer and tanh) as in BERT.
+
+    Parameters
+    ----------
+    hidden_size : int
+        Size of the features.
+    num_layers : int, optional
+        Number of layers of per-layer features, or `None` for pooled features.
+    num_labels : int
+        Number of classes.
+    learning_rate : float
+        Learning rate of AdamW.
+    weight_decay : float
+        Weight decay of AdamW.
+    dropout : float
+        Dropout probability before the classifier.
+    """
+
+    def __init__(self, hidden_size: int, num_layers: Optional[int] = None, num_labels: int = 5,
+                 learning_rate: float = 1e-3, weight_decay: float = 0.01, dropout: float = 0.1):
+        super().__init__()
+        self.save_hyperparameters()
+
+        if num_layers is not None:
+            self.layer_weights = torch.nn.Parameter(torch.zeros(num_layers))
+            self.pooler = torch.nn.Sequential(torch.nn.Linear(hidden_size, hidden_size), torch.nn.Tanh())
+        else:
+            self.layer_weights = None
+            self.pooler = None
+
+        self.dropout = torch.nn.Dropout(dropout)
+        self.classifier = torch.nn.Linear(hidden_size, num_labels)
+        # Separate metrics, as validation runs in the middle of a training epoch
+        self.train_accuracy = torchmetrics.Accuracy(num_classes=num_labels)
+        self.val_accuracy = torchmetrics.Accuracy(num_classes=num_labels)
+
+    def forward(self, features):
+        if self.layer_weights is not None:
+            features = torch.einsum('l,blh->bh', self.layer_weights.softmax(dim=0), features)
+            features = self.pooler(features)
+
+        return self.classifier(self.dropout(features))
+
+    def training_step(self, batch, batch_idx):
+        features, labels = batch
+        logits = self.forward(features)
+        loss = torch.nn.functional.cross_entropy(logits, labels)
+
+        self.train_accuracy(torch.argmax(logits, dim=-1), labels)
+
+        self.log("train/loss", loss)
+        self.log("train/accuracy", self.train_accuracy)
+
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        features, labels = batch
+        logits = self.forward(features)
+        loss = torch.nn.functional.cross_entropy(logits, labels)
+
+        self.val_accuracy(torch.argmax(logits, dim=-1), labels)
+
+        self.log("val/loss", loss)
+        self.log("val/accuracy", self.val_accuracy)
+
+        return loss
+
+    def configure_optimizers(self):
+        return torch.optim.AdamW(
+            self.parameters(), lr=self.hparams.learning_rate, weight_decay=self.hparams.weight_decay)
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: FeatureHeadConfig):
+    device = torch.device('cuda' if config.gpus > 0 else 'cpu')
+
+    tokenized_kwargs = dict(
+        tokenizer_name=config.model_name, max_length=config.max_length,
+        cache_dir=config.data_cache_dir, padding=False)
+    tokenized_path = dataset.prepare_tokenized(**tokenized_kwargs)
+    ds = dataset.load_tokenized(**tokenized_kwargs)
+
+    path = feature_cache_path(tokenized_path, config.model_name, config.pooling)
+    prepare_features(config.model_name, ds, path, config.pooling, config.extract_batch_size, device)
+
+    ds_train = FeatureDataset(os.path.join(path, 'train'))
+    ds_test = FeatureDataset(os.path.join(path, 'test'))
+
+    shape = ds_train.features.shape
+    head = FeatureHeadModel(
+        hidden_size=shape[-1],
+        num_layers=shape[1] if config.pooling == 'layers' else None,
+        learning_rate=config.learning_rate,
+        weight_decay=config.weight_decay,
+        dropout=config.dropout)
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='gpu' if config.gpus > 0 else 'cpu',
+        devices=config.gpus if config.gpus > 0 else None,
+        max_epochs=config.max_epochs)
+
+    trainer.fit(
+        head,
+        torch.utils.data.DataLoader(ds_train, batch_size=config.batch_size, shuffle=True, num_workers=config.num_workers),
+        torch.utils.data.DataLoader(ds_test, batch_size=config.batch_size, num_workers=config.num_workers))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=FeatureHeadConfig)
+    main()
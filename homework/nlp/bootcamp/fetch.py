@@ -0,0 +1,156 @@
+"""Batched fetching of tokenized reviews from arrow tables.
+
+By default, the dataloader fetches the samples of a batch one at a time: each review is converted from
+arrow to torch separately, and the reviews are then stacked (or padded) by the collate function.
+When the dataset implements `__getitems__`, the dataloader instead passes it the indices of the whole batch,
+as produced by the batch sampler. `ArrowBatchDataset` uses this to gather the batch from the arrow table
+in a single call, and to convert each column of the batch to a tensor at once: the values of the gathered
+column are viewed as a numpy array without copying, and reshaped (or scattered into a padded array) in a
+single vectorized operation, without creating python objects for each review.
+
+As the dataset returns complete batches, it must be used with `collate_fetched`, which returns them unchanged.
+
+The speed of both paths may be compared for several numbers of workers with
+```
+python -m bootcamp.fetch num_workers=[0,2,4] dynamic_padding=true
+```
+
+"""
+
+import time
+from typing import Dict, Optional, Sequence
+
+import hydra
+import numpy as np
+import pyarrow
+import torch
+import torch.utils.data
+
+from ._config import FetchBenchmarkConfig
+
+
+def _list_column(column: pyarrow.ChunkedArray, pad_value: int, pad_to_multiple_of: Optional[int]):
+    """Converts a column of lists of integers to a padded int64 array, also returning the length of each list."""
+    array = column.combine_chunks()
+    offsets = array.offsets.to_numpy()
+    # Values of the lists in the (possibly sliced) array, viewed without copying
+    values = array.flatten().to_numpy()
+    lengths = np.diff(offsets)
+
+    length = int(lengths.max()) if len(lengths) > 0 else 0
+    if pad_to_multiple_of is not None:
+        length = (length + pad_to_multiple_of - 1) // pad_to_multiple_of * pad_to_multiple_of
+
+    if len(lengths) > 0 and (lengths == length).all():
+        # All lists have the padded length, as when reviews are stored padded
+        return values.astype(np.int64).reshape(len(lengths), length), lengths
+
+    padded = np.full((len(lengths), length), pad_value, dtype=np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1] - offsets[0], lengths)
+    padded[rows, cols] = values
+    return padded, lengths
+
+
+class ArrowBatchDataset(torch.utils.data.Dataset):
+    """Tokenized reviews, fetched a batch at a time from the underlying arrow table.
+
+    Batches have the same format as the default collation of padded reviews, or as `batching.pad_collate`
+    for unpadded reviews (stored with a `length` column): `input_ids`, `token_type_ids` and `attention_mask`
+    of shape `[batch, length]`, and `labels` of shape `[batch]`.
+
+    Parameters
+    ----------
+    ds : datasets.Dataset
+        Tokenized reviews (see `load_tokenized`).
+    pad_token_id : int
+        Id of the padding token, used for unpadded reviews.
+    pad_to_multiple_of : int, optional
+        For unpadded reviews, the padded length is rounded up to a multiple of this value.
+    """
+
+    def __init__(self, ds, pad_token_id: int=0, pad_to_multiple_of: Optional[int]=8):
+        self.ds = ds
+        # Arrow format view of the same table, which returns the gathered rows as an arrow table
+        self._table = ds.with_format('arrow')
+        self.pad_token_id = pad_token_id
+        self.padded = 'length' not in ds.column_names
+        self.pad_to_multiple_of = None if self.padded else pad_to_multiple_of
+
+    def __len__(self):
+        return len(self.ds)
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        return {k: v[0] for k, v in self.__getitems__([idx]).items()}
+
+    def __getitems__(self, indices: Sequence[int]) -> Dict[str, torch.Tensor]:
+        table = self._table[list(indices)]
+        input_ids, lengths = _list_column(table.column('input_ids'), self.pad_token_id, self.pad_to_multiple_of)
+        batch = {'input_ids': torch.from_numpy(input_ids)}
+
+        if 'token_type_ids' in table.column_names:
+            batch['token_type_ids'] = torch.from_numpy(
+                _list_column(table.column('token_type_ids'), 0, self.pad_to_multiple_of)[0])
+        else:
+            batch['token_type_ids'] = torch.zeros_like(batch['input_ids'])
+
+        if self.padded and 'attention_mask' in table.column_names:
+            batch['attention_mask'] = torch.from_numpy(_list_column(table.column('attention_mask'), 0, None)[0])
+        else:
+            batch['attention_mask'] = torch.from_numpy(
+                (np.arange(input_ids.shape[1]) < lengths[:, None]).astype(np.int64))
+
+        if 'labels' in table.column_names:
+            batch['labels'] = torch.from_numpy(table.column('labels').to_numpy().astype(np.int64))
+
+        return batch
+
+
+def collate_fetched(batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """Collate function for batches fetched by `ArrowBatchDataset`, which are already complete."""
+    return batch
+
+
+def benchmark_loader(loader: torch.utils.data.DataLoader, num_batches: int=100, warmup: int=5) -> Dict[str, float]:
+    """Measures the rate at which the given dataloader produces batches, excluding the first `warmup` batches."""
+    iterator = iter(loader)
+    num_fetched = 0
+    num_samples = 0
+
+    for _ in range(warmup):
+        next(iterator)
+
+    start = time.perf_counter()
+    for batch in iterator:
+        num_fetched += 1
+        num_samples += len(batch['labels'])
+        if num_fetched == num_batches:
+            break
+    elapsed = time.perf_counter() - start
+
+    return {'batches_per_sec': num_fetched / elapsed, 'samples_per_sec': num_samples / elapsed}
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: FetchBenchmarkConfig):
+    from . import dataset
+
+    for batched_fetch in (False, True):
+        for num_workers in config.num_workers:
+            dm = dataset.YelpDataModule(
+                batch_size=config.batch_size, num_workers=num_workers,
+                max_length=config.max_length, cache_dir=config.data_cache_dir,
+                dynamic_padding=config.dynamic_padding, batched_fetch=batched_fetch)
+            dm.prepare_data()
+            dm.setup()
+
+            result = benchmark_loader(dm.train_dataloader(), config.num_batches)
+            print(f'batched_fetch={batched_fetch}, num_workers={num_workers}: ' +
+                  ', '.join(f'{k}: {v:.1f}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=FetchBenchmarkConfig)
+    main()
@@ -7,18 +7,53 @@ import torchmetrics
 import transformers
 
 from transformers import AutoModelForSequenceClassification
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+from . import packing
 
 
 class PretrainedBertModel(pytorch_lightning.LightningModule):
-    def __init__(self):
+    def __init__(self, model_name: str = "bert-base-cased", gradient_checkpointing: bool = False):
         super().__init__()
+        self.save_hyperparameters()
 
-        self.model = AutoModelForSequenceClassification.from_pretrained("bert-base-cased", num_labels=5)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name, num_labels=5)
+        if gradient_checkpointing:
+            # Recompute the activations of each layer during the backward pass instead of storing them
+            self.model.gradient_checkpointing_enable()
         self.accuracy = torchmetrics.Accuracy(num_classes=5)
 
     def forward(self, batch):
+        if 'segment_ids' in batch:
+            return self._forward_packed(batch)
         return self.model(**batch)
 
+    def _forward_packed(self, batch):
+        """Classifies each review of a batch of packed rows (see `bootcamp.packing`)."""
+        bert = self.model.base_model
+
+        # Run the embeddings and encoder directly, as the model only expands 2-dimensional attention masks
+        # for scaled dot product attention, and would pool the first token of each row
+        attention_mask = bert.get_extended_attention_mask(
+            packing.segment_attention_mask(batch['segment_ids']), batch['input_ids'].shape)
+
+        hidden = bert.embeddings(
+            input_ids=batch['input_ids'],
+            token_type_ids=batch['token_type_ids'],
+            position_ids=batch['position_ids'])
+        hidden = bert.encoder(hidden, attention_mask=attention_mask).last_hidden_state
+
+        # Pool the output at the [CLS] token of each review, as the pooler does for the first token of a row
+        cls = hidden[batch['cls_index'][:, 0], batch['cls_index'][:, 1]]
+        pooled = bert.pooler(cls.unsqueeze(1))
+        logits = self.model.classifier(self.model.dropout(pooled))
+
+        loss = None
+        if 'labels' in batch:
+            loss = torch.nn.functional.cross_entropy(logits, batch['labels'])
+
+        return SequenceClassifierOutput(loss=loss, logits=logits)
+
     def training_step(self, batch, batch_idx):
         outputs = self.forward(batch)
         loss = outputs.loss
@@ -47,9 +82,10 @@ class PretrainedBertModel(pytorch_lightning.LightningModule):
 
     def configure_optimizers(self):
         optim = torch.optim.AdamW(self.parameters(), lr=5e-5)
+        # The number of optimizer steps, which accounts for gradient accumulation
         lr = transformers.get_scheduler(
             name="linear",
             optimizer=optim,
             num_warmup_steps=0,
             num_training_steps=self.trainer.estimated_stepping_batches)
-        return [optim], [lr]
+        return [optim], [{'scheduler': lr, 'interval': 'step'}]
@@ -0,0 +1,170 @@
+"""Sequence packing of tokenized reviews.
+
+Even with dynamic padding, a large fraction of the computation is spent on padding,
+as the lengths of reviews vary widely. Instead, several reviews may be concatenated into
+a single row of `max_length` tokens, so that almost every token slot contains real data.
+
+The reviews of each row are packed once, before training, by `pack_lengths`. Each review
+(segment) of a row keeps its own position ids, starting from zero, and may only attend to the
+tokens of the same segment, through the block-diagonal attention mask computed on the device
+from the segment ids of the tokens (see `segment_attention_mask`). The model then classifies each
+review from the output at its [CLS] token, whose location is given by `cls_index` in the batch.
+
+"""
+
+import bisect
+import copy
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def pack_lengths(lengths: Sequence[int], max_length: int) -> List[List[int]]:
+    """Packs sequences of the given lengths into rows of at most `max_length` tokens.
+
+    Sequences are placed by decreasing length in the row with the least remaining space
+    which can hold them (best-fit decreasing). Sequences of equal length are placed in
+    the order they are given.
+
+    Returns
+    -------
+    List[List[int]]
+        The indices of the sequences in each row.
+    """
+    lengths = np.asarray(lengths)
+
+    if len(lengths) > 0 and lengths.max() > max_length:
+        raise ValueError(f'Sequences of length {lengths.max()} do not fit in rows of length {max_length}')
+
+    rows = []
+    # Sorted (remaining space, row index) of the rows which may still hold a sequence
+    available = []
+
+    for idx in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[idx])
+        position = bisect.bisect_left(available, (length, -1))
+
+        if position < len(available):
+            space, row = available.pop(position)
+        else:
+            space, row = max_length, len(rows)
+            rows.append([])
+
+        rows[row].append(int(idx))
+        space -= length
+
+        if space > 0:
+            bisect.insort(available, (space, row))
+
+    return rows
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """Dataset of rows of packed reviews.
+
+    Each row is a dictionary with the following entries:
+
+    - `input_ids`, `token_type_ids`: the concatenated tokens of the reviews, padded to `max_length`.
+    - `position_ids`: the position of each token in its review.
+    - `segment_ids`: the index of the review of each token, starting from one, and zero for padding.
+    - `cls_positions`: the position of the first ([CLS]) token of each review in the row.
+    - `labels`: the label of each review, if present in the dataset.
+
+    Parameters
+    ----------
+    ds : torch.utils.data.Dataset
+        Dataset of unpadded tokenized reviews (see `load_tokenized`).
+    lengths : Sequence[int]
+        Length of each review of the dataset.
+    max_length : int
+        Length of the rows.
+    pad_token_id : int
+        Id of the padding token.
+    seed : int
+        Seed of the random order of the reviews before packing, which determines how reviews
+        of equal length are grouped.
+    """
+
+    def __init__(self, ds, lengths: Sequence[int], max_length: int, pad_token_id: int=0, seed: int=0):
+        self.ds = ds
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+
+        order = np.random.default_rng(seed).permutation(len(lengths))
+        rows = pack_lengths(np.asarray(lengths)[order], max_length)
+        self.rows = [order[row].tolist() for row in rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def select(self, indices: Sequence[int]) -> 'PackedDataset':
+        """Returns the dataset of the given rows, e.g. the shard of a process."""
+        selected = copy.copy(self)
+        selected.rows = [self.rows[i] for i in indices]
+        return selected
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        reviews = self.ds[self.rows[idx]]
+
+        input_ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.int64)
+        token_type_ids = torch.zeros(self.max_length, dtype=torch.int64)
+        position_ids = torch.zeros(self.max_length, dtype=torch.int64)
+        segment_ids = torch.zeros(self.max_length, dtype=torch.int64)
+        cls_positions = []
+
+        start = 0
+        for segment, ids in enumerate(reviews['input_ids'], start=1):
+            end = start + len(ids)
+            input_ids[start:end] = torch.as_tensor(ids)
+            if 'token_type_ids' in reviews:
+                token_type_ids[start:end] = torch.as_tensor(reviews['token_type_ids'][segment - 1])
+            position_ids[start:end] = torch.arange(len(ids))
+            segment_ids[start:end] = segment
+            cls_positions.append(start)
+            start = end
+
+        row = {
+            'input_ids': input_ids,
+            'token_type_ids': token_type_ids,
+            'position_ids': position_ids,
+            'segment_ids': segment_ids,
+            'cls_positions': torch.as_tensor(cls_positions),
+        }
+
+        if 'labels' in reviews:
+            row['labels'] = torch.as_tensor(reviews['labels']).view(-1)
+
+        return row
+
+
+def packed_collate(rows: Sequence[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+    """Collates rows of a `PackedDataset`.
+
+    Returns
+    -------
+    Dict[str, torch.Tensor]
+        The batch, with `input_ids`, `token_type_ids`, `position_ids` and `segment_ids` of shape
+        `[batch, length]`, `cls_index` of shape `[reviews, 2]` giving the row and position of
+        the [CLS] token of each review, and `labels` of shape `[reviews]` if present in the rows.
+    """
+    batch = {k: torch.stack([r[k] for r in rows]) for k in ('input_ids', 'token_type_ids', 'position_ids', 'segment_ids')}
+
+    batch['cls_index'] = torch.cat([
+        torch.stack([torch.full_like(r['cls_positions'], i), r['cls_positions']], dim=1)
+        for i, r in enumerate(rows)])
+
+    if 'labels' in rows[0]:
+        batch['labels'] = torch.cat([r['labels'] for r in rows])
+
+    return batch
+
+
+def segment_attention_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """Computes the block-diagonal attention mask of shape `[batch, length, length]` from the segment ids.
+
+    Each token may only attend to the tokens of the same segment. Padding tokens attend to
+    each other, so that no row of the mask is empty, but are not attended to by other tokens.
+    """
+    return segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
@@ -0,0 +1,240 @@
+"""Int8 quantization and TorchScript export of the yelp classifier for CPU inference.
+
+This module converts the classifier of a `PretrainedBertModel` checkpoint for offline scoring
+on CPU (see `bootcamp.score`). The linear layers, which account for most of the computation of
+BERT, are quantized dynamically to int8: their weights are quantized ahead of time, and their
+activations on the fly, so that no calibration is required.
+
+The quantized classifier is then traced to TorchScript once for each length bucket, as the traced
+graph is specialized to the sequence length (but not to the batch size). Reviews are padded to the
+smallest bucket which holds them (see `BucketedClassifier`). The traced buckets are saved in a
+directory, together with a `buckets.json` file listing them.
+
+The exported classifier is compared to the original (eager, float32) classifier on the test subset,
+in terms of accuracy, agreement with the original predictions, throughput and latency.
+
+"""
+
+import copy
+import json
+import os
+import time
+from typing import Callable, Dict, Iterable, Sequence, Tuple
+
+import hydra
+import numpy as np
+import torch
+import torch.ao.quantization
+from transformers import AutoTokenizer
+
+from . import dataset
+
+from ._config import ExportConfig
+
+
+class Classifier(torch.nn.Module):
+    """Wraps a sequence classification model, to take `input_ids` and `attention_mask` tensors and return the logits."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask,
+            token_type_ids=torch.zeros_like(input_ids), return_dict=False)[0]
+
+
+def quantize_dynamic(model: torch.nn.Module) -> torch.nn.Module:
+    """Quantizes the linear layers of the given model to int8 (weights ahead of time, activations dynamically).
+
+    The given model is not modified.
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def trace_buckets(classifier: torch.nn.Module, buckets: Sequence[int]) -> Dict[int, torch.jit.ScriptModule]:
+    """Traces the given classifier for each of the given sequence lengths.
+
+    The traced modules accept any batch size.
+    """
+    classifier.eval()
+    traced = {}
+
+    with torch.inference_mode():
+        for length in sorted(buckets):
+            example = (torch.zeros(2, length, dtype=torch.int64), torch.ones(2, length, dtype=torch.int64))
+            traced[length] = torch.jit.freeze(torch.jit.trace(classifier, example))
+
+    return traced
+
+
+def save_buckets(traced: Dict[int, torch.jit.ScriptModule], path: str):
+    """Saves the traced buckets in the given directory."""
+    os.makedirs(path, exist_ok=True)
+
+    for length, module in traced.items():
+        torch.jit.save(module, os.path.join(path, f'bucket_{length}.pt'))
+
+    with open(os.path.join(path, 'buckets.json'), 'w') as f:
+        json.dump({'buckets': sorted(traced)}, f)
+
+
+def load_buckets(path: str) -> Dict[int, torch.jit.ScriptModule]:
+    """Loads the traced buckets saved by `save_buckets`."""
+    with open(os.path.join(path, 'buckets.json')) as f:
+        buckets = json.load(f)['buckets']
+
+    return {length: torch.jit.load(os.path.join(path, f'bucket_{length}.pt')) for length in buckets}
+
+
+class BucketedClassifier:
+    """Classifies batches of unpadded reviews, padding each review to the smallest bucket which holds it.
+
+    Parameters
+    ----------
+    classifiers : Dict[int, Callable]
+        Classifier for each bucket length, taking `input_ids` and `attention_mask` and returning the logits.
+        The same classifier may be used for all lengths, e.g. when running in eager mode.
+    pad_token_id : int
+        Id of the padding token.
+    max_batch_size : int
+        Maximum number of reviews run at once.
+    """
+
+    def __init__(self, classifiers: Dict[int, Callable], pad_token_id: int=0, max_batch_size: int=64):
+        self.classifiers = classifiers
+        self.buckets = sorted(classifiers)
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+
+    def bucket(self, length: int) -> int:
+        """Length of the bucket holding reviews of the given length."""
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        raise ValueError(f'Review of length {length} exceeds the largest bucket {self.buckets[-1]}')
+
+    def batches(self, input_ids: Sequence[Sequence[int]]) -> Iterable[Tuple[np.ndarray, int]]:
+        """Groups the given reviews into batches, yielding the indices of the reviews in each batch and its length."""
+        lengths = np.array([len(ids) for ids in input_ids])
+        buckets = np.array([self.bucket(n) for n in lengths])
+
+        for bucket in self.buckets:
+            indices = np.flatnonzero(buckets == bucket)
+            for start in range(0, len(indices), self.max_batch_size):
+                yield indices[start:start + self.max_batch_size], bucket
+
+    def run(self, input_ids: Sequence[Sequence[int]], length: int) -> torch.Tensor:
+        """Runs the classifier of the given bucket on the given reviews, returning the logits."""
+        ids = torch.full((len(input_ids), length), self.pad_token_id, dtype=torch.int64)
+        mask = torch.zeros((len(input_ids), length), dtype=torch.int64)
+
+        for i, review in enumerate(input_ids):
+            ids[i, :len(review)] = torch.as_tensor(review)
+            mask[i, :len(review)] = 1
+
+        with torch.inference_mode():
+            return self.classifiers[length](ids, mask).float()
+
+    def __call__(self, input_ids: Sequence[Sequence[int]]) -> torch.Tensor:
+        """Returns the logits of the given reviews, in order."""
+        logits = [None] * len(input_ids)
+
+        for indices, length in self.batches(input_ids):
+            for i, l in zip(indices, self.run([input_ids[i] for i in indices], length)):
+                logits[i] = l
+
+        return torch.stack(logits)
+
+
+def evaluate(classifier: BucketedClassifier, input_ids: Sequence[Sequence[int]], labels: Sequence[int]) -> Tuple[Dict[str, float], np.ndarray]:
+    """Measures the accuracy, throughput and batch latency of the given classifier.
+
+    Returns
+    -------
+    Dict[str, float]
+        The accuracy, the throughput in reviews per second, and percentiles of the latency of each batch in milliseconds.
+    np.ndarray
+        The predicted labels.
+    """
+    predictions = np.zeros(len(input_ids), dtype=np.int64)
+    latencies = []
+    start = time.perf_counter()
+
+    for indices, length in classifier.batches(input_ids):
+        batch_start = time.perf_counter()
+        logits = classifier.run([input_ids[i] for i in indices], length)
+        latencies.append(time.perf_counter() - batch_start)
+        predictions[indices] = logits.argmax(dim=-1).numpy()
+
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+
+    report = {
+        'accuracy': float(np.mean(predictions == np.asarray(labels))),
+        'reviews_per_sec': len(input_ids) / elapsed,
+        'batch_latency_p50_ms': float(np.percentile(latencies, 50)),
+        'batch_latency_p99_ms': float(np.percentile(latencies, 99)),
+    }
+    return report, predictions
+
+
+def compare(classifiers: Dict[str, BucketedClassifier], input_ids: Sequence[Sequence[int]],
+            labels: Sequence[int], reference: str='eager_fp32') -> Dict[str, Dict[str, float]]:
+    """Evaluates each of the given classifiers, and reports the agreement of their predictions with the reference classifier."""
+    report = {}
+    predictions = {}
+
+    for name, classifier in classifiers.items():
+        report[name], predictions[name] = evaluate(classifier, input_ids, labels)
+
+    if reference in predictions:
+        for name in report:
+            report[name]['agreement'] = float(np.mean(predictions[name] == predictions[reference]))
+
+    return report
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: ExportConfig):
+    from .model import PretrainedBertModel
+
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    bert = PretrainedBertModel.load_from_checkpoint(hydra.utils.to_absolute_path(config.checkpoint), map_location='cpu')
+    classifier = Classifier(bert.model).eval()
+    quantized = quantize_dynamic(classifier)
+
+    traced = trace_buckets(quantized, config.length_buckets)
+    save_buckets(traced, hydra.utils.to_absolute_path(config.output))
+    print(f'Exported {len(traced)} buckets to {config.output}')
+
+    ds = dataset.load_tokenized(
+        config.model_name, max(config.length_buckets), cache_dir=config.data_cache_dir, padding=False)['test']
+    ds = ds.select(range(min(config.eval_size, len(ds))))
+    input_ids = [ids.tolist() for ids in ds['input_ids']]
+    labels = ds['labels'].tolist()
+
+    pad_token_id = AutoTokenizer.from_pretrained(config.model_name).pad_token_id
+    buckets = sorted(config.length_buckets)
+
+    def bucketed(classifiers):
+        return BucketedClassifier(classifiers, pad_token_id, config.max_batch_size)
+
+    report = compare({
+        'eager_fp32': bucketed({length: classifier for length in buckets}),
+        'eager_int8': bucketed({length: quantized for length in buckets}),
+        'traced_int8': bucketed(traced),
+    }, input_ids, labels)
+
+    for name, result in report.items():
+        print(f'{name}: ' + ', '.join(f'{k}: {v:.3f}' for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=ExportConfig)
+    main()
@@ -0,0 +1,101 @@
+"""Offline scoring of large review dumps on CPU.
+
+Reviews are read from a json lines or parquet file in chunks of `chunk_size` reviews, so that
+memory remains bounded regardless of the size of the file. Each chunk is tokenized at once, and
+classified by the traced buckets exported by `bootcamp.quantize`: reviews are grouped by length bucket
+into batches of at most `max_batch_size`. The predictions are written as json lines, in the order of
+the input file, with the index of the review (and its id, if `id_field` is set).
+
+"""
+
+import itertools
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import hydra
+import pyarrow.parquet
+import torch
+from transformers import AutoTokenizer
+
+from . import quantize
+
+from ._config import ScoreConfig
+
+
+def read_records(path: str, fields: List[str], chunk_size: int=1024) -> Iterator[Dict[str, List[Any]]]:
+    """Reads the given fields of the records of a json lines or parquet file, in chunks of at most `chunk_size` records.
+
+    Yields
+    ------
+    Dict[str, List[Any]]
+        The values of each field for the records of the chunk.
+    """
+    if path.endswith('.parquet'):
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=fields):
+            yield batch.to_pydict()
+        return
+
+    with open(path) as f:
+        while True:
+            lines = [line for line in itertools.islice(f, chunk_size) if line.strip()]
+            if not lines:
+                return
+
+            records = [json.loads(line) for line in lines]
+            yield {field: [r[field] for r in records] for field in fields}
+
+
+def score(classifier: quantize.BucketedClassifier, tokenizer, chunks: Iterator[Dict[str, List[Any]]], output,
+          text_field: str='text', id_field: Optional[str]=None) -> Dict[str, float]:
+    """Scores the reviews of the given chunks, writing the predictions to the given file as json lines.
+
+    Returns
+    -------
+    Dict[str, float]
+        The number of reviews scored and the throughput in reviews per second.
+    """
+    max_length = classifier.buckets[-1]
+    num_reviews = 0
+    start = time.perf_counter()
+
+    for chunk in chunks:
+        input_ids = tokenizer(chunk[text_field], truncation=True, max_length=max_length)['input_ids']
+        probs = classifier(input_ids).softmax(dim=-1)
+
+        for i, p in enumerate(probs):
+            result = {'index': num_reviews + i, 'stars': int(p.argmax()) + 1, 'probabilities': p.tolist()}
+            if id_field is not None:
+                result['id'] = chunk[id_field][i]
+            output.write(json.dumps(result) + '\n')
+
+        num_reviews += len(input_ids)
+
+    elapsed = time.perf_counter() - start
+    return {'reviews': num_reviews, 'reviews_per_sec': num_reviews / elapsed if elapsed > 0 else 0.0}
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: ScoreConfig):
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(config.model_name)
+    classifier = quantize.BucketedClassifier(
+        quantize.load_buckets(hydra.utils.to_absolute_path(config.model)),
+        tokenizer.pad_token_id, config.max_batch_size)
+
+    fields = [config.text_field] + ([config.id_field] if config.id_field is not None else [])
+    chunks = read_records(hydra.utils.to_absolute_path(config.input), fields, config.chunk_size)
+
+    with open(hydra.utils.to_absolute_path(config.output), 'w') as output:
+        report = score(classifier, tokenizer, chunks, output, config.text_field, config.id_field)
+
+    print(', '.join(f'{k}: {v:.1f}' for k, v in report.items()))
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=ScoreConfig)
+    main()
@@ -0,0 +1,315 @@
+"""HTTP inference server for yelp star predictions.
+
+The server loads a `PretrainedBertModel` and exposes the following endpoints:
+
+- `POST /predict`, with a json body `{"text": ...}` or `{"texts": [...]}`, returns the predicted
+  number of stars and the probability of each number of stars for each text.
+- `GET /metrics` returns the current queue depth, the number of requests and batches, the distribution
+  of batch sizes, and latency histograms and percentiles (see `monitor.StageTimings`).
+- `GET /health` returns `ok`, or fails with status 503 if batches are no longer being run.
+
+Incoming texts are tokenized in a thread pool (the fast tokenizers release the GIL), and queued
+by length bucket. A batch is run as soon as a bucket holds `max_batch_size` texts, or when the
+oldest text of the bucket has waited for `max_wait_ms`. Each batch is padded to the length of its
+bucket, so that texts of very different length are not batched together, and the model only
+sees a few distinct shapes. The model runs in a separate thread, so that requests keep being
+queued (and thus batched) while a batch is running.
+
+If the task forming and running the batches stops (when the server is stopped, or on an unexpected error),
+all texts which are waiting for a result fail, and new texts are rejected.
+
+"""
+
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import time
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import aiohttp.web
+import hydra
+import torch
+from transformers import AutoTokenizer
+
+from . import monitor
+
+from ._config import ServeConfig
+
+
+LATENCY_STAGES = ('tokenize', 'queue', 'inference', 'total')
+
+
+class _Request:
+    __slots__ = ('input_ids', 'future', 'arrival')
+
+    def __init__(self, input_ids: List[int], future: asyncio.Future, arrival: float):
+        self.input_ids = input_ids
+        self.future = future
+        self.arrival = arrival
+
+
+class InferenceServer:
+    """Dynamic batching of classification requests.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model taking a batch of `input_ids`, `token_type_ids` and `attention_mask`, and returning
+        outputs with `logits`, such as `PretrainedBertModel`.
+    tokenizer
+        Tokenizer of the model.
+    max_batch_size : int
+        Maximum number of texts in a batch.
+    max_wait_ms : float
+        Maximum time a text waits for its batch to fill up, in milliseconds.
+    length_buckets : Sequence[int]
+        Lengths to which batches are padded. Texts are truncated to the largest bucket.
+    tokenize_threads : int
+        Number of threads tokenizing texts.
+    """
+
+    def __init__(self, model: torch.nn.Module, tokenizer, max_batch_size: int=32, max_wait_ms: float=5.0,
+                 length_buckets: Sequence[int]=(64, 128, 256, 512), tokenize_threads: int=2):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.length_buckets = sorted(length_buckets)
+
+        self.timings = monitor.StageTimings(LATENCY_STAGES, max_workers=0, sample_every=1)
+        self.batch_sizes = collections.Counter()
+        self.num_requests = 0
+
+        self._tokenize_pool = concurrent.futures.ThreadPoolExecutor(tokenize_threads)
+        # A single thread runs the model, as batches are already parallelized by torch
+        self._model_pool = concurrent.futures.ThreadPoolExecutor(1)
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Dict[int, List[_Request]] = {b: [] for b in self.length_buckets}
+        # Futures of all texts waiting for a result, wherever they are in the batcher
+        self._waiting: Set[asyncio.Future] = set()
+        self._batcher: Optional[asyncio.Task] = None
+
+    def bucket(self, length: int) -> int:
+        """Length to which a text of the given length is padded."""
+        idx = bisect.bisect_left(self.length_buckets, length)
+        return self.length_buckets[min(idx, len(self.length_buckets) - 1)]
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of texts waiting to be run."""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + sum(len(p) for p in self._pending.values())
+
+    @property
+    def running(self) -> bool:
+        """Whether batches are being formed and run."""
+        return self._batcher is not None and not self._batcher.done()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # The batcher failed earlier, and the error was already raised to the waiting texts
+                pass
+            self._batcher = None
+
+        self._tokenize_pool.shutdown()
+        self._model_pool.shutdown()
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.tokenizer(text, truncation=True, max_length=self.length_buckets[-1])['input_ids']
+
+    async def predict(self, text: str) -> Dict[str, Any]:
+        """Predicts the number of stars of the given text."""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        input_ids = await loop.run_in_executor(self._tokenize_pool, self._tokenize, text)
+        arrival = time.perf_counter()
+        self.timings.record('tokenize', arrival - start)
+
+        if not self.running:
+            raise RuntimeError('The inference server is not running')
+
+        # Not awaited, so that the batcher cannot stop between the check and queueing the text
+        future = loop.create_future()
+        self._waiting.add(future)
+        future.add_done_callback(self._waiting.discard)
+        self._queue.put_nowait(_Request(input_ids, future, arrival))
+        self.num_requests += 1
+
+        result = await future
+        self.timings.record('total', time.perf_counter() - start)
+        return result
+
+    def _ready_buckets(self, now: float) -> List[int]:
+        return [
+            b for b, pending in self._pending.items()
+            if len(pending) >= self.max_batch_size or (pending and now - pending[0].arrival >= self.max_wait)]
+
+    def _next_deadline(self) -> Optional[float]:
+        arrivals = [pending[0].arrival for pending in self._pending.values() if pending]
+        return min(arrivals) + self.max_wait if arrivals else None
+
+    def _fail_waiting(self, error: BaseException):
+        """Fails all texts waiting for a result, and empties the queue and buckets."""
+        for pending in self._pending.values():
+            pending.clear()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+        for future in list(self._waiting):
+            if not future.done():
+                future.set_exception(error)
+
+    async def _run_batches(self):
+        try:
+            await self._batch_loop()
+        except BaseException as e:
+            # Otherwise, texts which are waiting would never receive a result
+            error = RuntimeError('The inference server has stopped')
+            error.__cause__ = e
+            self._fail_waiting(error)
+            raise
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(deadline - time.perf_counter(), 0)
+
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+                self._pending[self.bucket(len(request.input_ids))].append(request)
+            except asyncio.TimeoutError:
+                pass
+
+            # Queue all texts which are already available before forming batches
+            while not self._queue.empty():
+                request = self._queue.get_nowait()
+                self._pending[self.bucket(len(request.input_ids))].append(request)
+
+            for bucket in self._ready_buckets(time.perf_counter()):
+                batch = self._pending[bucket][:self.max_batch_size]
+                del self._pending[bucket][:self.max_batch_size]
+
+                start = time.perf_counter()
+                for request in batch:
+                    self.timings.record('queue', start - request.arrival)
+
+                try:
+                    results = await loop.run_in_executor(self._model_pool, self._run, batch, bucket)
+                except Exception as e:
+                    for request in batch:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+
+                self.timings.record('inference', time.perf_counter() - start)
+                self.batch_sizes[len(batch)] += 1
+
+                for request, result in zip(batch, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+
+    def _run(self, batch: Sequence[_Request], length: int) -> List[Dict[str, Any]]:
+        input_ids = torch.full((len(batch), length), self.tokenizer.pad_token_id, dtype=torch.int64)
+        attention_mask = torch.zeros((len(batch), length), dtype=torch.int64)
+
+        for i, request in enumerate(batch):
+            input_ids[i, :len(request.input_ids)] = torch.as_tensor(request.input_ids)
+            attention_mask[i, :len(request.input_ids)] = 1
+
+        inputs = {'input_ids': input_ids, 'token_type_ids': torch.zeros_like(input_ids), 'attention_mask': attention_mask}
+
+        with torch.inference_mode():
+            probs = self.model(inputs).logits.float().softmax(dim=-1)
+
+        # Labels are the number of stars minus one
+        return [{'stars': int(p.argmax()) + 1, 'probabilities': p.tolist()} for p in probs]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Current queue depth, request and batch counts, and latency statistics (in seconds)."""
+        return {
+            'queue_depth': self.queue_depth,
+            'requests': self.num_requests,
+            'batches': sum(self.batch_sizes.values()),
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'latency': self.timings.summary(),
+            'latency_histograms': self.timings.histograms(),
+        }
+
+
+def make_app(server: InferenceServer) -> aiohttp.web.Application:
+    """Creates the web application serving the given server, which is started and stopped with the application."""
+    async def predict(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        body = await request.json()
+
+        if 'texts' in body:
+            results = await asyncio.gather(*(server.predict(t) for t in body['texts']))
+            return aiohttp.web.json_response({'predictions': list(results)})
+        elif 'text' in body:
+            return aiohttp.web.json_response(await server.predict(body['text']))
+        else:
+            raise aiohttp.web.HTTPBadRequest(reason='Expected "text" or "texts"')
+
+    async def metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(server.metrics())
+
+    async def health(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        if not server.running:
+            raise aiohttp.web.HTTPServiceUnavailable(reason='Batches are not being run')
+        return aiohttp.web.Response(text='ok')
+
+    async def lifecycle(app):
+        await server.start()
+        yield
+        await server.stop()
+
+    app = aiohttp.web.Application()
+    app.add_routes([
+        aiohttp.web.post('/predict', predict),
+        aiohttp.web.get('/metrics', metrics),
+        aiohttp.web.get('/health', health),
+    ])
+    app.cleanup_ctx.append(lifecycle)
+    return app
+
+
+@hydra.main(config_name='conf', config_path=None)
+def main(config: ServeConfig):
+    from .model import PretrainedBertModel
+
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    if config.checkpoint is not None:
+        model = PretrainedBertModel.load_from_checkpoint(hydra.utils.to_absolute_path(config.checkpoint), map_location='cpu')
+    else:
+        model = PretrainedBertModel(config.model_name)
+
+    server = InferenceServer(
+        model, AutoTokenizer.from_pretrained(config.model_name),
+        max_batch_size=config.max_batch_size,
+        max_wait_ms=config.max_wait_ms,
+        length_buckets=config.length_buckets,
+        tokenize_threads=config.tokenize_threads)
+
+    aiohttp.web.run_app(make_app(server), host=config.host, port=config.port)
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store('conf', node=ServeConfig)
+    main()
@@ -1,8 +1,9 @@
 import hydra
 import pytorch_lightning
 import pytorch_lightning.callbacks
+from pytorch_lightning.utilities.rank_zero import rank_zero_info
 
-from . import dataset, model
+from . import dataset, distributed, model, monitor
 
 from ._config import BertFineTuningConfig
 
@@ -11,28 +12,53 @@ def main(config: BertFineTuningConfig):
     callbacks = [
         pytorch_lightning.callbacks.DeviceStatsMonitor(),
         pytorch_lightning.callbacks.LearningRateMonitor(log_momentum=True),
+        monitor.ThroughputMonitor(),
     ]
 
     trainer_kwargs = {}
 
+    num_processes = config.gpus if config.gpus > 0 else max(config.cpu_processes, 1)
+
     if config.gpus > 0:
         trainer_kwargs['accelerator'] = 'gpu'
         trainer_kwargs['devices'] = config.gpus
     else:
         trainer_kwargs['accelerator'] = 'cpu'
 
+        if num_processes > 1:
+            trainer_kwargs['devices'] = num_processes
+            trainer_kwargs['strategy'] = distributed.CPUDDPStrategy()
+
+    dm = dataset.YelpDataModule(
+        batch_size=config.batch_size // num_processes,
+        num_workers=4,
+        profile=config.profile_data,
+        max_length=config.max_length,
+        cache_dir=config.data_cache_dir,
+        dynamic_padding=config.dynamic_padding,
+        bucket_batches=config.bucket_batches,
+        sequence_packing=config.sequence_packing,
+        batched_fetch=config.batched_fetch)
+
+    if config.profile_data:
+        callbacks.append(monitor.DataPipelineMonitor(dm.data_timings))
+
     trainer_kwargs['callbacks'] = callbacks
     trainer_kwargs['max_epochs'] = config.max_epochs
     trainer_kwargs['precision'] = config.precision
+    trainer_kwargs['accumulate_grad_batches'] = config.accumulate_grad_batches
+    # Each process reads its own shard of the data, see `YelpDataModule`
+    trainer_kwargs['replace_sampler_ddp'] = False
 
     trainer = pytorch_lightning.Trainer(**trainer_kwargs)
 
-    dm = dataset.YelpDataModule(
-        batch_size=config.batch_size // max(config.gpus, 1),
-        num_workers=4)
-    dm.setup()
+    rank_zero_info(
+        f'Effective batch size: {config.batch_size * config.accumulate_grad_batches} '
+        f'({config.batch_size // num_processes} per process, {num_processes} processes, '
+        f'{config.accumulate_grad_batches} accumulated batches), precision: {config.precision}, '
+        f'gradient checkpointing: {config.gradient_checkpointing}')
 
-    mymodel = model.PretrainedBertModel()
+    mymodel = model.PretrainedBertModel(gradient_checkpointing=config.gradient_checkpointing)
     trainer.fit(mymodel, datamodule=dm)
 
 
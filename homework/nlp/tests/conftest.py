@@ -0,0 +1,46 @@
+import datasets
+import numpy as np
+import pytest
+import transformers
+
+
+_WORDS = ['the', 'food', 'was', 'great', 'bad', 'service', 'slow', 'friendly', 'place', 'again', 'never', 'good']
+
+
+@pytest.fixture(scope='session')
+def tokenizer_path(tmp_path_factory):
+    """Path to a small word-level BERT tokenizer, which does not require downloading a pretrained one."""
+    path = tmp_path_factory.mktemp('tokenizer')
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + _WORDS
+
+    with open(path / 'vocab.txt', 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+
+    transformers.BertTokenizerFast(str(path / 'vocab.txt'), do_lower_case=True).save_pretrained(str(path))
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def raw_yelp():
+    """A small stand-in for the raw yelp dataset, with reviews of varying length."""
+    rng = np.random.default_rng(0)
+
+    def make_split(n):
+        return datasets.Dataset.from_dict({
+            'label': [int(x) for x in rng.integers(0, 5, size=n)],
+            'text': [' '.join(rng.choice(_WORDS, size=rng.integers(1, 30))) for _ in range(n)],
+        })
+
+    return datasets.DatasetDict({'train': make_split(200), 'test': make_split(50)})
+
+
+@pytest.fixture(scope='session')
+def bert_path(tmp_path_factory):
+    """Path to a small randomly initialized BERT classifier, matching the vocabulary of `tokenizer_path`."""
+    path = tmp_path_factory.mktemp('bert')
+    config = transformers.BertConfig(
+        vocab_size=5 + len(_WORDS), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=64, max_position_embeddings=64, num_labels=5)
+
+    transformers.BertForSequenceClassification(config).save_pretrained(str(path))
+    return str(path)
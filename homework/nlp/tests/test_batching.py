@@ -0,0 +1,60 @@
+import torch
+import torch.utils.data
+
+from bootcamp import batching, dataset
+
+
+def test_pad_collate():
+    features = [
+        {'input_ids': torch.tensor([2, 5, 3]), 'token_type_ids': torch.zeros(3, dtype=torch.int64), 'labels': torch.tensor(1)},
+        {'input_ids': torch.tensor([2, 3]), 'token_type_ids': torch.zeros(2, dtype=torch.int64), 'labels': torch.tensor(4)},
+    ]
+
+    batch = batching.pad_collate(features, pad_to_multiple_of=4)
+
+    assert batch['input_ids'].tolist() == [[2, 5, 3, 0], [2, 3, 0, 0]]
+    assert batch['attention_mask'].tolist() == [[1, 1, 1, 0], [1, 1, 0, 0]]
+    assert batch['labels'].tolist() == [1, 4]
+
+
+def test_length_bucket_batch_sampler():
+    generator = torch.Generator().manual_seed(0)
+    lengths = torch.randint(1, 500, (1000,), generator=generator).tolist()
+
+    sampler = batching.LengthBucketBatchSampler(
+        torch.utils.data.RandomSampler(range(1000), generator=generator), lengths, batch_size=16, bucket_batches=8)
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler) == 63
+    assert sorted(i for b in batches for i in b) == list(range(1000))
+
+    def padded_length(batches):
+        return sum(max(lengths[i] for i in b) * len(b) for b in batches)
+
+    # Batches contain reviews of similar length, so padding is greatly reduced
+    unbucketed = batching.LengthBucketBatchSampler(range(1000), lengths, batch_size=16, bucket_batches=1)
+    assert sum(lengths) / padded_length(batches) > 0.85
+    assert sum(lengths) / padded_length(unbucketed) < 0.6
+
+    # The order changes between epochs
+    assert list(sampler) != batches
+
+
+def test_datamodule_dynamic_padding(tmp_path, tokenizer_path, raw_yelp):
+    # Populate the cache from the stand-in dataset
+    dataset.load_tokenized(
+        tokenizer_path, max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path), padding=False, raw=raw_yelp)
+
+    dm = dataset.YelpDataModule(
+        batch_size=8, num_workers=0, tokenizer_name=tokenizer_path, max_length=32,
+        train_size=64, test_size=16, cache_dir=str(tmp_path), dynamic_padding=True, bucket_batches=4)
+    dm.setup()
+
+    batches = list(dm.train_dataloader())
+    assert sum(len(b['labels']) for b in batches) == 64
+    assert all(b['input_ids'].shape[1] <= 32 for b in batches)
+    assert 'length' not in batches[0]
+
+    for b in batches:
+        lengths = b['attention_mask'].sum(dim=1)
+        assert b['input_ids'].shape[1] == (int(lengths.max()) + 7) // 8 * 8
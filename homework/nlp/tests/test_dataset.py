@@ -0,0 +1,47 @@
+import types
+
+from bootcamp import dataset
+
+
+def test_load_tokenized_caches_subsets(tmp_path, tokenizer_path, raw_yelp):
+    kwargs = dict(max_length=32, seed=1, train_size=40, test_size=10, cache_dir=str(tmp_path))
+
+    ds = dataset.load_tokenized(tokenizer_path, raw=raw_yelp, **kwargs)
+    assert len(ds['train']) == 40
+    assert len(ds['test']) == 10
+    assert ds['train'][0]['input_ids'].shape == (32,)
+    assert set(ds['train'].column_names) == {'labels', 'input_ids', 'token_type_ids', 'attention_mask'}
+
+    # The selected subset follows the seed
+    expected = raw_yelp['train'].shuffle(seed=1).select(range(40))['label']
+    assert ds['train']['labels'].tolist() == expected
+
+    # Later calls read the cache, without requiring the raw dataset
+    cached = dataset.load_tokenized(tokenizer_path, **kwargs)
+    assert cached['train']['input_ids'].tolist() == ds['train']['input_ids'].tolist()
+
+    # Different parameters use a different cache
+    assert dataset.cache_path(str(tmp_path), tokenizer_path, 64, 1, 40, 10) != dataset.cache_path(
+        str(tmp_path), tokenizer_path, 32, 1, 40, 10)
+
+
+def test_datamodule_shards(tmp_path, tokenizer_path, raw_yelp):
+    kwargs = dict(max_length=32, train_size=63, test_size=16, cache_dir=str(tmp_path))
+    dataset.prepare_tokenized(tokenizer_path, raw=raw_yelp, **kwargs)
+
+    shards = []
+    for rank in range(2):
+        dm = dataset.YelpDataModule(batch_size=8, num_workers=0, tokenizer_name=tokenizer_path, **kwargs)
+        dm.trainer = types.SimpleNamespace(world_size=2, global_rank=rank)
+        # The subsets are already cached, so that preparing the data does not require the raw dataset
+        dm.prepare_data()
+        dm.setup()
+
+        # Each shard is a slice of the memory-mapped table, without an indices mapping
+        assert dm.ds_train._indices is None
+        shards.append(dm.ds_train['labels'].tolist())
+
+    assert len(shards[0]) == len(shards[1]) == 31
+
+    full = dataset.load_tokenized(tokenizer_path, **kwargs)['train']['labels'].tolist()
+    assert shards[0] + shards[1] == full[:62]
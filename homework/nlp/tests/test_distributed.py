@@ -0,0 +1,12 @@
+from bootcamp import distributed
+
+
+def test_rank_cores_partition():
+    cores = [0, 1, 2, 3, 8, 9, 10, 11, 12, 13]
+    assignments = [distributed.rank_cores(rank, 3, cores) for rank in range(3)]
+
+    assert assignments == [[0, 1, 2], [3, 8, 9], [10, 11, 12, 13]]
+
+
+def test_rank_cores_oversubscribed():
+    assert [distributed.rank_cores(rank, 3, [4, 5]) for rank in range(3)] == [[4], [5], [4]]
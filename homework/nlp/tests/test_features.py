@@ -0,0 +1,63 @@
+import numpy as np
+import pytorch_lightning
+import torch
+import torch.utils.data
+from transformers import AutoModel
+
+from bootcamp import batching, dataset, features
+
+
+def _extract(tmp_path, tokenizer_path, bert_path, raw_yelp, pooling):
+    kwargs = dict(max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path), padding=False)
+    tokenized_path = dataset.prepare_tokenized(tokenizer_path, raw=raw_yelp, **kwargs)
+    ds = dataset.load_tokenized(tokenizer_path, **kwargs)
+
+    path = features.feature_cache_path(tokenized_path, bert_path, pooling)
+    features.prepare_features(bert_path, ds, path, pooling, batch_size=16)
+    return ds, path
+
+
+def test_extract_features(tmp_path, tokenizer_path, bert_path, raw_yelp):
+    ds, path = _extract(tmp_path, tokenizer_path, bert_path, raw_yelp, 'pooled')
+
+    train = features.FeatureDataset(f'{path}/train')
+    assert train.features.dtype == np.float16
+    assert train.features.shape == (64, 32)
+    assert train.labels.tolist() == ds['train']['labels'].tolist()
+
+    # Features are stored in the order of the reviews, although they are encoded by length
+    encoder = AutoModel.from_pretrained(bert_path).eval()
+    with torch.no_grad():
+        for i in (0, 17, 63):
+            batch = batching.pad_collate([ds['train'][i]])
+            batch.pop('labels')
+            expected = encoder(**batch).pooler_output[0]
+            torch.testing.assert_close(train[i][0], expected, atol=2e-3, rtol=1e-2)
+
+    layers = features.FeatureDataset(f'{_extract(tmp_path, tokenizer_path, bert_path, raw_yelp, "layers")[1]}/test')
+    assert layers.features.shape == (16, 3, 32)
+
+
+def test_train_head(tmp_path, tokenizer_path, bert_path, raw_yelp):
+    _, path = _extract(tmp_path, tokenizer_path, bert_path, raw_yelp, 'layers')
+
+    train = features.FeatureDataset(f'{path}/train')
+    head = features.FeatureHeadModel(hidden_size=32, num_layers=3, learning_rate=1e-2)
+
+    trainer = pytorch_lightning.Trainer(
+        max_epochs=2, accelerator='cpu', logger=False, enable_checkpointing=False, enable_progress_bar=False)
+    trainer.fit(
+        head,
+        torch.utils.data.DataLoader(train, batch_size=16, shuffle=True),
+        torch.utils.data.DataLoader(features.FeatureDataset(f'{path}/test'), batch_size=16))
+
+    assert trainer.global_step == 8
+    assert torch.isfinite(trainer.callback_metrics['val/loss'])
+
+    # Only the validation samples are counted in the validation accuracy
+    test = features.FeatureDataset(f'{path}/test')
+    head.eval()
+    with torch.no_grad():
+        predictions = head(torch.from_numpy(test.features.astype(np.float32))).argmax(dim=-1)
+    expected = (predictions == torch.from_numpy(test.labels.astype(np.int64))).float().mean()
+    torch.testing.assert_close(trainer.callback_metrics['val/accuracy'], expected)
@@ -0,0 +1,44 @@
+import pytest
+import torch
+import torch.utils.data
+
+from bootcamp import dataset, fetch
+
+
+@pytest.mark.parametrize('dynamic_padding', [False, True])
+def test_batched_fetch_matches_rows(tmp_path, tokenizer_path, raw_yelp, dynamic_padding):
+    kwargs = dict(max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path))
+    dataset.prepare_tokenized(tokenizer_path, padding=not dynamic_padding, raw=raw_yelp, **kwargs)
+
+    def batches(batched_fetch):
+        dm = dataset.YelpDataModule(
+            batch_size=8, num_workers=0, tokenizer_name=tokenizer_path, dynamic_padding=dynamic_padding,
+            batched_fetch=batched_fetch, **kwargs)
+        dm.setup()
+        return list(dm.val_dataloader())
+
+    expected = batches(False)
+    fetched = batches(True)
+    assert len(fetched) == len(expected) == 2
+
+    for b, e in zip(fetched, expected):
+        assert b.keys() == e.keys()
+        for k in e:
+            assert b[k].dtype == e[k].dtype
+            assert torch.equal(b[k], e[k]), k
+
+
+def test_arrow_batch_dataset_in_workers(tmp_path, tokenizer_path, raw_yelp):
+    kwargs = dict(max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path))
+    ds = dataset.load_tokenized(tokenizer_path, padding=False, raw=raw_yelp, **kwargs)['train']
+
+    loader = torch.utils.data.DataLoader(
+        fetch.ArrowBatchDataset(ds), batch_size=16, shuffle=True, num_workers=2, collate_fn=fetch.collate_fetched)
+    batches = list(loader)
+
+    assert sum(len(b['labels']) for b in batches) == 64
+    assert sorted(torch.cat([b['labels'] for b in batches]).tolist()) == sorted(ds['labels'].tolist())
+    assert all(b['input_ids'].shape[1] % 8 == 0 for b in batches)
+
+    result = fetch.benchmark_loader(loader, num_batches=2, warmup=1)
+    assert result['samples_per_sec'] > 0
@@ -0,0 +1,25 @@
+import pytorch_lightning
+import torch
+
+from bootcamp import dataset, model
+
+
+def test_schedule_with_accumulation(tmp_path, tokenizer_path, bert_path, raw_yelp):
+    kwargs = dict(max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path))
+    dataset.prepare_tokenized(tokenizer_path, padding=False, raw=raw_yelp, **kwargs)
+
+    dm = dataset.YelpDataModule(batch_size=8, num_workers=0, tokenizer_name=tokenizer_path, dynamic_padding=True, **kwargs)
+    bert = model.PretrainedBertModel(bert_path, gradient_checkpointing=True)
+    assert bert.model.bert.encoder.gradient_checkpointing
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', max_epochs=2, accumulate_grad_batches=4, precision='bf16', limit_val_batches=0,
+        logger=False, enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(bert, datamodule=dm)
+
+    # 8 batches per epoch, accumulated in groups of 4, so that the linear schedule ends after 4 steps
+    assert trainer.global_step == 4
+    scheduler = trainer.lr_scheduler_configs[0].scheduler
+    assert scheduler.last_epoch == 4
+    assert trainer.optimizers[0].param_groups[0]['lr'] == 0
+    assert all(torch.isfinite(p).all() for p in bert.parameters())
@@ -0,0 +1,73 @@
+import pytorch_lightning
+import torch
+import torch.utils.data
+
+from bootcamp import monitor
+
+
+class _TokenDataset(torch.utils.data.Dataset):
+    def __len__(self):
+        return 16
+
+    def __getitem__(self, idx):
+        mask = torch.zeros(10, dtype=torch.int64)
+        mask[:idx % 10 + 1] = 1
+        return {'input_ids': torch.randint(0, 20, (10,)), 'attention_mask': mask, 'labels': idx % 2}
+
+
+class _BagOfWordsModel(pytorch_lightning.LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.EmbeddingBag(20, 2)
+
+    def training_step(self, batch, *_):
+        logits = self.embedding(batch['input_ids'], per_sample_weights=None)
+        return torch.nn.functional.cross_entropy(logits, batch['labels'])
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def test_throughput_monitor_counts_tokens():
+    throughput = monitor.ThroughputMonitor()
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', max_epochs=1, callbacks=[throughput], logger=False,
+        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(_BagOfWordsModel(), torch.utils.data.DataLoader(_TokenDataset(), batch_size=4))
+
+    summary = throughput.epoch_summaries[-1]
+    assert throughput._num_tokens == sum(i % 10 + 1 for i in range(16))
+    assert summary['tokens_per_sec'] > summary['samples_per_sec']
+    assert summary['peak_memory_mb'] > 0
+
+
+def test_profiled_arrow_dataset():
+    import datasets
+
+    ds = datasets.Dataset.from_dict({'input_ids': [[i] * 4 for i in range(12)], 'labels': [i % 5 for i in range(12)]})
+    ds.set_format('torch')
+
+    timings = monitor.StageTimings(['getitem', 'collate'], max_workers=1, sample_every=3)
+    dataloader = torch.utils.data.DataLoader(
+        monitor.ProfiledDataset(ds, timings), batch_size=4, num_workers=1,
+        collate_fn=monitor.ProfiledCollate(None, timings))
+
+    batches = list(dataloader)
+    assert batches[0]['input_ids'].shape == (4, 4)
+
+    summary = timings.summary()
+    assert summary['getitem']['count'] == 4
+    assert summary['collate']['count'] == 1
+
+
+def test_throughput_monitor_token_fraction():
+    throughput = monitor.ThroughputMonitor()
+
+    trainer = pytorch_lightning.Trainer(
+        accelerator='cpu', max_epochs=1, callbacks=[throughput], logger=False,
+        enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False)
+    trainer.fit(_BagOfWordsModel(), torch.utils.data.DataLoader(_TokenDataset(), batch_size=4))
+
+    expected = sum(i % 10 + 1 for i in range(16)) / (16 * 10)
+    assert abs(throughput.epoch_summaries[-1]['token_fraction'] - expected) < 1e-6
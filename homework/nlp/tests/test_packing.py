@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from bootcamp import dataset, model, packing
+
+
+def test_pack_lengths():
+    lengths = np.random.default_rng(0).integers(1, 200, size=1000)
+    rows = packing.pack_lengths(lengths, 512)
+
+    assert sorted(i for r in rows for i in r) == list(range(1000))
+    assert all(sum(lengths[r]) <= 512 for r in rows)
+
+    # Almost every token slot is filled
+    assert lengths.sum() / (512 * len(rows)) > 0.95
+
+
+def test_packed_dataset():
+    ds = [{'input_ids': [2, 5, 3], 'labels': 1}, {'input_ids': [2, 6, 7, 8, 3], 'labels': 4}, {'input_ids': [2, 3], 'labels': 0}]
+
+    class Dataset:
+        def __getitem__(self, indices):
+            return {k: [ds[i][k] for i in indices] for k in ('input_ids', 'labels')}
+
+    packed = packing.PackedDataset(Dataset(), [3, 5, 2], max_length=8)
+    assert len(packed) == 2
+
+    batch = packing.packed_collate([packed[i] for i in range(len(packed))])
+    assert batch['input_ids'].shape == (2, 8)
+    assert sorted(batch['labels'].tolist()) == [0, 1, 4]
+
+    for (row, position), label in zip(batch['cls_index'].tolist(), batch['labels'].tolist()):
+        assert batch['input_ids'][row, position] == 2
+        assert batch['position_ids'][row, position] == 0
+
+        segment = batch['segment_ids'][row, position]
+        length = int((batch['segment_ids'][row] == segment).sum())
+        review = next(r for r in ds if r['labels'] == label)
+        assert batch['input_ids'][row, position:position + length].tolist() == review['input_ids']
+
+        # Each review only attends to its own tokens
+        mask = packing.segment_attention_mask(batch['segment_ids'])
+        assert mask[row, position].nonzero().flatten().tolist() == list(range(position, position + length))
+
+
+def test_packed_forward_matches_unpacked(tmp_path, tokenizer_path, bert_path, raw_yelp):
+    dataset.load_tokenized(
+        tokenizer_path, max_length=32, train_size=64, test_size=16, cache_dir=str(tmp_path), padding=False, raw=raw_yelp)
+
+    dm = dataset.YelpDataModule(
+        batch_size=4, num_workers=0, tokenizer_name=tokenizer_path, max_length=32,
+        train_size=64, test_size=16, cache_dir=str(tmp_path), sequence_packing=True)
+    dm.setup()
+
+    batches = list(dm.train_dataloader())
+    assert sum(len(b['labels']) for b in batches) == 64
+
+    # Rows hold several reviews on average
+    assert sum(len(b['labels']) for b in batches) > sum(len(b['input_ids']) for b in batches)
+
+    batch = max(batches, key=lambda b: len(b['labels']))
+
+    bert = model.PretrainedBertModel(bert_path).eval()
+
+    with torch.no_grad():
+        packed = bert(batch)
+        assert packed.logits.shape == (len(batch['labels']), 5)
+        assert torch.isfinite(packed.loss)
+
+        for (row, position), logits in zip(batch['cls_index'].tolist(), packed.logits):
+            segment = batch['segment_ids'][row, position]
+            input_ids = batch['input_ids'][row][batch['segment_ids'][row] == segment]
+            single = bert.model(input_ids=input_ids.unsqueeze(0)).logits[0]
+            torch.testing.assert_close(logits, single, atol=1e-5, rtol=1e-4)
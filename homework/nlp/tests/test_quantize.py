@@ -0,0 +1,62 @@
+import io
+import json
+
+import pyarrow
+import pyarrow.parquet
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from bootcamp import quantize, score
+
+
+def test_quantized_buckets(tmp_path, tokenizer_path, bert_path):
+    classifier = quantize.Classifier(AutoModelForSequenceClassification.from_pretrained(bert_path)).eval()
+    quantized = quantize.quantize_dynamic(classifier)
+    assert isinstance(quantized.model.bert.encoder.layer[0].intermediate.dense, torch.ao.nn.quantized.dynamic.Linear)
+    assert isinstance(classifier.model.bert.encoder.layer[0].intermediate.dense, torch.nn.Linear)
+
+    quantize.save_buckets(quantize.trace_buckets(quantized, [8, 32]), str(tmp_path / 'model'))
+    traced = quantize.load_buckets(str(tmp_path / 'model'))
+    assert sorted(traced) == [8, 32]
+
+    input_ids = [[2, 5, 6, 3], [2] + [7] * 20 + [3], [2, 8, 3]]
+    eager = quantize.BucketedClassifier({8: classifier, 32: classifier}, max_batch_size=2)
+    assert [len(b) for b, _ in eager.batches(input_ids)] == [2, 1]
+
+    # The traced buckets accept any batch size, and match the quantized model
+    expected = quantize.BucketedClassifier({8: quantized, 32: quantized})(input_ids)
+    torch.testing.assert_close(quantize.BucketedClassifier(traced, max_batch_size=2)(input_ids), expected)
+    torch.testing.assert_close(eager(input_ids), expected, atol=0.05, rtol=0.1)
+
+    report = quantize.compare(
+        {'eager_fp32': eager, 'traced_int8': quantize.BucketedClassifier(traced)}, input_ids, [0, 1, 2])
+    assert report['eager_fp32']['agreement'] == 1
+    assert set(report['traced_int8']) >= {'accuracy', 'reviews_per_sec', 'batch_latency_p99_ms'}
+
+
+def test_score_streams_chunks(tmp_path, tokenizer_path, bert_path):
+    texts = ['the food was great', 'bad service', 'the place was friendly and good'] * 3
+    classifier = quantize.BucketedClassifier(
+        {16: quantize.Classifier(AutoModelForSequenceClassification.from_pretrained(bert_path)).eval()})
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    with open(tmp_path / 'reviews.jsonl', 'w') as f:
+        for i, t in enumerate(texts):
+            f.write(json.dumps({'review_id': f'r{i}', 'text': t}) + '\n')
+    pyarrow.parquet.write_table(pyarrow.table({'review_id': [f'r{i}' for i in range(9)], 'text': texts}), tmp_path / 'reviews.parquet')
+
+    results = []
+    for name in ('reviews.jsonl', 'reviews.parquet'):
+        chunks = list(score.read_records(str(tmp_path / name), ['text', 'review_id'], chunk_size=4))
+        assert [len(c['text']) for c in chunks] == [4, 4, 1]
+
+        output = io.StringIO()
+        report = score.score(classifier, tokenizer, iter(chunks), output, id_field='review_id')
+        assert report['reviews'] == 9
+        results.append([json.loads(line) for line in output.getvalue().splitlines()])
+
+    assert results[0] == results[1]
+    assert [r['id'] for r in results[0]] == [f'r{i}' for i in range(9)]
+    assert [r['index'] for r in results[0]] == list(range(9))
+    # Identical texts have identical predictions, regardless of their chunk
+    assert results[0][0]['probabilities'] == results[0][3]['probabilities']
@@ -0,0 +1,93 @@
+import asyncio
+
+import aiohttp.test_utils
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from bootcamp import model, serve
+
+
+def test_inference_server(tokenizer_path, bert_path):
+    bert = model.PretrainedBertModel(bert_path)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    server = serve.InferenceServer(bert, tokenizer, max_batch_size=4, max_wait_ms=50, length_buckets=(8, 16, 64))
+
+    assert [server.bucket(n) for n in (1, 8, 9, 64, 100)] == [8, 8, 16, 64, 64]
+
+    texts = ['the food was great'] * 3 + ['the service was slow and the place was never good again, the food was bad'] * 3
+
+    async def run():
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(serve.make_app(server))) as client:
+            responses = await asyncio.gather(*(client.post('/predict', json={'text': t}) for t in texts))
+            predictions = [await r.json() for r in responses]
+
+            response = await client.post('/predict', json={'texts': texts[:2]})
+            assert len((await response.json())['predictions']) == 2
+
+            metrics = await (await client.get('/metrics')).json()
+            return predictions, metrics
+
+    predictions, metrics = asyncio.run(run())
+
+    bert.eval()
+    with torch.no_grad():
+        for text, prediction in zip(texts, predictions):
+            expected = bert.model(**tokenizer(text, return_tensors='pt')).logits.softmax(dim=-1)[0]
+            torch.testing.assert_close(torch.tensor(prediction['probabilities']), expected, atol=1e-4, rtol=1e-3)
+            assert prediction['stars'] == int(expected.argmax()) + 1
+
+    # Texts are batched by length bucket
+    assert metrics['requests'] == 8
+    assert metrics['queue_depth'] == 0
+    assert metrics['batches'] < 8
+    assert sum(int(k) * v for k, v in metrics['batch_sizes'].items()) == 8
+    assert metrics['latency']['total']['count'] == 8
+    assert sum(metrics['latency_histograms']['queue'].values()) == 8
+
+
+def test_waiting_texts_fail_when_server_stops(tokenizer_path):
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    # Batches never fill up or time out, so that texts wait until the server is stopped
+    server = serve.InferenceServer(torch.nn.Identity(), tokenizer, max_batch_size=64, max_wait_ms=60_000)
+
+    async def run():
+        await server.start()
+        predictions = [asyncio.ensure_future(server.predict('the food was great')) for _ in range(3)]
+
+        while server.queue_depth < 3:
+            await asyncio.sleep(0.01)
+
+        await server.stop()
+        return await asyncio.gather(*predictions, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_texts_fail_when_batcher_fails(tokenizer_path):
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    server = serve.InferenceServer(torch.nn.Identity(), tokenizer, max_batch_size=64, max_wait_ms=60_000)
+
+    def bucket(length):
+        raise ValueError('bucket')
+
+    server.bucket = bucket
+
+    async def run():
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(serve.make_app(server))) as client:
+            assert (await client.get('/health')).status == 200
+
+            with pytest.raises(RuntimeError) as info:
+                await server.predict('the food was great')
+            assert isinstance(info.value.__cause__, ValueError)
+
+            # New texts are rejected once the batcher has stopped
+            assert not server.running
+            with pytest.raises(RuntimeError):
+                await server.predict('the food was great')
+
+            assert (await client.get('/health')).status == 503
+            assert (await client.post('/predict', json={'text': 'the food was great'})).status == 500
+
+    asyncio.run(run())
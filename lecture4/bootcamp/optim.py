@@ -0,0 +1,292 @@
+"""Layer-wise adaptive optimizers for large batch training.
+
+With very large batches, scaling the learning rate linearly with the batch size (even with warmup)
+eventually makes training unstable, as the update of some layers becomes large compared to their weights.
+LARS (https://arxiv.org/abs/1708.03888) and LAMB (https://arxiv.org/abs/1904.00962) instead scale the
+update of each parameter tensor by a trust ratio, proportional to the ratio of the norm of the weights
+to the norm of the update, so that the relative size of the update is the same for all layers.
+
+The trust ratio is clipped to `max_trust_ratio`. As is usual, biases and the parameters of normalization
+layers are excluded from the trust ratio and from weight decay (see `parameter_groups`), which is controlled
+per parameter group by the `trust_ratio` and `weight_decay` options.
+
+Both optimizers update all the parameters of a group at once with multi-tensor (`foreach`) operations,
+and compute the trust ratios without synchronizing with the device.
+
+This module is a copy of `bootcamp.optim` from the homework/cv project (which is the canonical
+version), as both projects are installed independently.
+
+"""
+
+from typing import Dict, Iterable, List, Optional
+
+import torch
+import torch.optim
+
+
+OPTIMIZERS = ('sgd', 'lars', 'lamb')
+
+
+def parameter_groups(model: torch.nn.Module, weight_decay: float=0.0, exclude_bias_and_norm: bool=True) -> List[Dict]:
+    """Splits the parameters of the model into groups for layer-wise adaptive optimizers.
+
+    If `exclude_bias_and_norm` is `True`, the parameters with at most one dimension, i.e. biases and the
+    parameters of normalization layers, are placed in a separate group without weight decay or trust ratio.
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+
+    if not exclude_bias_and_norm:
+        return [{'params': params, 'weight_decay': weight_decay}]
+
+    return [
+        {'params': [p for p in params if p.dim() > 1], 'weight_decay': weight_decay},
+        {'params': [p for p in params if p.dim() <= 1], 'weight_decay': 0.0, 'trust_ratio': False},
+    ]
+
+
+def _trust_ratios(weight_norms: List[torch.Tensor], update_norms: List[torch.Tensor], coefficient: float,
+                  max_trust_ratio: Optional[float]) -> List[torch.Tensor]:
+    """Computes the trust ratio of each parameter tensor, which is 1 if the weights or the update are zero."""
+    weight_norm = torch.stack(weight_norms)
+    update_norm = torch.stack(update_norms)
+
+    ratio = torch.where(
+        (weight_norm > 0) & (update_norm > 0),
+        coefficient * weight_norm / update_norm,
+        torch.ones_like(weight_norm))
+
+    if max_trust_ratio is not None:
+        ratio = ratio.clamp(max=max_trust_ratio)
+
+    return list(ratio.unbind())
+
+
+def _params_with_grad(group) -> List[torch.Tensor]:
+    params = [p for p in group['params'] if p.grad is not None]
+
+    if any(p.grad.is_sparse for p in params):
+        raise RuntimeError('Sparse gradients are not supported')
+
+    return params
+
+
+class LARS(torch.optim.Optimizer):
+    """Layer-wise adaptive rate scaling (LARS), on top of SGD with momentum.
+
+    The update of each parameter tensor is scaled by the trust ratio
+    `trust_coefficient * ||w|| / (||g|| + weight_decay * ||w||)`, clipped to `max_trust_ratio`.
+
+    Parameters
+    ----------
+    params : Iterable
+        Parameters or parameter groups to optimize (see `parameter_groups`).
+    lr : float
+        Learning rate.
+    momentum : float
+        Momentum factor.
+    weight_decay : float
+        Weight decay (L2 penalty).
+    trust_coefficient : float
+        Trust coefficient, by which the trust ratio is multiplied.
+    max_trust_ratio : float, optional
+        If not `None`, the trust ratio is clipped to this value.
+    trust_ratio : bool
+        If `False`, the trust ratio is not applied, so that the optimizer is equivalent to SGD.
+    """
+
+    def __init__(self, params: Iterable, lr: float, momentum: float=0.9, weight_decay: float=0.0,
+                 trust_coefficient: float=0.001, max_trust_ratio: Optional[float]=10.0, trust_ratio: bool=True):
+        if lr < 0.0:
+            raise ValueError(f'Invalid learning rate: {lr}')
+        if momentum < 0.0:
+            raise ValueError(f'Invalid momentum: {momentum}')
+
+        defaults = dict(
+            lr=lr, momentum=momentum, weight_decay=weight_decay, trust_coefficient=trust_coefficient,
+            max_trust_ratio=max_trust_ratio, trust_ratio=trust_ratio)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = _params_with_grad(group)
+            if not params:
+                continue
+
+            grads = [p.grad for p in params]
+            weight_decay = group['weight_decay']
+
+            if weight_decay != 0:
+                updates = torch._foreach_add(grads, params, alpha=weight_decay)
+            else:
+                updates = [g.clone() for g in grads]
+
+            if group['trust_ratio']:
+                weight_norms = torch._foreach_norm(params)
+                update_norms = torch._foreach_norm(grads)
+                if weight_decay != 0:
+                    update_norms = torch._foreach_add(update_norms, weight_norms, alpha=weight_decay)
+
+                torch._foreach_mul_(updates, _trust_ratios(
+                    weight_norms, update_norms, group['trust_coefficient'], group['max_trust_ratio']))
+
+            if group['momentum'] == 0:
+                torch._foreach_add_(params, updates, alpha=-group['lr'])
+                continue
+
+            buffers = []
+            for p in params:
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                buffers.append(state['momentum_buffer'])
+
+            # The learning rate is included in the momentum buffer, as in the original LARS
+            torch._foreach_mul_(buffers, group['momentum'])
+            torch._foreach_add_(buffers, updates, alpha=group['lr'])
+            torch._foreach_sub_(params, buffers)
+
+        return loss
+
+
+class LAMB(torch.optim.Optimizer):
+    """Layer-wise adaptive moments for batch training (LAMB), on top of Adam.
+
+    The Adam update (with decoupled weight decay) `r` of each parameter tensor is scaled by
+    the trust ratio `trust_coefficient * ||w|| / ||r||`, clipped to `max_trust_ratio`.
+
+    Parameters
+    ----------
+    params : Iterable
+        Parameters or parameter groups to optimize (see `parameter_groups`).
+    lr : float
+        Learning rate.
+    betas : Tuple[float, float]
+        Coefficients of the running averages of the gradient and of its square.
+    eps : float
+        Term added to the denominator for numerical stability.
+    weight_decay : float
+        Decoupled weight decay, added to the Adam update before applying the trust ratio.
+    trust_coefficient : float
+        Trust coefficient, by which the trust ratio is multiplied.
+    max_trust_ratio : float, optional
+        If not `None`, the trust ratio is clipped to this value.
+    trust_ratio : bool
+        If `False`, the trust ratio is not applied, so that the optimizer is equivalent to AdamW
+        (with weight decay scaled by the learning rate).
+    """
+
+    def __init__(self, params: Iterable, lr: float=1e-3, betas=(0.9, 0.999), eps: float=1e-6, weight_decay: float=0.0,
+                 trust_coefficient: float=1.0, max_trust_ratio: Optional[float]=10.0, trust_ratio: bool=True):
+        if lr < 0.0:
+            raise ValueError(f'Invalid learning rate: {lr}')
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError(f'Invalid betas: {betas}')
+
+        defaults = dict(
+            lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, trust_coefficient=trust_coefficient,
+            max_trust_ratio=max_trust_ratio, trust_ratio=trust_ratio)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = _params_with_grad(group)
+            if not params:
+                continue
+
+            grads = [p.grad for p in params]
+            beta1, beta2 = group['betas']
+
+            exp_avgs = []
+            exp_avg_sqs = []
+            bias_corrections1 = []
+            bias_corrections2 = []
+
+            for p in params:
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+
+                state['step'] += 1
+                exp_avgs.append(state['exp_avg'])
+                exp_avg_sqs.append(state['exp_avg_sq'])
+                bias_corrections1.append(1 - beta1 ** state['step'])
+                bias_corrections2.append((1 - beta2 ** state['step']) ** 0.5)
+
+            torch._foreach_lerp_(exp_avgs, grads, 1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            # r = (m / (1 - beta1^t)) / (sqrt(v) / sqrt(1 - beta2^t) + eps) + weight_decay * w
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(denom, bias_corrections2)
+            torch._foreach_add_(denom, group['eps'])
+
+            updates = torch._foreach_div(exp_avgs, bias_corrections1)
+            torch._foreach_div_(updates, denom)
+
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(updates, params, alpha=group['weight_decay'])
+
+            if group['trust_ratio']:
+                torch._foreach_mul_(updates, _trust_ratios(
+                    torch._foreach_norm(params), torch._foreach_norm(updates),
+                    group['trust_coefficient'], group['max_trust_ratio']))
+
+            torch._foreach_add_(params, updates, alpha=-group['lr'])
+
+        return loss
+
+
+def create_optimizer(name: str, model: torch.nn.Module, lr: float, weight_decay: float=0.0, momentum: float=0.9,
+                     trust_coefficient: Optional[float]=None, max_trust_ratio: Optional[float]=10.0,
+                     exclude_bias_and_norm: bool=True) -> torch.optim.Optimizer:
+    """Creates the optimizer with the given name for the parameters of the given model.
+
+    Parameters
+    ----------
+    name : str
+        One of `sgd` (SGD with momentum), `lars` or `lamb`.
+    model : torch.nn.Module
+        Model whose parameters to optimize.
+    lr : float
+        Learning rate.
+    weight_decay : float
+        Weight decay.
+    momentum : float
+        Momentum of `sgd` and `lars` (`lamb` uses the default betas of Adam).
+    trust_coefficient : float, optional
+        Trust coefficient of `lars` and `lamb`, by default 0.001 for `lars` and 1 for `lamb`.
+    max_trust_ratio : float, optional
+        Clipping value of the trust ratio of `lars` and `lamb`.
+    exclude_bias_and_norm : bool
+        If `True`, biases and the parameters of normalization layers are excluded from weight decay
+        and from the trust ratio of `lars` and `lamb`. Plain `sgd` always applies weight decay to all parameters.
+    """
+    if name == 'sgd':
+        return torch.optim.SGD(model.parameters(), lr, momentum=momentum, weight_decay=weight_decay)
+
+    groups = parameter_groups(model, weight_decay, exclude_bias_and_norm)
+    adaptive_kwargs = dict(weight_decay=weight_decay, max_trust_ratio=max_trust_ratio)
+    if trust_coefficient is not None:
+        adaptive_kwargs['trust_coefficient'] = trust_coefficient
+
+    if name == 'lars':
+        return LARS(groups, lr, momentum=momentum, **adaptive_kwargs)
+    elif name == 'lamb':
+        return LAMB(groups, lr, **adaptive_kwargs)
+    else:
+        raise ValueError(f'Unknown optimizer {name}, expected one of {OPTIMIZERS}')
@@ -23,11 +23,25 @@ This script is intended to demonstrate a couple aspects of setting learning rate
     https://arxiv.org/pdf/1706.02677.pdf
     for more information.
 
+    For even larger batches, set `optimizer=lars` or `optimizer=lamb` to use a layer-wise adaptive
+    optimizer (see `bootcamp.optim`), which scales the update of each layer by a trust ratio.
+
+4. Training on CPU
+    The script runs on CPU when no GPU is available (or with `device=cpu`). There, set `precision=bf16`
+    to train with bfloat16 autocast (which is fast on CPUs with native bfloat16 support), `num_threads`
+    to control the number of threads used by torch, and `compile=true` to compile the model.
+    As loss scaling is only needed for float16, it is only used for `precision=fp16` (the default on GPU).
+
+    At the end of training, a report of the configuration and of the training speed is printed, and
+    if `report_path` is set, saved as json to that path, so that configurations may be compared.
+    When compiling, the last incomplete batch of each epoch is dropped, to avoid recompiling the model for it.
+
 """
 
 import dataclasses
+import json
 import time
-from typing import List, Iterable, Optional, Sequence, Tuple
+from typing import Any, Dict, List, Iterable, Optional, Sequence, Tuple
 
 import numpy as np
 
@@ -38,6 +52,8 @@ import torch.nn
 import torch.nn.functional
 import torch.optim
 
+from . import optim as optimizers
+
 
 @dataclasses.dataclass
 class Config:
@@ -47,6 +63,56 @@ class Config:
     warmup_lr: bool = False
     max_epochs: int = 50
     data_folder: str = './data'
+    data_on_device: bool = True
+    device: str = 'auto'
+    precision: str = 'auto'
+    channels_last: bool = True
+    num_threads: Optional[int] = None
+    compile: bool = False
+    report_path: Optional[str] = None
+    optimizer: str = 'sgd'
+    momentum: float = 0.0
+    weight_decay: float = 0.0
+    trust_coefficient: Optional[float] = None
+    max_trust_ratio: Optional[float] = 10.0
+
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+
+def resolve_device(device: str='auto') -> torch.device:
+    """Returns the given device, or for `auto`, the GPU if available and the CPU otherwise."""
+    if device == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(device)
+
+
+def resolve_precision(precision: str, device: torch.device) -> torch.dtype:
+    """Returns the dtype of autocast for the given precision.
+
+    For `auto`, this is float16 on GPU, and float32 (i.e. no autocast) on CPU, as bfloat16
+    is only faster than float32 on CPUs with native support for it.
+    """
+    if precision == 'auto':
+        return torch.float16 if device.type == 'cuda' else torch.float32
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, expected auto or one of {list(PRECISIONS)}')
+    return PRECISIONS[precision]
+
+
+def autocast(device_type: str, dtype: Optional[torch.dtype]=None):
+    """Autocast context for the given device, which is disabled for float32.
+
+    By default, float16 is used on GPU and float32 on CPU.
+    """
+    if dtype is None:
+        dtype = torch.float16 if device_type == 'cuda' else torch.float32
+    return torch.autocast(device_type, dtype=dtype, enabled=dtype != torch.float32)
+
 
 class SimpleConvNet(torch.nn.Module):
     def __init__(self):
@@ -74,13 +140,48 @@ class SimpleConvNet(torch.nn.Module):
 class InMemoryDataloader:
     """Utility class which exposes the data as an iterable sequence, but holds
     all of the data in (GPU) memory instead of loading it bit by bit.
+
+    The permutation of each epoch is generated on the device holding the data, and composed
+    with the subset (if any) once per epoch. Each batch is then gathered with a single indexing
+    operation per tensor, into preallocated buffers. Note that the buffers are reused: a batch
+    is only valid until the next-but-one batch is requested.
+
+    If the data is held in CPU memory but training happens on a GPU (`device`), batches are
+    gathered into pinned buffers, and copied to the GPU on a separate stream while the previous
+    batch is being used (double buffering).
+
+    Parameters
+    ----------
+    tensors : Sequence[torch.Tensor]
+        The data, with samples along the first dimension.
+    batch_size : int
+        Number of samples in each batch.
+    generator : torch.Generator, optional
+        Generator for the permutations. If it is on another device than the data,
+        the permutation is generated on the device of the generator, and then moved once per epoch.
+    subset : torch.Tensor, optional
+        If not `None`, indices of the samples to iterate over.
+    drop_last : bool
+        If `True`, the last incomplete batch of each epoch is dropped.
+    fill_last : bool
+        If `True`, the last incomplete batch of each epoch is completed with samples from the start
+        of the epoch, so that all batches have the same size (but some samples are seen twice).
+    device : torch.device, optional
+        Device on which batches are produced, by default the device of the data.
     """
 
-    def __init__(self, tensors: Sequence[torch.Tensor], batch_size: int, generator: Optional[torch.Generator]=None, subset: torch.Tensor=None):
+    def __init__(self, tensors: Sequence[torch.Tensor], batch_size: int, generator: Optional[torch.Generator]=None, subset: torch.Tensor=None,
+                 drop_last: bool=False, fill_last: bool=False, device: Optional[torch.device]=None):
+        if drop_last and fill_last:
+            raise ValueError('drop_last and fill_last are mutually exclusive')
+
         self.tensors = tensors
         self.batch_size = batch_size
         self.generator = generator
-        self.subset = subset
+        self.subset = subset.to(device=tensors[0].device) if subset is not None else None
+        self.drop_last = drop_last
+        self.fill_last = fill_last
+        self.device = torch.device(device) if device is not None else tensors[0].device
 
     @property
     def dataset_size(self):
@@ -89,18 +190,111 @@ class InMemoryDataloader:
         else:
             return len(self.tensors[0])
 
+    @property
+    def samples_per_epoch(self):
+        """Number of samples in each epoch, taking into account `drop_last` and `fill_last`."""
+        if self.drop_last or self.fill_last:
+            return len(self) * self.batch_size
+        return self.dataset_size
+
     def __len__(self):
+        if self.drop_last:
+            return self.dataset_size // self.batch_size
         return (self.dataset_size + self.batch_size - 1) // self.batch_size
 
+    def _permutation(self) -> torch.Tensor:
+        """Computes the indices of the samples of the epoch, in order."""
+        data_device = self.tensors[0].device
+
+        if self.generator is not None:
+            perm = torch.randperm(self.dataset_size, generator=self.generator, device=self.generator.device)
+            perm = perm.to(device=data_device, non_blocking=True)
+        else:
+            perm = torch.randperm(self.dataset_size, device=data_device)
+
+        if self.subset is not None:
+            perm = self.subset[perm]
+
+        if self.drop_last:
+            perm = perm[:len(self) * self.batch_size]
+        elif self.fill_last and len(perm) % self.batch_size != 0:
+            fill = torch.arange(len(self) * self.batch_size - len(perm), device=perm.device) % len(perm)
+            perm = torch.cat([perm, perm[fill]])
+
+        return perm
+
+    def _allocate(self, device: torch.device, pin_memory: bool=False) -> Tuple[torch.Tensor, ...]:
+        buffers = []
+
+        for t in self.tensors:
+            # Keep the memory format of the data, e.g. channels last images
+            memory_format = torch.contiguous_format
+            if t.dim() == 4 and not t.is_contiguous() and t.is_contiguous(memory_format=torch.channels_last):
+                memory_format = torch.channels_last
+
+            buffer = torch.empty((self.batch_size,) + t.shape[1:], dtype=t.dtype, device=device, memory_format=memory_format)
+            buffers.append(buffer.pin_memory() if pin_memory else buffer)
+
+        return tuple(buffers)
+
+    def _gather(self, idx: torch.Tensor, buffers: Tuple[torch.Tensor, ...]) -> Tuple[torch.Tensor, ...]:
+        return tuple(torch.index_select(t, 0, idx, out=b[:len(idx)]) for t, b in zip(self.tensors, buffers))
+
     def __iter__(self):
-        perm = torch.randperm(self.dataset_size, generator=self.generator)
-        perm.to(device=self.tensors[0].device)
+        perm = self._permutation()
+
+        if self.device.type == 'cuda' and self.tensors[0].device.type == 'cpu':
+            yield from self._iter_prefetch(perm)
+            return
+
+        # Two sets of buffers, so that the previous batch remains valid while the next is gathered
+        buffers = [self._allocate(self.device) for _ in range(2)]
 
         for i in range(len(self)):
             idx = perm[i * self.batch_size:(i + 1) * self.batch_size]
-            if self.subset is not None:
-                idx = self.subset[idx]
-            yield (t[idx] for t in self.tensors)
+            yield self._gather(idx, buffers[i % 2])
+
+    def _iter_prefetch(self, perm: torch.Tensor):
+        stream = torch.cuda.Stream(self.device)
+        host = [self._allocate(torch.device('cpu'), pin_memory=True) for _ in range(2)]
+        device = [self._allocate(self.device) for _ in range(2)]
+        # Events recording when the copy to each device buffer is complete,
+        # and when the computation using each device buffer has been enqueued
+        copied = [None, None]
+        consumed = [None, None]
+
+        def load(i):
+            k = i % 2
+            idx = perm[i * self.batch_size:(i + 1) * self.batch_size]
+
+            if copied[k] is not None:
+                # Wait for the previous copy from this pinned buffer before overwriting it
+                copied[k].synchronize()
+            batch = self._gather(idx, host[k])
+
+            with torch.cuda.stream(stream):
+                if consumed[k] is not None:
+                    stream.wait_event(consumed[k])
+                for d, h in zip(device[k], batch):
+                    d[:len(idx)].copy_(h, non_blocking=True)
+                copied[k] = torch.cuda.Event()
+                copied[k].record(stream)
+
+            return len(idx)
+
+        sizes = [load(0)] if len(self) > 0 else []
+
+        for i in range(len(self)):
+            if i + 1 < len(self):
+                # Start copying the next batch, while the current batch is used
+                sizes.append(load(i + 1))
+
+            k = i % 2
+            torch.cuda.current_stream(self.device).wait_event(copied[k])
+            yield tuple(d[:sizes[i]] for d in device[k])
+
+            consumed[k] = torch.cuda.Event()
+            consumed[k].record(torch.cuda.current_stream(self.device))
 
 
 def make_warmup_scheduler(optim, batches_per_epoch: int, num_warmup_epochs: int=5):
@@ -110,8 +304,13 @@ def make_warmup_scheduler(optim, batches_per_epoch: int, num_warmup_epochs: int=
         optim, lambda step: min(step / num_warmup_batches, 1))
 
 
-def train_epoch(model: torch.nn.Module, optim: torch.optim.Optimizer, scaler: torch.cuda.amp.GradScaler, dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]], scheduler=None) -> List[float]:
-    """Train the model for a single epoch."""
+def train_epoch(model: torch.nn.Module, optim: torch.optim.Optimizer, scaler: Optional[torch.cuda.amp.GradScaler], dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]], scheduler=None,
+                autocast_dtype: Optional[torch.dtype]=None) -> List[float]:
+    """Train the model for a single epoch.
+
+    The model is run under autocast with the given dtype (see `autocast`). The scaler may be `None`
+    (or disabled) when loss scaling is not needed, i.e. unless training in float16.
+    """
     loss_values = []
 
     for data in dataloader:
@@ -119,13 +318,13 @@ def train_epoch(model: torch.nn.Module, optim: torch.optim.Optimizer, scaler: to
 
         optim.zero_grad()
 
-        with torch.cuda.amp.autocast():
-            outputs = model.forward(inputs)
+        with autocast(inputs.device.type, autocast_dtype):
+            outputs = model(inputs)
             loss = torch.nn.functional.cross_entropy(outputs, labels)
 
         # Note: for better performance, we are using 16-bit training,
         # so we are also using loss scaling here.
-        if scaler is not None:
+        if scaler is not None and scaler.is_enabled():
             scaler.scale(loss).backward()
             scaler.step(optim)
             scaler.update()
@@ -142,7 +341,7 @@ def train_epoch(model: torch.nn.Module, optim: torch.optim.Optimizer, scaler: to
 
     return [l.item() for l in loss_values]
 
-def eval_model(model: torch.nn.Module, dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]]):
+def eval_model(model: torch.nn.Module, dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]], autocast_dtype: Optional[torch.dtype]=None):
     with torch.no_grad():
         total_loss = 0
         total_correct = 0
@@ -151,8 +350,9 @@ def eval_model(model: torch.nn.Module, dataloader: Iterable[Tuple[torch.Tensor,
         for data in dataloader:
             inputs, labels = data
 
-            outputs = model.forward(inputs)
-            loss = torch.nn.functional.cross_entropy(outputs, labels, reduction='sum')
+            with autocast(inputs.device.type, autocast_dtype):
+                outputs = model(inputs)
+            loss = torch.nn.functional.cross_entropy(outputs.float(), labels, reduction='sum')
             predicted = torch.argmax(outputs, dim=-1)
             accuracy = torch.sum(predicted == labels)
 
@@ -166,53 +366,115 @@ def eval_model(model: torch.nn.Module, dataloader: Iterable[Tuple[torch.Tensor,
     return loss, accuracy
 
 
-def create_dataloader(batch_size, seed: int, dtype=torch.float32, device='cpu', train=True, data_folder='./data'):
+def create_dataloader(batch_size, seed: int, dtype=torch.float32, device='cpu', train=True, data_folder='./data', data_on_device=True, drop_last=False,
+                      channels_last=True):
+    """Creates a dataloader for CIFAR-10.
+
+    If `data_on_device` is `False`, the data is held in CPU memory, and batches are copied to the device as they are used.
+    Images are stored in channels last format if `channels_last` is `True`, and in the default (channels first) format otherwise.
+    """
     import torchvision
     data_folder = hydra.utils.to_absolute_path(data_folder)
     ds = torchvision.datasets.CIFAR10(data_folder, train=train, download=True)
 
-    images = torch.from_numpy(ds.data).to(dtype=dtype, device=device).div_(256).sub_(0.5).div_(0.5).permute(0, 3, 1, 2)
-    labels = torch.tensor(ds.targets, dtype=torch.int64, device=device)
+    data_device = device if data_on_device else 'cpu'
+
+    images = torch.from_numpy(ds.data).to(dtype=dtype, device=data_device).div_(256).sub_(0.5).div_(0.5).permute(0, 3, 1, 2)
+    labels = torch.tensor(ds.targets, dtype=torch.int64, device=data_device)
+
+    if not channels_last:
+        images = images.contiguous()
 
-    generator = torch.Generator().manual_seed(seed)
+    # Generate the permutations on the device holding the data
+    generator = torch.Generator(device=data_device).manual_seed(seed)
 
-    return InMemoryDataloader((images, labels), batch_size, generator=generator)
+    return InMemoryDataloader((images, labels), batch_size, generator=generator, drop_last=drop_last, device=device)
 
 
-def train(config: Config):
-    device = torch.device('cuda')
-    model = SimpleConvNet().to(device=device, memory_format=torch.channels_last)
+def train(config: Config) -> Dict[str, Any]:
+    """Trains the model with the given configuration, and returns a report of the results and of the training speed."""
+    device = resolve_device(config.device)
+    autocast_dtype = resolve_precision(config.precision, device)
+    memory_format = torch.channels_last if config.channels_last else torch.contiguous_format
+
+    if config.num_threads is not None:
+        torch.set_num_threads(config.num_threads)
+
+    model = SimpleConvNet().to(device=device, memory_format=memory_format)
 
     lr = config.learning_rate
     if config.scale_lr_by_bs:
         # reference learning rate at bs=256
         lr *= (config.batch_size / 256)
 
-    optim = torch.optim.SGD(model.parameters(), lr=lr)
-    scaler = torch.cuda.amp.GradScaler()
+    optim = optimizers.create_optimizer(
+        config.optimizer, model, lr, weight_decay=config.weight_decay, momentum=config.momentum,
+        trust_coefficient=config.trust_coefficient, max_trust_ratio=config.max_trust_ratio)
+    # Loss scaling is only needed for float16, which has a limited range
+    scaler = torch.cuda.amp.GradScaler() if device.type == 'cuda' and autocast_dtype == torch.float16 else None
+
+    if config.compile:
+        model = torch.compile(model)
 
-    dataloader = create_dataloader(config.batch_size, 0, device=device, data_folder=config.data_folder)
-    test_dataloader = create_dataloader(config.batch_size, 0, device=device, train=False, data_folder=config.data_folder)
+    # A compiled model is recompiled for the smaller last batch, so it is only dropped when compiling
+    dataloader = create_dataloader(
+        config.batch_size, 0, device=device, data_folder=config.data_folder,
+        data_on_device=config.data_on_device, drop_last=config.compile, channels_last=config.channels_last)
+    test_dataloader = create_dataloader(
+        config.batch_size, 0, device=device, train=False, data_folder=config.data_folder,
+        data_on_device=config.data_on_device, channels_last=config.channels_last)
 
     if config.warmup_lr:
         scheduler = make_warmup_scheduler(optim, len(dataloader))
     else:
         scheduler = None
 
-
+    epoch_times = []
     start_time = time.perf_counter()
 
     for _ in tqdm.trange(config.max_epochs):
-        epoch_loss = train_epoch(model, optim, scaler, dataloader, scheduler=scheduler)
+        epoch_start = time.perf_counter()
+        # Note: the losses are synchronized at the end of the epoch, so that the time is accurate
+        epoch_loss = train_epoch(model, optim, scaler, dataloader, scheduler=scheduler, autocast_dtype=autocast_dtype)
+        epoch_times.append(time.perf_counter() - epoch_start)
 
     end_time = time.perf_counter()
 
-    final_loss, final_accuracy = eval_model(model, test_dataloader)
-    print(f'Final train loss: {np.mean(epoch_loss)}')
+    final_loss, final_accuracy = eval_model(model, test_dataloader, autocast_dtype=autocast_dtype)
+
+    total_time = end_time - start_time
+    images_per_epoch = dataloader.samples_per_epoch
+    # The first epoch includes compilation and warmup, so it is excluded from the steady state speed if possible
+    steady_times = epoch_times[1:] if len(epoch_times) > 1 else epoch_times
+
+    report = {
+        'device': str(device),
+        'precision': str(autocast_dtype).replace('torch.', ''),
+        'channels_last': config.channels_last,
+        'num_threads': torch.get_num_threads() if device.type == 'cpu' else None,
+        'compile': config.compile,
+        'optimizer': config.optimizer,
+        'batch_size': config.batch_size,
+        'max_epochs': config.max_epochs,
+        'final_train_loss': float(np.mean(epoch_loss)),
+        'final_loss': final_loss,
+        'final_accuracy': final_accuracy,
+        'total_time_s': total_time,
+        'first_epoch_time_s': epoch_times[0] if epoch_times else None,
+        'images_per_sec': images_per_epoch * config.max_epochs / total_time,
+        'steady_images_per_sec': images_per_epoch * len(steady_times) / sum(steady_times) if steady_times else None,
+    }
+
+    print(f'Final train loss: {report["final_train_loss"]}')
     print(f'Final loss {final_loss:.3f}, final accuracy {final_accuracy:.2%}.')
-    print(f'Total time: {end_time - start_time:.1f} s.')
-    total_images = dataloader.dataset_size * config.max_epochs
-    print(f'Training speed: {total_images / (end_time - start_time):.1f} img / s.')
+    print(f'Total time: {total_time:.1f} s.')
+    print(f'Training speed: {report["images_per_sec"]:.1f} img / s.')
+
+    if config.report_path is not None:
+        with open(config.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
 
 
 @hydra.main(config_name='config', config_path=None)
@@ -0,0 +1,382 @@
+"""Learning rate sweeps with vectorized ensembles.
+
+Each configuration of `train_lr.py` trains a single (small) `SimpleConvNet`, which does not
+come close to using the hardware. Instead, this script trains one replica of the model for
+each configuration of the sweep at the same time: the parameters of the replicas are stacked
+along a leading dimension, and the model is evaluated for all replicas at once with
+`torch.func.vmap` and `torch.func.functional_call`. All replicas see the same batches,
+but each replica has its own learning rate and warmup schedule. The replicas are trained
+with SGD (with the given momentum and weight decay), as the layer-wise trust ratios of the
+other optimizers of `train_lr.py` would need to be computed for each replica separately.
+
+The sweep is the product of the given learning rates, `scale_lr_by_bs` and `warmup_lr` values,
+for a single batch size (as the batches are shared by the replicas). For example
+```
+python -m bootcamp.train_lr_ensemble learning_rates=[1e-3,3e-3,1e-2,3e-2] warmup_lr=[false,true]
+```
+trains 8 replicas, and reports the final loss and accuracy of each.
+
+Replicas whose loss becomes non-finite are reported as diverged, and are no longer updated,
+so that their gradients do not skip the steps of the other replicas. Note however that when
+training in float16 (on GPU), the loss scale is shared by all replicas: if the gradients of any
+replica overflow while its loss is still finite, the step is skipped for all replicas, and the
+loss scale is reduced for all of them.
+
+"""
+
+import copy
+import dataclasses
+import itertools
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import hydra
+import torch
+import torch.func
+import torch.nn.functional
+import tqdm
+
+from . import train_lr
+
+
+@dataclasses.dataclass
+class EnsembleConfig:
+    """Configuration for vectorized learning rate sweeps.
+
+    Attributes
+    ----------
+    batch_size : int
+        Batch size, shared by all replicas.
+    learning_rates : List[float]
+        Learning rates (at batch size 256 when scaling by batch size) to sweep over.
+    scale_lr_by_bs : List[bool]
+        Whether to scale the learning rate by the batch size, for each value to sweep over.
+    warmup_lr : List[bool]
+        Whether to warm up the learning rate, for each value to sweep over.
+    warmup_epochs : int
+        Number of epochs of warmup.
+    momentum : float
+        Momentum of SGD, shared by all replicas.
+    weight_decay : float
+        Weight decay of SGD, shared by all replicas.
+    max_epochs : int
+        Number of epochs to train for.
+    seed : int
+        Seed for the initialization of the replicas and the order of the batches.
+    data_folder : str
+        Folder in which to download CIFAR-10.
+    """
+    batch_size: int = 512
+    learning_rates: List[float] = dataclasses.field(default_factory=lambda: [3e-3, 1e-2, 3e-2, 1e-1])
+    scale_lr_by_bs: List[bool] = dataclasses.field(default_factory=lambda: [True])
+    warmup_lr: List[bool] = dataclasses.field(default_factory=lambda: [False, True])
+    warmup_epochs: int = 5
+    momentum: float = 0.0
+    weight_decay: float = 0.0
+    max_epochs: int = 50
+    seed: int = 0
+    data_folder: str = './data'
+
+
+@dataclasses.dataclass
+class ReplicaConfig:
+    """Hyperparameters of a single replica of the sweep."""
+    learning_rate: float
+    scale_lr_by_bs: bool
+    warmup_lr: bool
+
+    def effective_learning_rate(self, batch_size: int) -> float:
+        if self.scale_lr_by_bs:
+            # reference learning rate at bs=256
+            return self.learning_rate * batch_size / 256
+        return self.learning_rate
+
+
+def make_replicas(config: EnsembleConfig) -> List[ReplicaConfig]:
+    """Lists the configurations of the sweep described by the given configuration."""
+    return [
+        ReplicaConfig(lr, scale, warmup)
+        for lr, scale, warmup in itertools.product(config.learning_rates, config.scale_lr_by_bs, config.warmup_lr)]
+
+
+class Ensemble:
+    """Replicas of a model, evaluated together with `vmap`.
+
+    The parameters (and buffers) of the replicas are stacked along a new leading dimension,
+    and are leaf tensors which may be passed to an optimizer. Calling the ensemble on inputs
+    shared by all replicas returns outputs with a leading dimension indexing the replicas.
+
+    Parameters
+    ----------
+    models : Sequence[torch.nn.Module]
+        Replicas of the same model, with different parameters. The models are not modified.
+    """
+
+    def __init__(self, models: Sequence[torch.nn.Module]):
+        self.params, self.buffers = torch.func.stack_module_state(list(models))
+        self.num_replicas = len(models)
+
+        # Skeleton of the model, which only provides its structure to `functional_call`
+        self.base = copy.deepcopy(models[0]).to('meta')
+
+    def parameters(self) -> List[torch.Tensor]:
+        return list(self.params.values())
+
+    def _call(self, params, buffers, x):
+        return torch.func.functional_call(self.base, (params, buffers), (x,))
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.func.vmap(self._call, in_dims=(0, 0, None))(self.params, self.buffers, x)
+
+
+def _per_replica(value: torch.Tensor, like: torch.Tensor) -> torch.Tensor:
+    """Views a tensor of shape `[replicas]` so that it broadcasts against the stacked tensor `like`."""
+    return value.view((-1,) + (1,) * (like.dim() - 1))
+
+
+class ReplicaSGD(torch.optim.Optimizer):
+    """SGD over the stacked parameters of an ensemble, with a separate learning rate for each replica.
+
+    Each replica is updated as by `torch.optim.SGD` (without dampening or Nesterov momentum), that is
+    the learning rate scales the update rather than the gradient, so that momentum and weight decay
+    behave as for a single model when the learning rate changes.
+
+    Parameters
+    ----------
+    params : Iterable[torch.Tensor]
+        Stacked parameters, with a leading dimension indexing the replicas (see `Ensemble.parameters`).
+    lr : torch.Tensor
+        Learning rate of each replica, of shape `[replicas]`. This may be replaced in the parameter
+        groups before each step (see `train_epoch`).
+    momentum : float
+        Momentum factor.
+    weight_decay : float
+        Weight decay (L2 penalty).
+    """
+
+    def __init__(self, params: Iterable[torch.Tensor], lr: torch.Tensor, momentum: float=0.0, weight_decay: float=0.0):
+        if momentum < 0.0:
+            raise ValueError(f'Invalid momentum: {momentum}')
+
+        super().__init__(params, dict(lr=lr, momentum=momentum, weight_decay=weight_decay))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+
+            grads = [p.grad for p in params]
+
+            if group['weight_decay'] != 0:
+                updates = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+            else:
+                updates = grads
+
+            if group['momentum'] != 0:
+                buffers = []
+                for p, u in zip(params, updates):
+                    state = self.state[p]
+                    if 'momentum_buffer' not in state:
+                        state['momentum_buffer'] = u.clone()
+                    else:
+                        state['momentum_buffer'].mul_(group['momentum']).add_(u)
+                    buffers.append(state['momentum_buffer'])
+                updates = buffers
+
+            torch._foreach_sub_(params, torch._foreach_mul(updates, [_per_replica(group['lr'], p) for p in params]))
+
+        return loss
+
+
+def replica_losses(outputs: torch.Tensor, labels: torch.Tensor, reduction: str='mean') -> torch.Tensor:
+    """Computes the cross-entropy of each replica, from outputs of shape `[replicas, batch, classes]`."""
+    num_replicas = outputs.shape[0]
+    losses = torch.nn.functional.cross_entropy(
+        outputs.flatten(0, 1).float(), labels.repeat(num_replicas), reduction='none').view(num_replicas, -1)
+    return losses.mean(dim=1) if reduction == 'mean' else losses.sum(dim=1)
+
+
+def make_learning_rate_schedule(replicas: Sequence[ReplicaConfig], batch_size: int, batches_per_epoch: int,
+                                num_warmup_epochs: int=5, device=None):
+    """Creates a function returning the learning rate of each replica (as a tensor) at the given step.
+
+    The warmup schedule is the same as `train_lr.make_warmup_scheduler`.
+    """
+    learning_rates = torch.tensor([r.effective_learning_rate(batch_size) for r in replicas], device=device)
+    warmup = torch.tensor([r.warmup_lr for r in replicas], device=device)
+    num_warmup_batches = batches_per_epoch * num_warmup_epochs
+
+    def schedule(step: int) -> torch.Tensor:
+        factor = min(step / num_warmup_batches, 1)
+        return torch.where(warmup, learning_rates * factor, learning_rates)
+
+    return schedule
+
+
+def train_epoch(ensemble: Ensemble, optim: ReplicaSGD, scaler: Optional[torch.cuda.amp.GradScaler],
+                dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]], schedule, active: torch.Tensor,
+                step: int=0) -> Tuple[torch.Tensor, int]:
+    """Trains the replicas of the ensemble for a single epoch.
+
+    The learning rate of each replica is set in the optimizer before each step, and is zero for replicas which have diverged.
+
+    Parameters
+    ----------
+    ensemble : Ensemble
+        The replicas to train.
+    optim : ReplicaSGD
+        Optimizer of the parameters of the ensemble.
+    scaler : torch.cuda.amp.GradScaler, optional
+        If not `None`, the loss is scaled for 16-bit training.
+    dataloader : Iterable[Tuple[torch.Tensor, torch.Tensor]]
+        Batches of inputs and labels, shared by all replicas.
+    schedule : Callable[[int], torch.Tensor]
+        Learning rate of each replica at the given step (see `make_learning_rate_schedule`).
+    active : torch.Tensor
+        Boolean mask of the replicas which have not diverged, updated in place.
+    step : int
+        Number of steps taken before this epoch.
+
+    Returns
+    -------
+    torch.Tensor
+        The loss of each replica at each batch, of shape `[batches, replicas]`.
+    int
+        The number of steps taken after this epoch.
+    """
+    loss_values = []
+    params = ensemble.parameters()
+    device_type = params[0].device.type
+
+    for data in dataloader:
+        inputs, labels = data
+
+        optim.zero_grad()
+
+        with torch.autocast(device_type, enabled=scaler is not None):
+            losses = replica_losses(ensemble(inputs), labels)
+
+        # Stop updating replicas which have diverged, without synchronizing
+        active &= torch.isfinite(losses)
+        loss = torch.where(active, losses, torch.zeros_like(losses)).sum()
+
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+        grads = [p.grad for p in params]
+        # Gradients of diverged replicas may be nan, which would skip the step for all replicas
+        for g in grads:
+            g.masked_fill_(~_per_replica(active, g), 0)
+
+        lr = schedule(step) * active
+        for group in optim.param_groups:
+            group['lr'] = lr
+
+        if scaler is not None:
+            scaler.step(optim)
+            scaler.update()
+        else:
+            optim.step()
+
+        step += 1
+        loss_values.append(losses.detach().to(device='cpu', non_blocking=True))
+
+    return torch.stack(loss_values) if loss_values else torch.empty(0, ensemble.num_replicas), step
+
+
+def eval_ensemble(ensemble: Ensemble, dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Computes the loss and accuracy of each replica on the given data."""
+    with torch.no_grad():
+        total_loss = 0
+        total_correct = 0
+        total_observations = 0
+
+        for data in dataloader:
+            inputs, labels = data
+
+            outputs = ensemble(inputs)
+            total_loss += replica_losses(outputs, labels, reduction='sum')
+            total_correct += torch.sum(torch.argmax(outputs, dim=-1) == labels, dim=1)
+            total_observations += inputs.shape[0]
+
+    return total_loss.cpu() / total_observations, total_correct.cpu() / total_observations
+
+
+def train(config: EnsembleConfig) -> List[Dict[str, Any]]:
+    device = train_lr.resolve_device()
+    replicas = make_replicas(config)
+
+    torch.manual_seed(config.seed)
+    ensemble = Ensemble([train_lr.SimpleConvNet().to(device=device) for _ in replicas])
+
+    optim = ReplicaSGD(
+        ensemble.parameters(), torch.zeros(len(replicas), device=device),
+        momentum=config.momentum, weight_decay=config.weight_decay)
+    # Note: for better performance, we are using 16-bit training on GPU,
+    # so we are also using loss scaling there.
+    scaler = torch.cuda.amp.GradScaler() if device.type == 'cuda' else None
+
+    dataloader = train_lr.create_dataloader(
+        config.batch_size, config.seed, device=device, data_folder=config.data_folder, drop_last=True)
+    test_dataloader = train_lr.create_dataloader(
+        config.batch_size, config.seed, device=device, train=False, data_folder=config.data_folder)
+
+    schedule = make_learning_rate_schedule(replicas, config.batch_size, len(dataloader), config.warmup_epochs, device)
+    active = torch.ones(len(replicas), dtype=torch.bool, device=device)
+    step = 0
+    epoch_loss = torch.full((1, len(replicas)), float('nan'))
+
+    start_time = time.perf_counter()
+
+    for _ in tqdm.trange(config.max_epochs):
+        epoch_loss, step = train_epoch(ensemble, optim, scaler, dataloader, schedule, active, step)
+
+    end_time = time.perf_counter()
+
+    final_loss, final_accuracy = eval_ensemble(ensemble, test_dataloader)
+    active = active.cpu()
+
+    results = []
+    for i, replica in enumerate(replicas):
+        results.append({
+            **dataclasses.asdict(replica),
+            'effective_learning_rate': replica.effective_learning_rate(config.batch_size),
+            'train_loss': epoch_loss[:, i].mean().item(),
+            'loss': final_loss[i].item(),
+            'accuracy': final_accuracy[i].item(),
+            'diverged': not active[i].item(),
+        })
+
+    for r in results:
+        status = ' (diverged)' if r['diverged'] else ''
+        print(f"lr {r['learning_rate']:g} (effective {r['effective_learning_rate']:g}), "
+              f"scale_lr_by_bs {r['scale_lr_by_bs']}, warmup_lr {r['warmup_lr']}: "
+              f"final train loss {r['train_loss']:.3f}, final loss {r['loss']:.3f}, "
+              f"final accuracy {r['accuracy']:.2%}{status}")
+
+    print(f'Total time: {end_time - start_time:.1f} s for {len(replicas)} replicas.')
+    total_images = dataloader.dataset_size * config.max_epochs * len(replicas)
+    print(f'Training speed: {total_images / (end_time - start_time):.1f} img / s (summed over replicas).')
+
+    return results
+
+
+@hydra.main(config_name='config', config_path=None)
+def main(config: EnsembleConfig):
+    train(config)
+
+
+if __name__ == '__main__':
+    from hydra.core.config_store import ConfigStore
+    cs = ConfigStore()
+    cs.store(name='config', node=EnsembleConfig)
+    main()
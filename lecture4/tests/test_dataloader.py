@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from bootcamp import train_lr
+
+
+def _make_data(n=10):
+    images = torch.arange(n, dtype=torch.float32).view(n, 1, 1, 1).expand(n, 3, 4, 4).contiguous(memory_format=torch.channels_last)
+    labels = torch.arange(n)
+    return images, labels
+
+
+def test_dataloader_epoch():
+    images, labels = _make_data()
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4, generator=torch.Generator().manual_seed(0))
+
+    assert len(dataloader) == 3
+
+    seen = []
+    sizes = []
+    for x, y in dataloader:
+        assert x.is_contiguous(memory_format=torch.channels_last)
+        assert torch.equal(x[:, 0, 0, 0].long(), y)
+        seen.extend(y.tolist())
+        sizes.append(len(y))
+
+    assert sizes == [4, 4, 2]
+    assert sorted(seen) == list(range(10))
+
+
+def test_dataloader_drop_last_and_fill_last():
+    images, labels = _make_data()
+
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4, drop_last=True)
+    sizes = [len(y) for _, y in dataloader]
+    assert len(dataloader) == 2
+    assert sizes == [4, 4]
+
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4, fill_last=True)
+    seen = []
+    for _, y in dataloader:
+        assert len(y) == 4
+        seen.extend(y.tolist())
+    assert len(dataloader) == 3
+    assert set(seen) == set(range(10))
+
+    with pytest.raises(ValueError):
+        train_lr.InMemoryDataloader((images, labels), batch_size=4, drop_last=True, fill_last=True)
+
+
+def test_dataloader_subset():
+    images, labels = _make_data()
+    subset = torch.tensor([1, 3, 5, 7, 9])
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=2, subset=subset)
+
+    assert len(dataloader) == 3
+    assert sorted(y for _, batch in dataloader for y in batch.tolist()) == [1, 3, 5, 7, 9]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='Requires CUDA')
+def test_dataloader_prefetch_cuda():
+    images, labels = _make_data(100)
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=8, device='cuda')
+
+    seen = []
+    for x, y in dataloader:
+        assert x.is_cuda and y.is_cuda
+        assert torch.equal(x[:, 0, 0, 0].long(), y)
+        seen.extend(y.tolist())
+
+    assert sorted(seen) == list(range(100))
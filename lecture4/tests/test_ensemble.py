@@ -0,0 +1,83 @@
+import copy
+
+import pytest
+import torch
+
+from bootcamp import train_lr, train_lr_ensemble
+
+
+def _make_data(n=8):
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn([n, 3, 32, 32], generator=generator)
+    labels = torch.randint(0, 10, [n], generator=generator)
+    return images, labels
+
+
+@pytest.mark.parametrize('momentum,weight_decay', [(0.0, 0.0), (0.9, 1e-2)])
+def test_ensemble_matches_separate_models(momentum, weight_decay):
+    images, labels = _make_data()
+    replicas = [
+        train_lr_ensemble.ReplicaConfig(1e-2, scale_lr_by_bs=False, warmup_lr=False),
+        train_lr_ensemble.ReplicaConfig(1e-1, scale_lr_by_bs=False, warmup_lr=True),
+    ]
+
+    torch.manual_seed(0)
+    models = [train_lr.SimpleConvNet() for _ in replicas]
+    ensemble = train_lr_ensemble.Ensemble(models)
+    optim = train_lr_ensemble.ReplicaSGD(
+        ensemble.parameters(), torch.zeros(len(replicas)), momentum=momentum, weight_decay=weight_decay)
+
+    schedule = train_lr_ensemble.make_learning_rate_schedule(
+        replicas, batch_size=4, batches_per_epoch=2, num_warmup_epochs=1)
+    active = torch.ones(len(replicas), dtype=torch.bool)
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4, generator=torch.Generator().manual_seed(0))
+
+    losses, step = train_lr_ensemble.train_epoch(ensemble, optim, None, dataloader, schedule, active)
+    assert losses.shape == (2, 2)
+    assert step == 2
+    # The learning rate changes during warmup, which scales the update rather than the gradient
+    losses, step = train_lr_ensemble.train_epoch(ensemble, optim, None, dataloader, schedule, active, step)
+
+    for i, (model, replica) in enumerate(zip(models, replicas)):
+        model = copy.deepcopy(model)
+        model_optim = torch.optim.SGD(model.parameters(), lr=replica.learning_rate, momentum=momentum, weight_decay=weight_decay)
+        scheduler = train_lr.make_warmup_scheduler(model_optim, batches_per_epoch=2, num_warmup_epochs=1) if replica.warmup_lr else None
+
+        dataloader.generator.manual_seed(0)
+        train_lr.train_epoch(model, model_optim, None, dataloader, scheduler)
+        expected = train_lr.train_epoch(model, model_optim, None, dataloader, scheduler)
+
+        assert torch.allclose(losses[:, i], torch.tensor(expected), atol=1e-5)
+        for name, p in model.named_parameters():
+            assert torch.allclose(ensemble.params[name][i], p, atol=1e-5)
+
+    loss, accuracy = train_lr_ensemble.eval_ensemble(ensemble, dataloader)
+    assert loss.shape == (2,)
+    assert ((accuracy >= 0) & (accuracy <= 1)).all()
+
+
+def test_ensemble_diverged_replica_is_frozen():
+    images, labels = _make_data()
+    replicas = [
+        train_lr_ensemble.ReplicaConfig(1e-2, scale_lr_by_bs=False, warmup_lr=False),
+        train_lr_ensemble.ReplicaConfig(1e-2, scale_lr_by_bs=False, warmup_lr=True),
+    ]
+
+    ensemble = train_lr_ensemble.Ensemble([train_lr.SimpleConvNet() for _ in replicas])
+    with torch.no_grad():
+        ensemble.params['fc3.weight'][1].fill_(float('nan'))
+
+    optim = train_lr_ensemble.ReplicaSGD(ensemble.parameters(), torch.zeros(len(replicas)), momentum=0.9, weight_decay=1e-2)
+    schedule = train_lr_ensemble.make_learning_rate_schedule(replicas, batch_size=4, batches_per_epoch=1, num_warmup_epochs=1)
+    assert torch.allclose(schedule(0), torch.tensor([1e-2, 0.0]))
+
+    before = ensemble.params['fc1.weight'].detach().clone()
+    active = torch.ones(len(replicas), dtype=torch.bool)
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4)
+
+    train_lr_ensemble.train_epoch(ensemble, optim, None, dataloader, schedule, active)
+
+    assert active.tolist() == [True, False]
+    assert torch.isfinite(ensemble.params['fc1.weight'][0]).all()
+    assert not torch.equal(ensemble.params['fc1.weight'][0], before[0])
+    assert torch.equal(ensemble.params['fc1.weight'][1], before[1])
@@ -0,0 +1,118 @@
+import pytest
+import torch
+
+from bootcamp import optim, train_lr
+
+
+def test_parameter_groups_exclude_bias():
+    groups = optim.parameter_groups(train_lr.SimpleConvNet(), weight_decay=1e-4)
+
+    assert all(p.dim() > 1 for p in groups[0]['params'])
+    assert len(groups[1]['params']) == 5
+    assert groups[1]['trust_ratio'] is False
+
+
+@pytest.mark.parametrize('name', optim.OPTIMIZERS)
+def test_train_epoch_with_optimizer(name):
+    images = torch.randn([8, 3, 32, 32]).contiguous(memory_format=torch.channels_last)
+    labels = torch.randint(0, 10, [8])
+
+    model = train_lr.SimpleConvNet().to(memory_format=torch.channels_last)
+    lr = {'sgd': 1e-2, 'lars': 1.0, 'lamb': 1e-3}[name]
+    opt = optim.create_optimizer(name, model, lr, weight_decay=1e-4)
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4)
+
+    result = train_lr.train_epoch(model, opt, None, dataloader)
+    assert len(result) == 2
+    assert all(torch.isfinite(p).all() for p in model.parameters())
+
+
+def _make_params(generator):
+    return [torch.nn.Parameter(torch.randn(shape, generator=generator)) for shape in [(4, 3), (5,)]]
+
+
+@pytest.mark.parametrize('max_trust_ratio', [None, 0.5])
+def test_lars_step_matches_reference(max_trust_ratio):
+    generator = torch.Generator().manual_seed(0)
+    params = _make_params(generator)
+    grads = [torch.randn(p.shape, generator=generator) for p in params]
+    expected = []
+
+    for w, g in zip(params, grads):
+        # trust_coefficient * ||w|| / (||g|| + weight_decay * ||w||), clipped to max_trust_ratio
+        ratio = 2.0 * w.norm() / (g.norm() + 0.1 * w.norm())
+        if max_trust_ratio is not None:
+            assert ratio > max_trust_ratio
+            ratio = ratio.clamp(max=max_trust_ratio)
+        # The first momentum buffer is the update itself
+        expected.append(w.detach() - 0.5 * ratio * (g + 0.1 * w.detach()))
+
+    opt = optim.LARS(params, lr=0.5, momentum=0.9, weight_decay=0.1, trust_coefficient=2.0, max_trust_ratio=max_trust_ratio)
+    for p, g in zip(params, grads):
+        p.grad = g
+    opt.step()
+
+    for p, e in zip(params, expected):
+        assert torch.allclose(p, e, atol=1e-6)
+
+
+@pytest.mark.parametrize('max_trust_ratio', [None, 0.5])
+def test_lamb_step_matches_reference(max_trust_ratio):
+    generator = torch.Generator().manual_seed(0)
+    params = _make_params(generator)
+    beta1, beta2, eps = 0.9, 0.99, 1e-6
+    opt = optim.LAMB(params, lr=0.1, betas=(beta1, beta2), eps=eps, weight_decay=0.1, max_trust_ratio=max_trust_ratio)
+
+    moments = [(torch.zeros_like(p), torch.zeros_like(p)) for p in params]
+
+    # The second step, where the bias corrections of the moments no longer cancel out
+    for step in (1, 2):
+        grads = [torch.randn(p.shape, generator=generator) for p in params]
+        expected = []
+
+        for i, (w, g) in enumerate(zip(params, grads)):
+            m, v = moments[i]
+            m = beta1 * m + (1 - beta1) * g
+            v = beta2 * v + (1 - beta2) * g * g
+            moments[i] = (m, v)
+
+            r = (m / (1 - beta1 ** step)) / ((v / (1 - beta2 ** step)).sqrt() + eps) + 0.1 * w.detach()
+            ratio = w.norm() / r.norm()
+            if max_trust_ratio is not None:
+                assert ratio > max_trust_ratio
+                ratio = ratio.clamp(max=max_trust_ratio)
+            expected.append(w.detach() - 0.1 * ratio * r)
+
+        for p, g in zip(params, grads):
+            p.grad = g
+        opt.step()
+
+        for p, e in zip(params, expected):
+            assert torch.allclose(p, e, atol=1e-6)
+
+
+@pytest.mark.parametrize('name', ['lars', 'lamb'])
+def test_group_without_trust_ratio_matches_torch(name):
+    generator = torch.Generator().manual_seed(0)
+    params = _make_params(generator)
+    reference = [torch.nn.Parameter(p.detach().clone()) for p in params]
+
+    # As the group of biases and normalization parameters of `parameter_groups`, but with weight decay
+    group = {'params': params, 'weight_decay': 1e-2, 'trust_ratio': False}
+    if name == 'lars':
+        opt = optim.LARS([group], lr=0.1, momentum=0.9)
+        reference_opt = torch.optim.SGD(reference, lr=0.1, momentum=0.9, weight_decay=1e-2)
+    else:
+        opt = optim.LAMB([group], lr=1e-2, eps=1e-8)
+        reference_opt = torch.optim.AdamW(reference, lr=1e-2, eps=1e-8, weight_decay=1e-2)
+
+    for _ in range(3):
+        grads = [torch.randn(p.shape, generator=generator) for p in params]
+        for p, q, g in zip(params, reference, grads):
+            p.grad = g
+            q.grad = g.clone()
+        opt.step()
+        reference_opt.step()
+
+    for p, q in zip(params, reference):
+        assert torch.allclose(p, q, atol=1e-6)
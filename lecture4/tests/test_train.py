@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from bootcamp import train_lr
+
+
+def test_resolve_precision():
+    assert train_lr.resolve_precision('auto', torch.device('cpu')) == torch.float32
+    assert train_lr.resolve_precision('auto', torch.device('cuda')) == torch.float16
+    assert train_lr.resolve_precision('bf16', torch.device('cpu')) == torch.bfloat16
+
+    with pytest.raises(ValueError):
+        train_lr.resolve_precision('int8', torch.device('cpu'))
+
+
+@pytest.mark.parametrize('autocast_dtype', [torch.float32, torch.bfloat16])
+def test_train_epoch_cpu(autocast_dtype):
+    images = torch.randn([8, 3, 32, 32]).contiguous(memory_format=torch.channels_last)
+    labels = torch.randint(0, 10, [8])
+
+    model = train_lr.SimpleConvNet().to(memory_format=torch.channels_last)
+    optim = torch.optim.SGD(model.parameters(), lr=1e-2)
+    dataloader = train_lr.InMemoryDataloader((images, labels), batch_size=4)
+
+    result = train_lr.train_epoch(model, optim, None, dataloader, autocast_dtype=autocast_dtype)
+    assert len(result) == 2
+
+    loss, accuracy = train_lr.eval_model(model, dataloader, autocast_dtype=autocast_dtype)
+    assert loss > 0
+    assert 0 <= accuracy <= 1